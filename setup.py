@@ -31,6 +31,9 @@ setup(
         'Mako',
         'lxml'
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     entry_points={
         'console_scripts': [
             'flask-ctl=presence_analyzer.script:run',
@@ -39,6 +42,9 @@ setup(
         'paste.app_factory': [
             'main=presence_analyzer.script:make_app',
             'debug=presence_analyzer.script:make_debug',
-        ]
+        ],
+        'paste.server_runner': [
+            'prefork=presence_analyzer.prefork:server_runner',
+        ],
     }
 )
@@ -1,3 +1,3 @@
 # -*- coding: utf-8 -*-
 from .main import app
-from . import views
+from . import helpers, views
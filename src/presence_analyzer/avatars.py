@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Avatars of users fetched from the intranet once and cached on disk.
+"""
+import httplib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib2
+from collections import OrderedDict, namedtuple
+
+from presence_analyzer import metrics
+from presence_analyzer.main import app
+from presence_analyzer.utils import etag_of
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+AVATAR_CACHES = {}
+
+Avatar = namedtuple('Avatar', [
+    'path', 'size', 'content_type', 'etag', 'upstream_etag',
+    'last_modified', 'checked',
+])
+
+
+class AvatarCache(object):
+    """
+    Avatars kept in ``directory``, up to ``max_size`` bytes of them.
+
+    Every avatar is stored as a file named after the user id, next to
+    its metadata in a ``.json`` file. Least recently used avatars are
+    removed first once the cache grows too big; after a restart the
+    avatars checked longest ago count as least recently used.
+
+    ``get`` returns a cached avatar right away, revalidating it with a
+    conditional request in a background thread when it was checked
+    more than ``revalidate_after`` seconds ago. A missing avatar is
+    fetched while the caller waits, at most ``timeout`` seconds. After
+    a failed fetch the user's avatar isn't fetched again for
+    ``retry_after`` seconds.
+    """
+    max_image_size = 1024 * 1024
+
+    def __init__(self, directory, max_size, timeout=5,
+                 revalidate_after=3600, retry_after=60, clock=time.time):
+        self.directory = directory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.revalidate_after = revalidate_after
+        self.retry_after = retry_after
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.fetch_locks = {}
+        self.failures = {}
+        self.revalidating = set()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._scan()
+
+    def get(self, user_id, url):
+        """
+        Returns (Avatar, content) of given user, fetching it from ``url``
+        if needed. Returns None when it can't be fetched.
+        """
+        cached = self._cached(user_id)
+        if cached is not None:
+            entry = cached[0]
+            if self.clock() - entry.checked > self.revalidate_after \
+                    and not self._failed_recently(user_id):
+                metrics.AVATARS.inc('stale')
+                self._revalidate(user_id, url, entry)
+            else:
+                metrics.AVATARS.inc('hit')
+            return cached
+        if self._failed_recently(user_id):
+            metrics.AVATARS.inc('failed')
+            return None
+        with self.fetch_locks.setdefault(user_id, threading.Lock()):
+            # another thread may have fetched it meanwhile
+            cached = self._cached(user_id) or self._fetch(user_id, url)
+        metrics.AVATARS.inc('miss' if cached is not None else 'failed')
+        return cached
+
+    def _cached(self, user_id):
+        """
+        Returns (Avatar, content) of cached avatar, marking it as used.
+        """
+        with self.lock:
+            entry = self.entries.pop(user_id, None)
+            if entry is None:
+                return None
+            self.entries[user_id] = entry
+        try:
+            with open(entry.path, 'rb') as image:
+                return entry, image.read()
+        except IOError:
+            # removed by another process sharing the directory
+            self._remove(user_id)
+            return None
+
+    def _failed_recently(self, user_id):
+        """
+        Checks whether fetching avatar of user failed not long ago.
+        """
+        failed = self.failures.get(user_id)
+        return failed is not None and self.clock() - failed < self.retry_after
+
+    def _revalidate(self, user_id, url, entry):
+        """
+        Fetches avatar again in a background thread, unless it's being
+        fetched already.
+        """
+        with self.lock:
+            if user_id in self.revalidating:
+                return
+            self.revalidating.add(user_id)
+
+        def run():  # pylint: disable=C0111
+            try:
+                self._fetch(user_id, url, entry)
+            finally:
+                with self.lock:
+                    self.revalidating.discard(user_id)
+
+        thread = threading.Thread(
+            target=run, name='avatar-revalidate-{}'.format(user_id)
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _fetch(self, user_id, url, entry=None):
+        """
+        Downloads avatar, conditionally when ``entry`` is given, and
+        stores it. Returns (Avatar, content) or None on failure.
+        """
+        request = urllib2.Request(url)
+        if entry is not None and entry.upstream_etag:
+            request.add_header('If-None-Match', entry.upstream_etag)
+        if entry is not None and entry.last_modified:
+            request.add_header('If-Modified-Since', entry.last_modified)
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+            try:
+                info = response.info()
+                content = response.read(self.max_image_size + 1)
+            finally:
+                response.close()
+        except urllib2.HTTPError as error:
+            if error.code == 304 and entry is not None:
+                entry = entry._replace(checked=self.clock())
+                self._write_meta(entry)
+                self._add(user_id, entry)
+                return self._cached(user_id)
+            return self._failed(user_id, url, error)
+        except (IOError, httplib.HTTPException) as error:
+            return self._failed(user_id, url, error)
+        if not info.gettype().startswith('image/'):
+            return self._failed(user_id, url, info.gettype())
+        if len(content) > self.max_image_size:
+            return self._failed(user_id, url, 'too big')
+
+        entry = Avatar(
+            os.path.join(self.directory, str(user_id)),
+            len(content),
+            info.gettype(),
+            etag_of(content),
+            info.getheader('ETag'),
+            info.getheader('Last-Modified'),
+            self.clock(),
+        )
+        self._write(entry.path, content)
+        self._write_meta(entry)
+        self._add(user_id, entry)
+        self.failures.pop(user_id, None)
+        log.debug('Avatar of user %s fetched from %s', user_id, url)
+        return entry, content
+
+    def _failed(self, user_id, url, reason):
+        """
+        Remembers failed fetch, returns None.
+        """
+        log.warning('Fetching avatar of user %s from %s failed: %s',
+                    user_id, url, reason)
+        self.failures[user_id] = self.clock()
+
+    def _write(self, path, content):
+        """
+        Atomically writes file in the cache directory.
+        """
+        temporary = tempfile.NamedTemporaryFile(
+            dir=self.directory, prefix='.tmp', delete=False
+        )
+        try:
+            with temporary:
+                temporary.write(content)
+            os.rename(temporary.name, path)
+        except:
+            os.remove(temporary.name)
+            raise
+
+    def _write_meta(self, entry):
+        """
+        Writes metadata of avatar next to it.
+        """
+        self._write(entry.path + '.json', json.dumps(entry._asdict()))
+
+    def _add(self, user_id, entry):
+        """
+        Indexes avatar as the most recently used one, evicting the least
+        recently used ones while the cache is too big.
+        """
+        evicted = []
+        with self.lock:
+            previous = self.entries.pop(user_id, None)
+            if previous is not None:
+                self.size -= previous.size
+            self.entries[user_id] = entry
+            self.size += entry.size
+            while self.size > self.max_size and len(self.entries) > 1:
+                evicted.append(self.entries.popitem(last=False))
+                self.size -= evicted[-1][1].size
+        for evicted_id, evicted_entry in evicted:
+            log.debug('Avatar of user %s evicted', evicted_id)
+            self._delete(evicted_entry)
+
+    def _remove(self, user_id):
+        """
+        Drops avatar from the cache.
+        """
+        with self.lock:
+            entry = self.entries.pop(user_id, None)
+            if entry is None:
+                return
+            self.size -= entry.size
+        self._delete(entry)
+
+    def _delete(self, entry):
+        """
+        Removes files of avatar, if they are still there.
+        """
+        for path in [entry.path + '.json', entry.path]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _scan(self):
+        """
+        Indexes avatars stored in the directory, oldest checked first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or not name[:-5].isdigit():
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as meta:
+                    entry = Avatar(**json.load(meta))._replace(
+                        path=os.path.join(self.directory, name[:-5])
+                    )
+                if os.path.getsize(entry.path) != entry.size:
+                    raise ValueError('Size mismatch')
+            except (IOError, OSError, TypeError, ValueError):
+                log.warning('Ignoring broken avatar %s', name)
+                continue
+            entries.append((entry.checked, int(name[:-5]), entry))
+        for _, user_id, entry in sorted(entries):
+            self._add(user_id, entry)
+
+
+def get_avatar_cache():
+    """
+    Returns AvatarCache configured by AVATAR_CACHE_* settings.
+    """
+    directory = app.config.get('AVATAR_CACHE_DIR') or os.path.join(
+        tempfile.gettempdir(), 'presence_analyzer_avatars'
+    )
+    avatar_cache = AVATAR_CACHES.get(directory)
+    if avatar_cache is None:
+        avatar_cache = AVATAR_CACHES.setdefault(directory, AvatarCache(
+            directory,
+            app.config.get('AVATAR_CACHE_SIZE', 50 * 1024 * 1024),
+            timeout=app.config.get('AVATAR_TIMEOUT', 5),
+            revalidate_after=app.config.get('AVATAR_REVALIDATE_AFTER', 3600),
+        ))
+    return avatar_cache
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks.
+
+Every module is runnable on its own, e.g.:
+
+    bin/python-console -m presence_analyzer.benchmarks.memory
+"""
+import csv
+import os.path
+
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', '..',
+    'runtime', 'data', 'sample_data.csv'
+)
+
+
+def read_rows(path, scale):
+    """
+    Reads CSV rows, repeating them ``scale`` times under new user ids.
+    """
+    with open(path, 'r') as csvfile:
+        rows = [row for row in csv.reader(csvfile) if len(row) == 4]
+    step = max(int(row[0]) for row in rows) + 1
+    for copy in xrange(scale):
+        for row in rows:
+            yield [str(int(row[0]) + copy * step)] + row[1:]
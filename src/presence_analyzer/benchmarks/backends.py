@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Compares in-memory and SQLite storage backends: time to the first
+response of a fresh process and latency of per-user API requests.
+"""
+import csv
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from presence_analyzer.benchmarks import SAMPLE_DATA_CSV, read_rows
+
+FIRST_RESPONSE = '''
+import sys
+from presence_analyzer import app
+app.config.update({
+    'DATA_CSV': sys.argv[1],
+    'DATA_SNAPSHOT': sys.argv[2] or None,
+    'DATA_BACKEND': sys.argv[3],
+    'DATA_SQLITE': sys.argv[4],
+})
+response = app.test_client().get('/api/v1/mean_time_weekday/10')
+assert response.status_code == 200
+'''
+
+URLS = [
+    '/api/v1/presence_weekday/%d',
+    '/api/v1/mean_time_weekday/%d?from=2013-01-01&to=2013-12-31',
+    '/api/v1/presence_percentiles/%d',
+]
+
+SETUPS = [
+    ('memory', None, 'memory'),
+    ('memory, snapshot', 'snapshot', 'memory'),
+    ('sqlite', None, 'sqlite'),
+]
+
+
+def first_response(path, snapshot, backend, database):
+    """
+    Returns seconds a new process needs to answer its first request.
+    """
+    started = time.time()
+    subprocess.check_call([
+        sys.executable, '-c', FIRST_RESPONSE,
+        path, snapshot or '', backend, database,
+    ])
+    return time.time() - started
+
+
+def latency(path, backend, database, repeat):
+    """
+    Returns best mean seconds per request of every URL in URLS, for
+    every user, with data already loaded and no serialized results.
+    """
+    from presence_analyzer import app, utils
+    app.config.update({
+        'DATA_CSV': path,
+        'DATA_SNAPSHOT': None,
+        'DATA_BACKEND': backend,
+        'DATA_SQLITE': database,
+    })
+    utils.CACHE.clear()
+    client = app.test_client()
+    user_ids = list(utils.get_data())
+    result = []
+    for url in URLS:
+        timings = []
+        for _ in xrange(repeat):
+            # measure the queries, not serving serialized results
+            utils.JSON_CACHE.clear()
+            started = time.time()
+            for user_id in user_ids:
+                client.get(url % user_id)
+            timings.append((time.time() - started) / len(user_ids))
+        result.append(min(timings))
+    return result
+
+
+def main(scale=10, repeat=3, path=SAMPLE_DATA_CSV):
+    """
+    Prints cold start times and per-request latency of both backends.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data_csv = os.path.join(tmpdir, 'data.csv')
+        with open(data_csv, 'wb') as csvfile:
+            csv.writer(csvfile).writerows(read_rows(path, scale))
+        snapshot = data_csv + '.snapshot'
+        database = os.path.join(tmpdir, 'presence.sqlite')
+        print 'rows: %d (sample data x %d)' % (
+            sum(1 for _ in open(data_csv)), scale
+        )
+        started = time.time()
+        first_response(data_csv, None, 'sqlite', database)
+        print '%-18s %8.3f s' % ('sqlite import', time.time() - started)
+        # the first run writes the snapshot
+        first_response(data_csv, snapshot, 'memory', database)
+        print '\ncold start (best of %d)' % repeat
+        for name, snapshot_path, backend in SETUPS:
+            if snapshot_path is not None:
+                snapshot_path = snapshot
+            timings = [
+                first_response(data_csv, snapshot_path, backend, database)
+                for _ in xrange(repeat)
+            ]
+            print '%-18s %8.3f s' % (name, min(timings))
+        print '\nlatency per request (best of %d)' % repeat
+        for backend in ['memory', 'sqlite']:
+            timings = latency(data_csv, backend, database, repeat)
+            for url, seconds in zip(URLS, timings):
+                print '%-7s %-36s %7.3f ms' % (
+                    backend, url.split('?')[0], seconds * 1000
+                )
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Measures API throughput under 50 concurrent threads, like the Paste
+thread pool, with lock-free readers and with get_data as it was before
+them: the global ``locker`` around a cache updating its entry in place.
+The CSV keeps growing meanwhile, so data is reloaded during the run.
+"""
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from presence_analyzer import app, utils, views
+from presence_analyzer.benchmarks import SAMPLE_DATA_CSV, read_rows
+
+URLS = [
+    '/api/v1/mean_time_weekday/%d',
+    '/api/v1/presence_weekday/%d',
+    '/api/v1/presence_start_end/%d',
+]
+
+
+LEGACY_CACHE = {}
+
+
+def legacy_locker(func):
+    """
+    The removed ``locker`` decorator.
+    """
+    func.lock = threading.Lock()
+
+    def wrap(*args, **kwargs):  # pylint: disable=C0111
+        with func.lock:
+            return func(*args, **kwargs)
+    return wrap
+
+
+def legacy_cache(key, expiration_time, source=None, clock=time.time):
+    """
+    The ``cache`` decorator as it was next to ``locker``, updating its
+    entry in place.
+    """
+    refresh_lock = threading.Lock()
+
+    def signature():  # pylint: disable=C0111
+        return utils.file_signature(source()) if source else None
+
+    def wrap(func):  # pylint: disable=C0111
+        def refresh(entry, args, kwargs):  # pylint: disable=C0111
+            source_signature = signature()
+            try:
+                data = func(*args, **kwargs)
+            except Exception:  # pylint: disable=W0703
+                entry.update({'time': clock(), 'source': source_signature})
+            else:
+                entry.update({
+                    'data': data,
+                    'time': clock(),
+                    'source': source_signature,
+                })
+            finally:
+                entry['refreshing'] = None
+
+        def wrap_cache(*args, **kwargs):  # pylint: disable=C0111
+            entry = LEGACY_CACHE.get(key)
+            if entry is None:
+                source_signature = signature()
+                entry = LEGACY_CACHE[key] = {
+                    'data': func(*args, **kwargs),
+                    'time': clock(),
+                    'source': source_signature,
+                    'refreshing': None,
+                }
+                return entry['data']
+            data = entry['data']
+            expired = (
+                clock() - entry['time'] > expiration_time or
+                entry['source'] != signature()
+            )
+            if expired and entry['refreshing'] is None:
+                with refresh_lock:
+                    if entry['refreshing'] is None:
+                        entry['refreshing'] = threading.Thread(
+                            target=refresh, args=(entry, args, kwargs)
+                        )
+                        entry['refreshing'].daemon = True
+                        entry['refreshing'].start()
+            return data
+        return wrap_cache
+    return wrap
+
+
+@legacy_locker
+@legacy_cache('cache', 200, source=lambda: app.config['DATA_CSV'])
+def legacy_get_data():
+    """
+    ``get_data`` as it was before lock-free readers.
+    """
+    return utils.PRESENCE_LOADER.load(
+        app.config['DATA_CSV'],
+        app.config.get('DATA_SNAPSHOT'),
+        app.config.get('DATA_CSV_WORKERS', 1),
+        app.config.get('DATA_MODE', 'full'),
+    )
+
+
+def client(user_ids, deadline, latencies):
+    """
+    Sends requests until deadline, recording their latencies.
+    """
+    http = app.test_client()
+    number = 0
+    while time.time() < deadline:
+        url = URLS[number % len(URLS)] % user_ids[number % len(user_ids)]
+        started = time.time()
+        response = http.get(url)
+        latencies.append(time.time() - started)
+        assert response.status_code == 200, response.status_code
+        number += 1
+
+
+def writer(path, rows, deadline):
+    """
+    Appends a row to the CSV every 0.2 s, forcing reloads.
+    """
+    while time.time() < deadline:
+        time.sleep(0.2)
+        with open(path, 'ab') as csvfile:
+            csv.writer(csvfile).writerow(next(rows))
+
+
+def run(path, rows, threads, duration):
+    """
+    Returns request latencies of all threads from a single run.
+    """
+    utils.CACHE.clear()
+    utils.JSON_CACHE.clear()
+    LEGACY_CACHE.clear()
+    utils.PRESENCE_LOADER = utils.PresenceLoader()
+    user_ids = list(utils.get_data())
+    deadline = time.time() + duration
+    latencies = []
+    workers = [
+        threading.Thread(
+            target=client, args=(user_ids, deadline, latencies)
+        )
+        for _ in xrange(threads)
+    ]
+    workers.append(
+        threading.Thread(target=writer, args=(path, rows, deadline))
+    )
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sorted(latencies)
+
+
+def main(threads=50, duration=5, scale=10, path=SAMPLE_DATA_CSV):
+    """
+    Prints requests per second and latency percentiles of both modes.
+    """
+    tmpdir = tempfile.mkdtemp()
+    original = utils.get_data
+    try:
+        data_csv = os.path.join(tmpdir, 'data.csv')
+        rows = read_rows(path, scale * 2)
+        with open(data_csv, 'wb') as csvfile:
+            output = csv.writer(csvfile)
+            for _ in xrange(sum(1 for _ in read_rows(path, scale))):
+                output.writerow(next(rows))
+        app.config.update({'DATA_CSV': data_csv, 'DATA_SNAPSHOT': None})
+        print '%d threads, %d s per mode' % (threads, duration)
+        for name, get_data in [('locked', legacy_get_data),
+                               ('lock-free', original)]:
+            utils.get_data = views.get_data = get_data
+            latencies = run(data_csv, rows, threads, duration)
+            print '%-9s %8.1f req/s  p50 %6.1f ms  p99 %7.1f ms' % (
+                name,
+                len(latencies) / float(duration),
+                latencies[len(latencies) / 2] * 1000,
+                latencies[len(latencies) * 99 / 100] * 1000,
+            )
+    finally:
+        utils.get_data = views.get_data = original
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
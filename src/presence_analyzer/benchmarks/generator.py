@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic presence CSV and users.xml of any size:
+
+    bin/python-console -m presence_analyzer.benchmarks.generator \
+        USERS DAYS DIRECTORY
+"""
+import csv
+import os
+import random
+import sys
+from datetime import date, timedelta
+
+FIRST_DAY = date(2011, 1, 3)
+
+USERS_XML_HEAD = '''<?xml version="1.0" encoding="UTF-8" ?>
+<intranet>
+    <server>
+        <host>intranet.stxnext.pl</host>
+        <port>443</port>
+        <protocol>https</protocol>
+    </server>
+    <users>
+'''
+
+USERS_XML_USER = u'''        <user id="{0}">
+            <avatar>/api/images/users/{0}</avatar>
+            <name>{1}</name>
+        </user>
+'''
+
+USERS_XML_TAIL = '''    </users>
+</intranet>
+'''
+
+NAMES = [
+    'Adam', 'Agata', 'Bartosz', 'Ewa', 'Jan', u'Łukasz', 'Magda', 'Piotr',
+    u'Żaneta', 'Zofia',
+]
+
+
+def presence_rows(users, days, seed=0):
+    """
+    Yields (user_id, date, start, end) rows sorted by user and date.
+
+    Users come to work on weekdays only, with a day off now and then.
+    """
+    rand = random.Random(seed)
+    for user_id in xrange(1, users + 1):
+        for offset in xrange(days):
+            day = FIRST_DAY + timedelta(days=offset)
+            if day.weekday() > 4 or rand.random() < 0.1:
+                continue
+            start = rand.randint(7 * 3600, 11 * 3600)
+            end = start + rand.randint(4 * 3600, 9 * 3600)
+            yield (
+                user_id,
+                day.isoformat(),
+                '%02d:%02d:%02d' % (start / 3600, start / 60 % 60, start % 60),
+                '%02d:%02d:%02d' % (end / 3600, end / 60 % 60, end % 60),
+            )
+
+
+def generate_csv(path, users, days, seed=0):
+    """
+    Writes presence CSV of given number of users and days.
+    """
+    with open(path, 'wb') as csvfile:
+        csv.writer(csvfile).writerows(presence_rows(users, days, seed))
+
+
+def generate_xml(path, users, seed=0):
+    """
+    Writes users.xml describing given number of users.
+    """
+    rand = random.Random(seed)
+    with open(path, 'wb') as xmlfile:
+        xmlfile.write(USERS_XML_HEAD)
+        for user_id in xrange(1, users + 1):
+            name = u'{} {}.'.format(
+                rand.choice(NAMES), unichr(rand.randint(65, 90))
+            )
+            xmlfile.write(
+                USERS_XML_USER.format(user_id, name).encode('utf-8')
+            )
+        xmlfile.write(USERS_XML_TAIL)
+
+
+def generate(directory, users, days, seed=0):
+    """
+    Writes data.csv and users.xml to given directory, returns their paths.
+    """
+    data_csv = os.path.join(directory, 'data.csv')
+    data_xml = os.path.join(directory, 'users.xml')
+    generate_csv(data_csv, users, days, seed)
+    generate_xml(data_xml, users, seed)
+    return data_csv, data_xml
+
+
+if __name__ == '__main__':
+    print generate(sys.argv[3], int(sys.argv[1]), int(sys.argv[2]))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Compares memory used by the legacy dict-of-dicts and PresenceStore.
+"""
+import sys
+from array import array
+from datetime import datetime
+
+from presence_analyzer.benchmarks import SAMPLE_DATA_CSV, read_rows
+from presence_analyzer.store import PresenceStore
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Returns size of given object and everything reachable from it,
+    including attributes of objects and buffers of arrays.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, array):
+        # older Pythons leave the buffer out of getsizeof
+        return sys.getsizeof(array(obj.typecode)) + \
+            obj.buffer_info()[1] * obj.itemsize
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+
+def legacy_structure(rows):
+    """
+    Builds the {user_id: {date: {'start': time, 'end': time}}} structure.
+    """
+    data = {}
+    for row in rows:
+        user_id = int(row[0])
+        date = datetime.strptime(row[1], '%Y-%m-%d').date()
+        start = datetime.strptime(row[2], '%H:%M:%S').time()
+        end = datetime.strptime(row[3], '%H:%M:%S').time()
+        data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+    return data
+
+
+def store_structure(rows):
+    """
+    Builds PresenceStore out of the same rows.
+    """
+    def parsed():  # pylint: disable=C0111
+        for row in rows:
+            date = datetime.strptime(row[1], '%Y-%m-%d').date()
+            start = datetime.strptime(row[2], '%H:%M:%S').time()
+            end = datetime.strptime(row[3], '%H:%M:%S').time()
+            yield (
+                int(row[0]),
+                date.toordinal(),
+                start.hour * 3600 + start.minute * 60 + start.second,
+                end.hour * 3600 + end.minute * 60 + end.second,
+            )
+    return PresenceStore.from_rows(parsed())
+
+
+def main(scale=100, path=SAMPLE_DATA_CSV):
+    """
+    Prints memory used by both structures.
+    """
+    rows = list(read_rows(path, scale))
+    print 'rows: %d (sample data x %d)' % (len(rows), scale)
+    results = []
+    for name, build in [('dict', legacy_structure),
+                        ('store', store_structure)]:
+        data = build(rows)
+        size = deep_sizeof(data)
+        results.append(size)
+        print '%-6s %12d bytes %8.1f bytes/row' % (
+            name, size, float(size) / len(rows)
+        )
+        if isinstance(data, PresenceStore):
+            for column, values in data.to_columns():
+                print '  %-20s %8.1f bytes/row' % (
+                    column, float(deep_sizeof(values)) / len(rows)
+                )
+        del data
+    print 'ratio: %.1fx' % (float(results[0]) / results[1])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how loading presence CSV scales with worker processes.
+"""
+import csv
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from presence_analyzer.benchmarks import SAMPLE_DATA_CSV, read_rows
+from presence_analyzer.utils import PresenceLoader
+
+
+def main(scale=100, path=SAMPLE_DATA_CSV):
+    """
+    Prints load time with 1, 2, 4 and 8 worker processes.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data_csv = os.path.join(tmpdir, 'data.csv')
+        with open(data_csv, 'wb') as csvfile:
+            csv.writer(csvfile).writerows(read_rows(path, scale))
+        print 'size: %d bytes (sample data x %d), %d CPUs' % (
+            os.path.getsize(data_csv), scale, multiprocessing.cpu_count()
+        )
+        serial = None
+        for workers in [1, 2, 4, 8]:
+            started = time.time()
+            data = PresenceLoader().load(data_csv, workers=workers)
+            elapsed = time.time() - started
+            if serial is None:
+                serial = elapsed, data.to_columns()
+            assert data.to_columns() == serial[1]
+            print '%d workers %8.3f s %6.2fx' % (
+                workers, elapsed, serial[0] / elapsed
+            )
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Compares CSV parsing speed of the fast and the strptime based path.
+"""
+import sys
+import time
+
+from presence_analyzer.benchmarks import SAMPLE_DATA_CSV, read_rows
+from presence_analyzer.utils import parse_rows, parse_row_strict
+
+
+def strict_rows(rows):
+    """
+    Parses every row with datetime.strptime, like get_data used to.
+    """
+    for i, row in enumerate(rows):
+        if len(row) != 4:
+            continue
+        parsed = parse_row_strict(row, i)
+        if parsed is not None:
+            yield parsed
+
+
+def main(scale=10, path=SAMPLE_DATA_CSV):
+    """
+    Prints rows per second of both parsers.
+    """
+    rows = list(read_rows(path, scale))
+    print 'rows: %d (sample data x %d)' % (len(rows), scale)
+    results = {}
+    for name, parse in [('strict', strict_rows), ('fast', parse_rows)]:
+        started = time.time()
+        results[name] = list(parse(rows))
+        elapsed = time.time() - started
+        print '%-6s %8.3f s %12.0f rows/s' % (
+            name, elapsed, len(rows) / elapsed
+        )
+    assert results['strict'] == results['fast']
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Measures requests per second and memory of the prefork server for 1 to
+8 workers, on bulk statistics of random ranges of days, which are CPU
+bound and never served from the JSON cache.
+
+Memory is summed over the master and its workers: RSS counts shared
+pages once per process, PSS splits them between processes sharing them.
+"""
+import csv
+import httplib
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+
+from presence_analyzer.benchmarks import SAMPLE_DATA_CSV, read_rows
+
+SERVE = '''
+import sys
+from presence_analyzer import app
+from presence_analyzer.prefork import PreforkServer
+app.config.update({'DATA_CSV': sys.argv[1], 'DATA_SNAPSHOT': None})
+server = PreforkServer(app, '127.0.0.1', 0, int(sys.argv[2]))
+print server.port
+sys.stdout.flush()
+server.serve_forever()
+'''
+
+FIRST_DAY = date(2011, 6, 1).toordinal()
+LAST_DAY = date(2013, 9, 12).toordinal()
+
+
+def random_url():
+    """
+    Returns URL of weekday statistics of all users in a random range.
+    """
+    first, last = sorted(random.randint(FIRST_DAY, LAST_DAY)
+                         for _ in xrange(2))
+    return '/api/v1/presence_start_end?from={}&to={}'.format(
+        date.fromordinal(first), date.fromordinal(last)
+    )
+
+
+def child_pids(pid):
+    """
+    Returns pids of child processes of given process.
+    """
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(name))
+    return children
+
+
+def memory_kb(pid):
+    """
+    Returns (RSS, PSS) of given process in kB.
+    """
+    rss = pss = 0
+    with open('/proc/{}/smaps'.format(pid)) as smaps:
+        for line in smaps:
+            if line.startswith('Rss:'):
+                rss += int(line.split()[1])
+            elif line.startswith('Pss:'):
+                pss += int(line.split()[1])
+    return rss, pss
+
+
+def start_server(data_csv, workers):
+    """
+    Starts prefork server in a new process, returns (process, port).
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-c', SERVE, data_csv, str(workers)],
+        stdout=subprocess.PIPE,
+    )
+    port = int(process.stdout.readline())
+    # wait until every worker answers
+    while len(child_pids(process.pid)) < workers:
+        time.sleep(0.1)
+    request(port, '/api/v1/presence_start_end')
+    return process, port
+
+
+def request(port, url):
+    """
+    Sends GET request, returns the response body.
+    """
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    try:
+        connection.request('GET', url)
+        response = connection.getresponse()
+        assert response.status == 200, (url, response.status)
+        return response.read()
+    finally:
+        connection.close()
+
+
+def client(task):
+    """
+    Sends requests for given number of seconds, returns their count.
+    """
+    port, seconds, seed = task
+    random.seed(seed)
+    deadline = time.time() + seconds
+    count = 0
+    while time.time() < deadline:
+        request(port, random_url())
+        count += 1
+    return count
+
+
+def measure(data_csv, workers, clients, seconds):
+    """
+    Returns (requests per second, RSS kB, PSS kB) of server with given
+    number of workers under load of given number of clients.
+    """
+    process, port = start_server(data_csv, workers)
+    try:
+        pool = multiprocessing.Pool(clients)
+        try:
+            started = time.time()
+            counts = pool.map(client, [
+                (port, seconds, seed) for seed in xrange(clients)
+            ])
+            elapsed = time.time() - started
+        finally:
+            pool.close()
+            pool.join()
+        memory = [memory_kb(pid)
+                  for pid in [process.pid] + child_pids(process.pid)]
+        return (
+            sum(counts) / elapsed,
+            sum(rss for rss, _ in memory),
+            sum(pss for _, pss in memory),
+        )
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(scale=10, seconds=10, path=SAMPLE_DATA_CSV):
+    """
+    Prints throughput and memory for 1 to 8 workers.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data_csv = os.path.join(tmpdir, 'data.csv')
+        with open(data_csv, 'wb') as csvfile:
+            csv.writer(csvfile).writerows(read_rows(path, scale))
+        print 'rows: %d (sample data x %d), %d CPUs' % (
+            sum(1 for _ in open(data_csv)), scale,
+            multiprocessing.cpu_count(),
+        )
+        print '%7s %9s %12s %12s' % ('workers', 'req/s', 'RSS kB', 'PSS kB')
+        for workers in xrange(1, 9):
+            rps, rss, pss = measure(data_csv, workers, 2 * workers, seconds)
+            print '%7d %9.1f %12d %12d' % (workers, rps, rss, pss)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
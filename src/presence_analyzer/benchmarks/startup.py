@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Measures time to the first response of a fresh process, with and
+without binary snapshot of presence data.
+"""
+import csv
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from presence_analyzer.benchmarks import SAMPLE_DATA_CSV, read_rows
+
+FIRST_RESPONSE = '''
+import sys
+from presence_analyzer import app
+app.config.update({'DATA_CSV': sys.argv[1], 'DATA_SNAPSHOT': sys.argv[2]})
+response = app.test_client().get('/api/v1/mean_time_weekday/10')
+assert response.status_code == 200
+'''
+
+
+def first_response(path, snapshot):
+    """
+    Returns seconds a new process needs to answer its first request.
+    """
+    started = time.time()
+    subprocess.check_call(
+        [sys.executable, '-c', FIRST_RESPONSE,
+         path, snapshot or ''],
+    )
+    return time.time() - started
+
+
+def main(scale=10, repeat=3, path=SAMPLE_DATA_CSV):
+    """
+    Prints time to the first response with and without snapshot.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data_csv = os.path.join(tmpdir, 'data.csv')
+        with open(data_csv, 'wb') as csvfile:
+            csv.writer(csvfile).writerows(read_rows(path, scale))
+        snapshot = data_csv + '.snapshot'
+        print 'rows: %d (sample data x %d)' % (
+            sum(1 for _ in open(data_csv)), scale
+        )
+        # the first run writes the snapshot
+        first_response(data_csv, snapshot)
+        for name, snapshot_path in [('csv', None), ('snapshot', snapshot)]:
+            timings = [first_response(data_csv, snapshot_path)
+                       for _ in xrange(repeat)]
+            print '%-9s %8.3f s (best of %d)' % (name, min(timings), repeat)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Times data loading, grouping helpers and every API view on synthetic
+data, recording wall time and peak memory of each case to JSON:
+
+    bin/python-console -m presence_analyzer.benchmarks.suite \
+        run --users 100 --days 730 --output before.json
+    bin/python-console -m presence_analyzer.benchmarks.suite \
+        diff before.json after.json
+
+Every case runs in a fresh process, so its peak RSS isn't inflated by
+the cases before it.
+"""
+import argparse
+import json
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from presence_analyzer.benchmarks.generator import generate
+
+PER_USER_VIEWS = [
+    '/api/v1/mean_time_weekday/%d',
+    '/api/v1/presence_weekday/%d',
+    '/api/v1/presence_start_end/%d',
+]
+
+VIEWS = [
+    '/api/v1/users',
+    '/api/v1/mean_time_weekday',
+    '/api/v1/presence_weekday',
+    '/api/v1/presence_start_end',
+]
+
+
+def fresh_data():
+    """
+    Loads presence data from scratch, bypassing cache and loader state.
+    """
+    from presence_analyzer import utils
+    utils.CACHE.clear()
+    utils.PRESENCE_LOADER = utils.PresenceLoader()
+    return utils.get_data()
+
+
+def each_user(helper):
+    """
+    Returns case calling given helper on entries of every user.
+    """
+    def case():  # pylint: disable=C0111
+        from presence_analyzer import utils
+        data = utils.get_data()
+        for user_id in data:
+            helper(data[user_id])
+    return case
+
+
+def request(*urls):
+    """
+    Returns case requesting given URLs, for every user if they need one.
+    """
+    def case():  # pylint: disable=C0111
+        from presence_analyzer import app, utils
+        utils.JSON_CACHE.clear()
+        client = app.test_client()
+        for url in urls:
+            paths = [url % user_id for user_id in utils.get_data()] \
+                if '%d' in url else [url]
+            for path in paths:
+                response = client.get(path)
+                assert response.status_code == 200, (path, response.status)
+                response.get_data()  # streamed bodies are built lazily
+    return case
+
+
+def cases():
+    """
+    Returns benchmark cases by name.
+    """
+    from presence_analyzer import utils
+    result = OrderedDict([
+        ('get_data', fresh_data),
+        ('group_by_weekday', each_user(utils.group_by_weekday)),
+        ('return_id_start_end', each_user(utils.return_id_start_end)),
+        ('get_data_from_xml', utils.get_data_from_xml),
+    ])
+    for url in PER_USER_VIEWS + VIEWS:
+        result['GET ' + url.replace('%d', '<id>')] = request(url)
+    return result
+
+
+def run_case(name, data_csv, data_xml, repeat):
+    """
+    Runs a single case in this process, returns its measurements.
+    """
+    from presence_analyzer import app
+    app.config.update({
+        'DATA_CSV': data_csv,
+        'DATA_XML': data_xml,
+        'DATA_SNAPSHOT': None,
+    })
+    case = cases()[name]
+    if name != 'get_data':
+        case()  # warm up caches the case doesn't measure
+    timings = []
+    for _ in xrange(repeat):
+        started = time.time()
+        case()
+        timings.append(time.time() - started)
+    return {
+        'seconds': min(timings),
+        'repeat': repeat,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run(users, days, repeat, output):
+    """
+    Runs all cases on generated data, writes results to ``output``.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data_csv, data_xml = generate(tmpdir, users, days)
+        results = OrderedDict([
+            ('users', users), ('days', days), ('cases', OrderedDict())
+        ])
+        for name in cases():
+            measured = json.loads(subprocess.check_output([
+                sys.executable, '-m', 'presence_analyzer.benchmarks.suite',
+                'case', name, data_csv, data_xml, str(repeat),
+            ]))
+            results['cases'][name] = measured
+            print '%-38s %9.4f s %9d kB' % (
+                name, measured['seconds'], measured['peak_rss_kb']
+            )
+    finally:
+        shutil.rmtree(tmpdir)
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+
+
+def diff(before, after, threshold=0.1):
+    """
+    Prints relative change of every case between two result files.
+
+    Returns number of cases slower or bigger by more than ``threshold``.
+    """
+    with open(before) as before_file:
+        old = json.load(before_file, object_pairs_hook=OrderedDict)
+    with open(after) as after_file:
+        new = json.load(after_file, object_pairs_hook=OrderedDict)
+    regressions = 0
+    for name, measured in new['cases'].iteritems():
+        if name not in old['cases']:
+            print '%-38s new' % name
+            continue
+        changes = [
+            measured[key] / float(old['cases'][name][key]) - 1
+            for key in ['seconds', 'peak_rss_kb']
+        ]
+        flag = ''
+        if max(changes) > threshold:
+            regressions += 1
+            flag = ' REGRESSION'
+        print '%-38s time %+7.1f%%  memory %+7.1f%%%s' % (
+            name, changes[0] * 100, changes[1] * 100, flag
+        )
+    return regressions
+
+
+def main(argv=None):
+    """
+    Parses command line and runs the requested command.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='run benchmarks')
+    run_parser.add_argument('--users', type=int, default=100)
+    run_parser.add_argument('--days', type=int, default=730)
+    run_parser.add_argument('--repeat', type=int, default=5)
+    run_parser.add_argument('--output', default='benchmark.json')
+    diff_parser = commands.add_parser('diff', help='compare two results')
+    diff_parser.add_argument('before')
+    diff_parser.add_argument('after')
+    diff_parser.add_argument('--threshold', type=float, default=0.1)
+    case_parser = commands.add_parser('case')
+    case_parser.add_argument('name')
+    case_parser.add_argument('data_csv')
+    case_parser.add_argument('data_xml')
+    case_parser.add_argument('repeat', type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        run(args.users, args.days, args.repeat, args.output)
+    elif args.command == 'diff':
+        return 1 if diff(args.before, args.after, args.threshold) else 0
+    else:
+        print json.dumps(
+            run_case(args.name, args.data_csv, args.data_xml, args.repeat)
+        )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
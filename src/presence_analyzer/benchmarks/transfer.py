@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Measures bytes transferred per view of every page: the page, its
+static files and the JSON it asks for.
+"""
+import re
+import sys
+
+from presence_analyzer import app
+from presence_analyzer.benchmarks import SAMPLE_DATA_CSV
+from presence_analyzer.helpers import compress_static
+from presence_analyzer.views import pages_list
+
+ASSET = re.compile(r'(?:src|href)="(/static/[^"]+)"')
+LONG_LIVED = 24 * 3600
+
+
+def page_requests(client, page_name):
+    """
+    Returns URLs a browser fetches to show given page of the first user.
+    """
+    page = client.get('/' + page_name)
+    urls = ['/' + page_name] + ASSET.findall(page.data)
+    urls.append('/api/v1/users')
+    endpoint = '/api/v1/{}'.format(page_name)
+    if page_name != 'occupancy':
+        endpoint += '/10'
+    urls.append(endpoint)
+    return urls
+
+
+def view(client, urls, headers, cached):
+    """
+    Fetches given URLs like a browser, returns transferred body bytes.
+
+    Responses in ``cached`` are reused if fresh, or revalidated with
+    their ETag, and are updated with the new ones.
+    """
+    transferred = 0
+    for url in urls:
+        previous = cached.get(url)
+        if previous is not None and \
+                (previous.cache_control.max_age or 0) >= LONG_LIVED:
+            continue
+        request_headers = dict(headers)
+        if previous is not None and previous.headers.get('ETag'):
+            request_headers['If-None-Match'] = previous.headers['ETag']
+        response = client.get(url, headers=request_headers)
+        transferred += len(response.get_data())
+        if response.status_code == 200:
+            cached[url] = response
+    return transferred
+
+
+def main(path=SAMPLE_DATA_CSV):
+    """
+    Prints bytes of the first and a repeated view of every page, with
+    and without compression.
+    """
+    app.config.update({'DATA_CSV': path})
+    compress_static()
+    client = app.test_client()
+    print '%-20s %12s %12s %12s' % (
+        'page', 'identity', 'gzip', 'gzip repeat'
+    )
+    for page_name in pages_list:
+        urls = page_requests(client, page_name)
+        cached = {}
+        plain = view(client, urls, {}, {})
+        compressed = view(client, urls, {'Accept-Encoding': 'gzip'}, cached)
+        repeated = view(client, urls, {'Accept-Encoding': 'gzip'}, cached)
+        print '%-20s %12d %12d %12d' % (
+            page_name, plain, compressed, repeated
+        )
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data kept in an SQLite database file.
+"""
+import sqlite3
+import threading
+from array import array
+from collections import Mapping
+from contextlib import contextmanager
+from datetime import date
+
+from presence_analyzer import sketch
+from presence_analyzer.store import GENERATIONS, PresenceStore, QuantileIndex
+from presence_analyzer.store import occupancy, weekday, weekday_quantiles
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    weekday INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS import_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    path TEXT NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    offset INTEGER NOT NULL,
+    tail BLOB NOT NULL,
+    checksum INTEGER NOT NULL
+);
+'''
+TIMEOUT = 60
+
+LOCAL = threading.local()
+INHERITED = []
+INITIALIZED = set()
+INITIALIZED_LOCK = threading.Lock()
+
+
+def connect(path):
+    """
+    Returns connection to given database owned by the current thread.
+
+    Every thread opens its own connection on first use and keeps it for
+    later calls. The schema is created once per process. Connections
+    are in autocommit mode, use ``transaction`` to group writes.
+    """
+    connections = getattr(LOCAL, 'connections', None)
+    if connections is None:
+        connections = LOCAL.connections = {}
+    connection = connections.get(path)
+    if connection is None:
+        connection = sqlite3.connect(
+            path, timeout=TIMEOUT, isolation_level=None
+        )
+        with INITIALIZED_LOCK:
+            if path not in INITIALIZED:
+                # readers don't wait for an import in write-ahead log mode
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.executescript(SCHEMA)
+                columns = [row[1] for row in connection.execute(
+                    'PRAGMA table_info(import_state)'
+                )]
+                if 'checksum' not in columns:
+                    # state of an older version, imported again in full
+                    connection.execute('DROP TABLE import_state')
+                    connection.executescript(SCHEMA)
+                INITIALIZED.add(path)
+        connections[path] = connection
+    return connection
+
+
+def forget_connections():
+    """
+    Makes the current thread open new connections, to be called in a
+    forked process. Connections inherited from the parent are left open,
+    closing them could release locks the parent holds.
+    """
+    INHERITED.extend(getattr(LOCAL, 'connections', {}).itervalues())
+    LOCAL.connections = {}
+
+
+@contextmanager
+def transaction(connection):
+    """
+    Runs block in a transaction holding the write lock from the start,
+    commits it unless the block raises.
+    """
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+    except:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+
+def insert_rows(connection, rows):
+    """
+    Inserts (user_id, day ordinal, start, end) tuples, later rows win
+    over earlier ones for the same user and day.
+    """
+    connection.executemany(
+        'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?, ?)',
+        ((user_id, day, weekday(day), start, end)
+         for user_id, day, start, end in rows)
+    )
+
+
+def read_import_state(connection):
+    """
+    Returns dict describing how much of which file was imported, or None
+    when nothing was imported yet.
+    """
+    row = connection.execute(
+        'SELECT path, inode, size, mtime, offset, tail, checksum '
+        'FROM import_state'
+    ).fetchone()
+    if row is None:
+        return None
+    return dict(zip(
+        ['path', 'inode', 'size', 'mtime', 'offset', 'tail', 'checksum'],
+        row
+    ))
+
+
+def write_import_state(connection, path, stat, offset, tail, checksum):
+    """
+    Records that ``offset`` bytes of file at ``path`` were imported,
+    ending with ``tail`` and with CRC-32 ``checksum``.
+    """
+    connection.execute(
+        'INSERT OR REPLACE INTO import_state VALUES '
+        '(1, ?, ?, ?, ?, ?, ?, ?)',
+        (path, stat.st_ino, stat.st_size, stat.st_mtime, offset,
+         sqlite3.Binary(tail), checksum)
+    )
+
+
+class SqliteStore(Mapping):
+    """
+    Presence entries of all users kept in an SQLite database.
+
+    Answers the same questions as PresenceStore, but only the user ids
+    are held in memory: weekday statistics are SQL aggregates over rows
+    of a user found by the (user_id, day) primary key, and every thread
+    queries through its own connection, see ``connect``.
+
+    A store describes the database as it was when created, a new one is
+    created after every import, so ``generation`` changes along with
+    the data.
+    """
+    has_ranges = True
+
+    def __init__(self, path):
+        self.path = path
+        connection = connect(path)
+        self.users = array('i', [
+            user_id for user_id, in connection.execute(
+                'SELECT DISTINCT user_id FROM presence ORDER BY user_id'
+            )
+        ])
+        self.rows_count = connection.execute(
+            'SELECT COUNT(*) FROM presence'
+        ).fetchone()[0]
+        self.index = frozenset(self.users)
+        self.generation = next(GENERATIONS)
+
+    def __len__(self):
+        return len(self.users)
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    def __getitem__(self, user_id):
+        if user_id not in self.index:
+            raise KeyError(user_id)
+        rows = connect(self.path).execute(
+            'SELECT user_id, day, start_time, end_time FROM presence '
+            'WHERE user_id = ?', (user_id,)
+        )
+        return PresenceStore.from_rows(rows)[user_id]
+
+    def weekday_stats(self, user_id):
+        """
+        Returns (count, total, start, end) sums for every weekday of user.
+        """
+        return self._stats(
+            'WHERE user_id = ? GROUP BY weekday', (user_id,)
+        )
+
+    def range_stats(self, user_id, first_day, last_day):
+        """
+        Same as ``weekday_stats``, limited to days between ``first_day``
+        and ``last_day`` ordinals inclusive. Zeros for unknown users.
+        """
+        return self._stats(
+            'WHERE user_id = ? AND day BETWEEN ? AND ? GROUP BY weekday',
+            (user_id, first_day, last_day)
+        )
+
+    def _stats(self, condition, parameters):
+        """
+        Returns weekday sums of rows matching given SQL condition.
+        """
+        result = [(0, 0, 0, 0)] * 7
+        for row in connect(self.path).execute(
+                'SELECT weekday, COUNT(*), SUM(end_time - start_time), '
+                'SUM(start_time), SUM(end_time) FROM presence ' + condition,
+                parameters):
+            result[row[0]] = row[1:]
+        return result
+
+    def quantile_stats(self, user_id, quantiles):
+        """
+        Returns ``{'presence': [...], 'start': [...], 'end': [...]}``
+        estimates of given quantiles for every weekday of user.
+
+        SQLite has no percentile aggregate, so values of the user are
+        sketched on the fly.
+        """
+        values = [[[] for _ in QuantileIndex.metrics] for _ in xrange(7)]
+        for day_of_week, start, end in connect(self.path).execute(
+                'SELECT weekday, start_time, end_time FROM presence '
+                'WHERE user_id = ?', (user_id,)):
+            columns = values[day_of_week]
+            columns[0].append(end - start)
+            columns[1].append(start)
+            columns[2].append(end)
+        return weekday_quantiles(
+            lambda day_of_week, metric: sketch.sketch(
+                values[day_of_week][metric]
+            ),
+            quantiles,
+        )
+
+    def occupancy(self, first_day=None, last_day=None):
+        """
+        Returns mean number of people present at every minute of every
+        weekday, see ``occupancy``.
+        """
+        days, starts, ends = array('i'), array('i'), array('i')
+        for day, start, end in connect(self.path).execute(
+                'SELECT day, start_time, end_time FROM presence '
+                'WHERE day BETWEEN ? AND ?',
+                (first_day or 1, last_day or date.max.toordinal())):
+            days.append(day)
+            starts.append(start)
+            ends.append(end)
+        return occupancy(days, starts, ends, first_day, last_day)
@@ -2,3 +2,101 @@
 """
 Helper functions used in templates.
 """
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import abort, request, safe_join, send_file, url_for
+from presence_analyzer.main import app
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+STATIC_HASHES = {}
+STATIC_MAX_AGE = 365 * 24 * 3600
+COMPRESSED_TYPES = ('.css', '.js', '.html', '.svg', '.json')
+
+
+def static_hash(filename):
+    """
+    Returns short hash of static file content, cached until it changes.
+    """
+    path = safe_join(app.static_folder, filename.lstrip('/'))
+    stat = os.stat(path)
+    cached = STATIC_HASHES.get(path)
+    if cached is None or cached[0] != (stat.st_size, stat.st_mtime):
+        with open(path, 'rb') as static_file:
+            digest = hashlib.sha1(static_file.read()).hexdigest()[:12]
+        cached = STATIC_HASHES[path] = ((stat.st_size, stat.st_mtime), digest)
+    return cached[1]
+
+
+@app.template_global()
+def static_url(filename):
+    """
+    Returns URL of static file which changes with its content, so the
+    file can be cached by browsers for good.
+    """
+    return url_for('static', filename=filename, v=static_hash(filename))
+
+
+def compress_static(directory=None):
+    """
+    Writes gzipped copies next to static text files, unless there are
+    up to date ones already. Returns paths of written copies.
+    """
+    written = []
+    for root, _, files in os.walk(directory or app.static_folder):
+        for name in files:
+            if not name.endswith(COMPRESSED_TYPES):
+                continue
+            path = os.path.join(root, name)
+            compressed = path + '.gz'
+            if os.path.exists(compressed) and \
+                    os.path.getmtime(compressed) >= os.path.getmtime(path):
+                continue
+            with open(path, 'rb') as source:
+                content = source.read()
+            temporary = compressed + '.tmp'
+            # fixed mtime keeps output identical for identical input
+            with open(temporary, 'wb') as target:
+                with gzip.GzipFile(name, 'wb', 9, target, mtime=0) as gz:
+                    gz.write(content)
+            os.rename(temporary, compressed)
+            log.debug('Compressed %s', path)
+            written.append(compressed)
+    return written
+
+
+def send_static_file(filename):
+    """
+    Serves static file, or its gzipped copy to clients accepting it.
+
+    Requests for the current version of a file, see ``static_url``, may
+    be cached for a year.
+    """
+    path = safe_join(app.static_folder, filename)
+    if path is None:
+        abort(404)
+    compressed = path + '.gz'
+    if request.accept_encodings['gzip'] and os.path.isfile(path) \
+            and os.path.isfile(compressed) \
+            and os.path.getmtime(compressed) >= os.path.getmtime(path):
+        response = send_file(
+            compressed,
+            mimetype=mimetypes.guess_type(path)[0],
+            conditional=True,
+        )
+        response.content_encoding = 'gzip'
+    else:
+        response = app.send_static_file(filename)
+    response.vary.add('Accept-Encoding')
+    if request.args.get('v') and request.args['v'] == static_hash(filename):
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.expires = None
+    return response
+
+
+app.view_functions['static'] = send_static_file
@@ -3,8 +3,35 @@
 Flask app initialization.
 """
 import os.path
-from flask import Flask
+import time
+from flask import Flask, g, request
 from flask.ext.mako import MakoTemplates
+from presence_analyzer import metrics
+from presence_analyzer.profiling import ProfilerMiddleware
 
 app = Flask(__name__)  # pylint: disable-msg=C0103
 mako = MakoTemplates(app)  # pylint: disable-msg=C0103
+app.wsgi_app = ProfilerMiddleware(app, app.wsgi_app)
+
+
+@app.before_request
+def start_timer():
+    """
+    Remembers when handling of the request started.
+    """
+    g.request_started = time.time()
+
+
+@app.after_request
+def record_request(response):
+    """
+    Records latency and status of the request in metrics.
+
+    Bodies streamed after returning from the view are not included.
+    """
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.time() - started, endpoint)
+        metrics.REQUESTS.inc(endpoint, response.status_code)
+    return response
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal Prometheus instrumentation, exposed at /metrics.
+"""
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+REGISTRY = []
+COLLECTORS = []
+
+
+def format_labels(names, values, extra=()):
+    """
+    Formats label names and values as {name="value",...}.
+    """
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (
+            name,
+            str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'),
+        )
+        for name, value in pairs
+    )
+
+
+class Metric(object):
+    """
+    Metric with values kept per combination of label values.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def header(self):
+        """
+        Returns HELP and TYPE lines.
+        """
+        return [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+
+    def samples(self):
+        """
+        Returns sample lines of all label combinations.
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+        return [
+            '{}{} {!r}'.format(self.name, format_labels(self.labels, key),
+                               float(value))
+            for key, value in values
+        ]
+
+    def render(self):
+        """
+        Returns the metric in text exposition format.
+        """
+        return self.header() + self.samples()
+
+
+class Counter(Metric):
+    """
+    Value which only goes up.
+    """
+    kind = 'counter'
+
+    def inc(self, *labels, **kwargs):
+        """
+        Increments value of given labels by ``amount``, 1 by default.
+        """
+        with self.lock:
+            self.values[labels] = (
+                self.values.get(labels, 0) + kwargs.get('amount', 1)
+            )
+
+
+class Gauge(Metric):
+    """
+    Value which is set to the last measurement.
+    """
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        """
+        Sets value of given labels.
+        """
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observations over fixed buckets.
+    """
+    kind = 'histogram'
+    buckets = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+        2.5, 5.0, 10.0,
+    )
+
+    def __init__(self, name, documentation, labels=(), buckets=None):
+        super(Histogram, self).__init__(name, documentation, labels)
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """
+        Records a single observation of given labels.
+        """
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # bucket counts, then count and sum of observations
+                counts = self.values[labels] = [0] * len(self.buckets) + [
+                    0, 0.0
+                ]
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        """
+        Returns cumulative buckets, count and sum of all label values.
+        """
+        with self.lock:
+            values = sorted(
+                (key, list(counts)) for key, counts in self.values.items()
+            )
+        lines = []
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    format_labels(self.labels, key, [('le', repr(bound))]),
+                    cumulative,
+                ))
+            lines.append('{}_bucket{} {}'.format(
+                self.name,
+                format_labels(self.labels, key, [('le', '+Inf')]),
+                counts[-2],
+            ))
+            lines.append('{}_count{} {}'.format(
+                self.name, format_labels(self.labels, key), counts[-2]
+            ))
+            lines.append('{}_sum{} {!r}'.format(
+                self.name, format_labels(self.labels, key), counts[-1]
+            ))
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    'presence_analyzer_request_seconds',
+    'Time spent handling requests, by endpoint.',
+    ['endpoint'],
+)
+REQUESTS = Counter(
+    'presence_analyzer_requests_total',
+    'Handled requests, by endpoint and status code.',
+    ['endpoint', 'status'],
+)
+LOAD_SECONDS = Histogram(
+    'presence_analyzer_load_seconds',
+    'Time spent loading data files, by loader.',
+    ['loader'],
+)
+LOADS = Counter(
+    'presence_analyzer_loads_total',
+    'Data file loads, by loader.',
+    ['loader'],
+)
+LOAD_ROWS = Gauge(
+    'presence_analyzer_load_rows',
+    'Rows held after the last load, by loader.',
+    ['loader'],
+)
+AVATARS = Counter(
+    'presence_analyzer_avatars_total',
+    'Avatar lookups, by result.',
+    ['result'],
+)
+
+
+def measured(loader, rows=len):
+    """
+    Records duration and resulting row count of decorated data loader.
+    """
+    def wrap(func):  # pylint: disable=C0111
+        @wraps(func)
+        def inner(*args, **kwargs):  # pylint: disable=C0111
+            started = time.time()
+            result = func(*args, **kwargs)
+            LOAD_SECONDS.observe(time.time() - started, loader)
+            LOADS.inc(loader)
+            LOAD_ROWS.set(rows(result), loader)
+            return result
+        return inner
+    return wrap
+
+
+def collector(func):
+    """
+    Registers function returning extra exposition lines on every scrape.
+    """
+    COLLECTORS.append(func)
+    return func
+
+
+def render():
+    """
+    Returns all metrics in Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for func in COLLECTORS:
+        lines.extend(func())
+    return '\n'.join(lines) + '\n'
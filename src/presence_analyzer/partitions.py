@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data split into partition files, e.g. one CSV per month.
+"""
+import calendar
+import glob
+import os
+import re
+from array import array
+from collections import Mapping
+from datetime import date
+from itertools import izip
+
+from presence_analyzer import sketch
+from presence_analyzer.store import GENERATIONS, PresenceStore
+from presence_analyzer.store import occupancy, weekday_quantiles
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+MONTH = re.compile(r'(\d{4})-(\d{2})')
+DAY = re.compile(r'(\d{4}-\d{2})-\d{2}$')
+
+
+def partition_paths(source):
+    """
+    Returns sorted paths of partition files when DATA_CSV ``source`` is
+    a directory, holding ``*.csv`` partitions, or a glob pattern.
+
+    Returns None for a plain file.
+    """
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, '*.csv')))
+    if glob.has_magic(source):
+        return sorted(glob.glob(source))
+    return None
+
+
+def month_range(path):
+    """
+    Returns (first, last) day ordinals of the month partition file is
+    named after, like ``2013-09.csv``, None when it's named otherwise.
+    """
+    match = MONTH.search(os.path.basename(path))
+    if match is None:
+        return None
+    year, month = int(match.group(1)), int(match.group(2))
+    if not (1 <= year and 1 <= month <= 12):
+        return None
+    return (
+        date(year, month, 1).toordinal(),
+        date(year, month, calendar.monthrange(year, month)[1]).toordinal(),
+    )
+
+
+def split_csv(path, directory):
+    """
+    Splits CSV file into ``YYYY-MM.csv`` partitions of every month in
+    given directory, replacing existing ones. Lines are copied as they
+    are, in order; lines without a date are dropped.
+
+    Returns paths of written partitions.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    partitions = {}
+    try:
+        with open(path, 'rb') as csvfile:
+            for line in csvfile:
+                fields = line.split(',', 3)
+                match = DAY.match(fields[1]) if len(fields) == 4 else None
+                if match is None:
+                    continue
+                partition = partitions.get(match.group(1))
+                if partition is None:
+                    partition = partitions[match.group(1)] = open(
+                        os.path.join(
+                            directory, '{}.csv.tmp'.format(match.group(1))
+                        ),
+                        'wb',
+                    )
+                partition.write(line if line.endswith('\n') else line + '\n')
+    finally:
+        for partition in partitions.itervalues():
+            partition.close()
+    written = []
+    for partition in sorted(partitions.itervalues(), key=lambda f: f.name):
+        os.rename(partition.name, partition.name[:-len('.tmp')])
+        written.append(partition.name[:-len('.tmp')])
+    return written
+
+
+def add_stats(first, second):
+    """
+    Adds up two lists of weekday sums, see PresenceStore.weekday_stats.
+    """
+    return [tuple(a + b for a, b in izip(x, y))
+            for x, y in izip(first, second)]
+
+
+class PartitionedStore(Mapping):
+    """
+    Presence entries of partition files, each loaded when first needed.
+
+    ``load(path)`` returns PresenceStore of the partition at ``path``.
+    Files named after a month, see ``month_range``, are expected to
+    hold entries of that month only, as written by ``split_csv``, so
+    statistics of a range of days load and read only partitions
+    overlapping the range. Other files are always read. Entries of the
+    same user and day in different partitions all count.
+
+    Users are looked for in loaded partitions first, then in the newest
+    ones, so a request about a known user rarely loads more than it
+    needs. Statistics of a range of days are zeros for users without
+    entries in it, views don't look the user up then. Listing all users
+    loads every partition.
+    """
+    has_ranges = True
+
+    def __init__(self, paths, load):
+        self.paths = paths
+        self.ranges = [month_range(path) for path in paths]
+        self.load = load
+        self.stores = [None] * len(paths)
+        self.generation = next(GENERATIONS)
+        self._users = None
+
+    def partition(self, i):
+        """
+        Returns PresenceStore of the i-th partition, loading it if needed.
+        """
+        store = self.stores[i]
+        if store is None:
+            log.debug('Loading partition %s', self.paths[i])
+            store = self.stores[i] = self.load(self.paths[i])
+        return store
+
+    def load_all(self):
+        """
+        Loads every partition not loaded yet.
+        """
+        for i in xrange(len(self.paths)):
+            self.partition(i)
+
+    def overlapping(self, first_day=None, last_day=None):
+        """
+        Yields stores of partitions which may hold days in given range.
+        """
+        first_day = first_day or 1
+        last_day = last_day or date.max.toordinal()
+        for i, days_range in enumerate(self.ranges):
+            if days_range is None or (
+                    days_range[0] <= last_day and first_day <= days_range[1]):
+                yield self.partition(i)
+
+    def holding(self, user_id, first_day=None, last_day=None):
+        """
+        Returns stores of partitions in given range with entries of user.
+        """
+        return [store for store in self.overlapping(first_day, last_day)
+                if user_id in store]
+
+    @property
+    def users(self):
+        """
+        Sorted ids of users of all partitions.
+        """
+        if self._users is None:
+            self._users = array('i', sorted(set().union(*[
+                self.partition(i).users for i in xrange(len(self.paths))
+            ])))
+        return self._users
+
+    @property
+    def rows_count(self):
+        """
+        Number of entries in partitions loaded so far.
+        """
+        return sum(store.rows_count for store in self.stores if store)
+
+    def __len__(self):
+        return len(self.users)
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __contains__(self, user_id):
+        order = sorted(
+            xrange(len(self.paths)),
+            key=lambda i: (self.stores[i] is None, -i),
+        )
+        return any(user_id in self.partition(i) for i in order)
+
+    def __getitem__(self, user_id):
+        stores = self.holding(user_id)
+        if not stores:
+            raise KeyError(user_id)
+        return PresenceStore.from_rows(
+            (user_id, day, start, end)
+            for store in stores
+            for day, start, end in store[user_id].rows()
+        )[user_id]
+
+    def weekday_stats(self, user_id):
+        """
+        Returns (count, total, start, end) sums for every weekday of user.
+        """
+        return reduce(add_stats, [
+            store.weekday_stats(user_id) for store in self.holding(user_id)
+        ], [(0, 0, 0, 0)] * 7)
+
+    def range_stats(self, user_id, first_day, last_day):
+        """
+        Same as ``weekday_stats``, limited to days between ``first_day``
+        and ``last_day`` ordinals inclusive. Zeros for unknown users.
+        """
+        return reduce(add_stats, [
+            store.range_stats(user_id, first_day, last_day)
+            for store in self.holding(user_id, first_day, last_day)
+        ], [(0, 0, 0, 0)] * 7)
+
+    def quantile_stats(self, user_id, quantiles):
+        """
+        Returns ``{'presence': [...], 'start': [...], 'end': [...]}``
+        estimates of given quantiles for every weekday of user, from
+        sketches of all partitions merged.
+        """
+        parts = [(store.quantiles, store.index[user_id])
+                 for store in self.holding(user_id)]
+        return weekday_quantiles(
+            lambda day_of_week, metric: sketch.merge([
+                index.sketch(position, day_of_week, metric)
+                for index, position in parts
+            ]),
+            quantiles,
+        )
+
+    def occupancy(self, first_day=None, last_day=None):
+        """
+        Returns mean number of people present at every minute of every
+        weekday, see ``occupancy``.
+        """
+        days, starts, ends = array('i'), array('i'), array('i')
+        for store in self.overlapping(first_day, last_day):
+            days.extend(store.days)
+            starts.extend(store.starts)
+            ends.extend(store.ends)
+        return occupancy(days, starts, ends, first_day, last_day)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Prefork server sharing presence data loaded once with its workers.
+
+The master process loads the data and forks worker processes, which
+serve requests from the listening socket they inherit, one at a time
+each. PresenceStore keeps all entries in a few flat typed arrays, which
+the garbage collector doesn't track, so reference counting in workers
+touches only the array headers and the pages holding the entries stay
+shared copy-on-write.
+
+Workers never reload the data themselves. The master watches DATA_CSV
+instead and, when it changes, loads it again and replaces all workers
+with ones forked off the new data. SIGHUP forces the same.
+
+Partitioned data, see ``partitions``, is loaded on demand otherwise,
+which would leave every worker loading partitions into memory of its
+own. The master loads all partitions before forking instead.
+"""
+import errno
+import gc
+import os
+import signal
+import socket
+import time
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from presence_analyzer import database, utils
+from presence_analyzer.main import app
+from presence_analyzer.partitions import PartitionedStore
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
+
+LISTEN_BACKLOG = 128
+ACCEPT_TIMEOUT = 1
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    Request handler which, like Paste's server, doesn't log requests.
+    """
+
+    def log_request(self, *args, **kwargs):
+        """
+        Skips logging of successful requests.
+        """
+
+
+def load_data():
+    """
+    Loads presence data, all partitions of it, into the cache and keeps
+    this process and its forks from reloading it on their own.
+    """
+    utils.CACHE.pop('cache', None)
+    utils.CACHE_FROZEN.add('cache')
+    data = utils.get_data()
+    if isinstance(data, PartitionedStore):
+        data.load_all()
+    # don't leave garbage for every worker to collect separately
+    gc.collect()
+
+
+def data_changed():
+    """
+    Checks whether DATA_CSV changed since the data was loaded.
+    """
+    entry = utils.CACHE.get('cache')
+    return entry is None or \
+        entry.source != utils.file_signature(app.config['DATA_CSV'])
+
+
+class PreforkServer(object):
+    """
+    Master process of the prefork server.
+
+    Binds the listening socket on creation, ``serve_forever`` loads the
+    data, forks ``workers`` processes and watches them and the data
+    every ``interval`` seconds until SIGTERM or SIGINT.
+    """
+
+    def __init__(self, wsgi_app, host, port, workers, interval=1.0):
+        self.wsgi_app = wsgi_app
+        self.workers = workers
+        self.interval = interval
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(LISTEN_BACKLOG)
+        self.host, self.port = self.listener.getsockname()[:2]
+        self.children = set()
+        self.running = False
+        self.reload_requested = False
+
+    def serve_forever(self):
+        """
+        Runs the master loop.
+        """
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        self.running = True
+        log.info('Serving on http://%s:%d with %d workers',
+                 self.host, self.port, self.workers)
+        try:
+            self.reload()
+            while self.running:
+                time.sleep(self.interval)
+                self.reap()
+                if self.reload_requested or data_changed():
+                    self.reload_requested = False
+                    self.reload()
+        finally:
+            self.stop(self.children)
+            self.children = set()
+            self.listener.close()
+
+    def handle_stop(self, signum, frame):  # pylint: disable=W0613
+        """
+        Stops the master loop.
+        """
+        self.running = False
+
+    def handle_reload(self, signum, frame):  # pylint: disable=W0613
+        """
+        Reloads data and workers with the next check.
+        """
+        self.reload_requested = True
+
+    def reload(self):
+        """
+        Loads the data and replaces running workers with fresh forks.
+
+        New workers start accepting requests before the old ones finish
+        theirs, so no request is refused meanwhile.
+        """
+        started = time.time()
+        load_data()
+        log.info('Presence data loaded in %.2f s', time.time() - started)
+        previous = self.children
+        self.children = set(self.fork() for _ in xrange(self.workers))
+        self.stop(previous)
+
+    def reap(self):
+        """
+        Replaces workers which exited on their own.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno != errno.ECHILD:
+                    raise
+                return
+            if not pid:
+                return
+            if pid in self.children:
+                log.warning('Worker %d exited with status %d', pid, status)
+                self.children.discard(pid)
+                self.children.add(self.fork())
+
+    def stop(self, pids):
+        """
+        Asks given workers to finish and waits for them.
+        """
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as error:
+                if error.errno != errno.ESRCH:
+                    raise
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError as error:
+                if error.errno != errno.ECHILD:
+                    raise
+
+    def fork(self):
+        """
+        Starts a worker, returns its pid.
+        """
+        pid = os.fork()
+        if pid:
+            return pid
+        status = 0
+        try:
+            self.work()
+        except Exception:  # pylint: disable=W0703
+            log.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            # skip cleanup of objects shared with the master
+            os._exit(status)  # pylint: disable=W0212
+
+    def work(self):
+        """
+        Serves requests in a worker until SIGTERM.
+        """
+        stopping = []
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: stopping.append(signum))
+        # the master stops workers on Ctrl+C in a terminal
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        database.forget_connections()
+        server = BaseWSGIServer(
+            self.host, self.port, self.wsgi_app,
+            handler=RequestHandler, fd=self.listener.fileno(),
+        )
+        server.timeout = ACCEPT_TIMEOUT
+        while not stopping:
+            server.handle_request()
+
+
+def server_runner(wsgi_app, global_conf, host='0.0.0.0', port=8080,
+                  workers=4, interval=1):  # pylint: disable=W0613
+    """
+    Paste server runner, see ``[server:prefork]`` in deploy.ini.
+    """
+    PreforkServer(
+        wsgi_app, host, int(port), int(workers), float(interval)
+    ).serve_forever()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+On-demand profiling of requests.
+"""
+import cProfile
+import os
+import re
+import time
+from urlparse import parse_qs
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=C0103
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_PARAMETER = 'profile'
+
+SCRIPTED_REQUESTS = [
+    '/api/v1/users',
+    '/api/v1/mean_time_weekday/{user_id}',
+    '/api/v1/presence_weekday/{user_id}',
+    '/api/v1/presence_start_end/{user_id}',
+    '/api/v1/mean_time_weekday',
+    '/api/v1/presence_weekday',
+    '/api/v1/presence_start_end',
+]
+
+
+def stats_path(directory, environ):
+    """
+    Returns unique stats file name describing the request.
+    """
+    name = re.sub(
+        r'[^A-Za-z0-9]+', '_', environ.get('PATH_INFO', '')
+    ).strip('_')
+    return os.path.join(directory, '{}-{:.6f}-{}.prof'.format(
+        environ.get('REQUEST_METHOD', 'GET'), time.time(), name or 'root'
+    ))
+
+
+class ProfilerMiddleware(object):
+    """
+    Runs requests asking for it under cProfile.
+
+    Profiling has to be enabled with PROFILE_REQUESTS config, then a
+    request is profiled if it has ``X-Profile`` header or ``profile``
+    query parameter. Stats are written to PROFILE_DIR, to be inspected
+    with pstats or any of its viewers.
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+
+    def wanted(self, environ):
+        """
+        Tells whether given request is to be profiled.
+        """
+        if not self.app.config.get('PROFILE_REQUESTS'):
+            return False
+        return PROFILE_HEADER in environ or PROFILE_PARAMETER in parse_qs(
+            environ.get('QUERY_STRING', ''), keep_blank_values=True
+        )
+
+    def __call__(self, environ, start_response):
+        if not self.wanted(environ):
+            return self.wsgi_app(environ, start_response)
+
+        profile = cProfile.Profile()
+        body = []
+
+        def run():  # pylint: disable=C0111
+            app_iter = self.wsgi_app(environ, start_response)
+            try:
+                # streamed bodies are built while iterating
+                body.extend(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+
+        profile.runcall(run)
+        directory = self.app.config.get('PROFILE_DIR') or '.'
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = stats_path(directory, environ)
+        profile.dump_stats(path)
+        log.info('Profile of %s written to %s', environ.get('PATH_INFO'), path)
+        return body
+
+
+def profile_requests(app, urls, repeat=1):
+    """
+    Sends given requests to the app under a single profiler, returns it.
+
+    ``{user_id}`` in URLs is filled in with the first known user.
+    Presence data stays cached, serialized responses are dropped before
+    every round.
+    """
+    from presence_analyzer.utils import JSON_CACHE, get_data
+    client = app.test_client()
+    user_id = next(iter(get_data()), 0)
+    urls = [url.format(user_id=user_id) for url in urls]
+    profile = cProfile.Profile()
+    for _ in xrange(repeat):
+        # measure building the responses, not serving them from cache
+        JSON_CACHE.clear()
+        for url in urls:
+            response = profile.runcall(client.get, url)
+            profile.runcall(response.get_data)
+            if response.status_code != 200:
+                log.warning('%s answered %s', url, response.status)
+    return profile
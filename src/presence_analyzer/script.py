@@ -30,6 +30,18 @@ def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
     from presence_analyzer import app
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    from presence_analyzer.helpers import compress_static
+    try:
+        compress_static()
+    except (IOError, OSError):
+        pass  # read-only installs serve static files uncompressed
+    from presence_analyzer.views import render_pages
+    with app.test_request_context():
+        render_pages()
+    interval = app.config.get('DATA_XML_REFRESH_INTERVAL')
+    if interval:
+        from presence_analyzer.utils import schedule_xml_update
+        schedule_xml_update(interval)
     return app
 
 
@@ -50,8 +62,8 @@ def make_shell():
     return locals()
 
 
-def _serve(action, debug=False, dry_run=False):
-    """Build paster command from 'action' and 'debug' flag."""
+def _serve(action, debug=False, dry_run=False, prefork=False):
+    """Build paster command from 'action', 'debug' and 'prefork' flags."""
     if debug:
         config = DEBUG_INI
     else:
@@ -63,6 +75,8 @@ def _serve(action, debug=False, dry_run=False):
         argv += ['--reload']
     else:
         argv += [action]
+    if prefork:
+        argv += ['--server-name', 'prefork']
     # Print the 'paster' command
     print ' '.join(argv)
     if dry_run:
@@ -83,7 +97,7 @@ def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
     # bin/flask-ctl serve [fg|start|stop|restart|status]
-    def action_serve(action=('a', 'start'), dry_run=False):
+    def action_serve(action=('a', 'start'), dry_run=False, prefork=False):
         """Serve the application.
 
         This command serves a web application that uses a paste.deploy
@@ -92,8 +106,10 @@ def run():
         Options:
          - 'action' is one of [fg|start|stop|restart|status]
          - '--dry-run' print the paster command and exit
+         - '--prefork' load data once and fork worker processes sharing
+           it, instead of serving from threads of a single process
         """
-        _serve(action, debug=False, dry_run=dry_run)
+        _serve(action, debug=False, dry_run=dry_run, prefork=prefork)
 
     # bin/flask-ctl debug [fg|start|stop|restart|status]
     def action_debug(action=('a', 'start'), dry_run=False):
@@ -110,6 +126,58 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl snapshot
+    def action_snapshot(config=('c', DEPLOY_CFG)):
+        """Build binary snapshot of parsed presence data.
+
+        Fresh processes load the snapshot instead of parsing the CSV.
+        """
+        make_app(config=config)
+        from presence_analyzer.utils import build_snapshot
+        print build_snapshot()
+
+    # bin/flask-ctl split
+    def action_split(config=('c', DEPLOY_CFG), directory=('d', '')):
+        """Split DATA_CSV into one partition file per month.
+
+        Partitions are written to given directory, by default the one
+        named like DATA_CSV without extension. Point DATA_CSV at the
+        directory afterwards, ranges of days then read only partitions
+        they overlap.
+        """
+        app = make_app(config=config)
+        from presence_analyzer.partitions import split_csv
+        path = app.config['DATA_CSV']
+        for partition in split_csv(
+                path, directory or os.path.splitext(path)[0]):
+            print partition
+
+    # bin/flask-ctl compress_static
+    def action_compress_static():
+        """Write gzipped copies of static files served to browsers."""
+        from presence_analyzer.helpers import compress_static
+        for path in compress_static():
+            print path
+
+    # bin/flask-ctl profile
+    def action_profile(config=('c', DEPLOY_CFG), repeat=('r', 10),
+                       sort=('s', 'cumulative'), limit=('l', 30)):
+        """Profile a scripted set of API requests.
+
+        Prints the hottest functions and writes full stats to
+        var/log/profile.prof, for pstats or any of its viewers.
+        """
+        import pstats
+        from presence_analyzer.profiling import (
+            SCRIPTED_REQUESTS, profile_requests
+        )
+        app = make_app(config=config)
+        profile = profile_requests(app, SCRIPTED_REQUESTS, repeat)
+        path = abspath('var', 'log', 'profile.prof')
+        profile.dump_stats(path)
+        pstats.Stats(profile).sort_stats(sort).print_stats(limit)
+        print 'Stats written to', path
+
     werkzeug.script.run()
 
 
@@ -117,5 +185,6 @@ def lets_update_xml():
     """
     Start function to update_xml
     """
-    from utils import update_data_from_xml
+    make_app()
+    from presence_analyzer.utils import update_data_from_xml
     update_data_from_xml()
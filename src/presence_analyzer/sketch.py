@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketches with relative error guarantee.
+
+A sketch counts whole numbers, like seconds, in logarithmic buckets:
+value ``x > 0`` falls into bucket ``ceil(log(x) / log(GAMMA))``, where
+``GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)``, zero,
+e.g. presence ending when it started, into bucket ZERO_KEY of its own
+and ``x < 0``, e.g. a broken entry ending before its start, into the
+bucket of ``-x`` mirrored below ZERO_KEY. Every bucket is represented
+by the value within RELATIVE_ACCURACY of all values it holds, zero by
+zero itself, so the ``q``-quantile estimate differs from the exact
+one, i.e. the value of rank ``floor(q * (n - 1))`` among sorted values,
+by at most RELATIVE_ACCURACY of it. With 1% that's 36 s of 1 hour,
+~5 min of 8 h.
+
+Sketches are lists of (bucket key, count) pairs sorted by key. Number
+of buckets depends on the spread of values only, e.g. ~115 at most for
+presence between 1 and 10 hours, never on how many values were added.
+Sketches of parts of data merge into the sketch of all of it exactly,
+and a value can be taken out again by decrementing its bucket.
+"""
+from heapq import merge as merge_sorted
+from itertools import groupby
+from math import ceil, log
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = log(GAMMA)
+ZERO_KEY = -1
+
+
+def bucket(value):
+    """
+    Returns key of bucket holding given whole number, keys are ordered
+    like the values.
+    """
+    if value > 0:
+        return int(ceil(log(value) / LOG_GAMMA))
+    if value == 0:
+        return ZERO_KEY
+    return ZERO_KEY - 1 - bucket(-value)
+
+
+def estimate(key):
+    """
+    Returns value representing given bucket.
+    """
+    if key > ZERO_KEY:
+        return 2 * GAMMA ** key / (GAMMA + 1)
+    if key == ZERO_KEY:
+        return 0.0
+    return -estimate(ZERO_KEY - 1 - key)
+
+
+def sketch(values):
+    """
+    Returns sketch of given values.
+    """
+    # plain dict, Counter costs more than counting for a few values
+    counts = {}
+    for value in values:
+        key = bucket(value)
+        counts[key] = counts.get(key, 0) + 1
+    return sorted(counts.items())
+
+
+def merge(sketches):
+    """
+    Returns sketch of all values of given sketches.
+    """
+    return [
+        (key, sum(count for _, count in pairs))
+        for key, pairs in groupby(
+            merge_sorted(*sketches), key=lambda pair: pair[0]
+        )
+    ]
+
+
+def quantile(pairs, q):
+    """
+    Returns estimate of ``q``-quantile, 0 <= q <= 1, of sketched values.
+
+    Returns None for an empty sketch.
+    """
+    total = sum(count for _, count in pairs)
+    if not total:
+        return None
+    # tolerate float error, e.g. 0.57 * 100 == 56.99999999999999
+    rank = int(q * (total - 1) + 1e-9)
+    seen = 0
+    for key, count in pairs:
+        seen += count
+        if seen > rank:
+            return estimate(key)
@@ -0,0 +1,887 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, array-backed storage of presence data.
+"""
+import json
+import mmap
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Mapping
+from datetime import date, time
+from itertools import count, izip, repeat
+
+from presence_analyzer import sketch
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+GENERATIONS = count(1)
+SNAPSHOT_MAGIC = 'PRESENCE-SNAPSHOT'
+SNAPSHOT_VERSION = 4
+MINUTES = 24 * 60
+
+
+def weekday(day):
+    """
+    Returns weekday (Monday is 0) of given day ordinal.
+    """
+    return (day + 6) % 7
+
+
+def accumulate(totals, days, starts, ends):
+    """
+    Adds entries to flat per-weekday (count, total, start, end) sums.
+    """
+    for day, start, end in izip(days, starts, ends):
+        base = weekday(day) * 4
+        totals[base] += 1
+        totals[base + 1] += end - start
+        totals[base + 2] += start
+        totals[base + 3] += end
+    return totals
+
+
+def occupancy(days, starts, ends, first_day=None, last_day=None):
+    """
+    Returns mean number of people present at every minute of every
+    weekday, as 7 lists of MINUTES floats. Optionally only entries of
+    days between ``first_day`` and ``last_day`` ordinals inclusive count.
+
+    Entry counts from the minute of its start up to, without, the minute
+    of its end. Counts are divided by the number of distinct days of the
+    weekday which have any entries. Every entry adds one at its start
+    and subtracts one at its end in a difference array, which is then
+    summed up, so the cost is O(rows + minutes) instead of checking
+    every minute against every entry.
+    """
+    first_day = first_day or 1
+    last_day = last_day or date.max.toordinal()
+    if numpy is not None:
+        return occupancy_numpy(days, starts, ends, first_day, last_day)
+    stride = MINUTES + 1
+    diff = [0] * (7 * stride)
+    present_days = set()
+    for day, start, end in izip(days, starts, ends):
+        if not first_day <= day <= last_day:
+            continue
+        base = weekday(day) * stride
+        first = start // 60
+        diff[base + first] += 1
+        diff[base + max(first, min(end // 60, MINUTES))] -= 1
+        present_days.add(day)
+    days_count = [0] * 7
+    for day in present_days:
+        days_count[weekday(day)] += 1
+    result = []
+    for day in xrange(7):
+        present = 0
+        curve = []
+        for change in diff[day * stride:day * stride + MINUTES]:
+            present += change
+            curve.append(present / float(days_count[day] or 1))
+        result.append(curve)
+    return result
+
+
+def as_numpy(column):
+    """
+    Returns NumPy view of given array.
+    """
+    if not len(column):
+        return numpy.zeros(0, dtype=column.typecode)
+    return numpy.frombuffer(column, dtype=column.typecode)
+
+
+def occupancy_numpy(days, starts, ends, first_day, last_day):
+    """
+    Vectorized ``occupancy``.
+    """
+    stride = MINUTES + 1
+    days, starts, ends = as_numpy(days), as_numpy(starts), as_numpy(ends)
+    selected = (days >= first_day) & (days <= last_day)
+    days = days[selected]
+    starts = starts[selected] // 60
+    ends = numpy.maximum(
+        starts, numpy.minimum(ends[selected] // 60, MINUTES)
+    )
+    bases = (days + 6) % 7 * stride
+    diff = (
+        numpy.bincount(bases + starts, minlength=7 * stride) -
+        numpy.bincount(bases + ends, minlength=7 * stride)
+    )
+    present = numpy.cumsum(diff.reshape(7, stride), axis=1)[:, :MINUTES]
+    days_count = numpy.bincount((numpy.unique(days) + 6) % 7, minlength=7)
+    return (present / numpy.maximum(days_count, 1)[:, None].astype(float)) \
+        .tolist()
+
+
+def weekday_quantiles(sketch_of, quantiles):
+    """
+    Returns ``{metric: [estimate of every quantile]}`` for every weekday,
+    0 when there's no entry. ``sketch_of(day_of_week, metric)`` returns
+    the sketch of metric at given index of ``QuantileIndex.metrics``.
+    """
+    return [
+        {
+            name: [
+                sketch.quantile(sketch_of(day_of_week, metric), q) or 0
+                for q in quantiles
+            ]
+            for metric, name in enumerate(QuantileIndex.metrics)
+        }
+        for day_of_week in xrange(7)
+    ]
+
+
+def shifted(column, base):
+    """
+    Returns array with ``base`` added to every item of given one.
+    """
+    if not base:
+        return column
+    return array(column.typecode, [value + base for value in column])
+
+
+def seconds_to_time(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time object.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class UserPresence(Mapping):
+    """
+    Read-only view of presence entries of a single user.
+
+    Behaves like a mapping of ``datetime.date`` to
+    ``{'start': datetime.time, 'end': datetime.time}``, but nothing is
+    materialized until asked for. Use ``rows()`` to iterate over raw
+    ``(day ordinal, start seconds, end seconds)`` tuples instead.
+    """
+
+    def __init__(self, store, begin, end):
+        self.store = store
+        self.begin = begin
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.begin
+
+    def __iter__(self):
+        for day in self.store.days[self.begin:self.end]:
+            yield date.fromordinal(day)
+
+    def __getitem__(self, key):
+        days = self.store.days
+        if not isinstance(key, date):
+            raise KeyError(key)
+        day = key.toordinal()
+        position = bisect_left(days, day, self.begin, self.end)
+        if position == self.end or days[position] != day:
+            raise KeyError(key)
+        return {
+            'start': seconds_to_time(self.store.starts[position]),
+            'end': seconds_to_time(self.store.ends[position]),
+        }
+
+    def rows(self):
+        """
+        Iterates over (day ordinal, start seconds, end seconds) tuples.
+        """
+        store = self.store
+        return izip(
+            store.days[self.begin:self.end],
+            store.starts[self.begin:self.end],
+            store.ends[self.begin:self.end],
+        )
+
+
+class WeekdayIndex(object):
+    """
+    Presence entries of every user grouped by weekday, with running sums.
+
+    Group of weekday ``w`` of the user at position ``p`` spans
+    ``offsets[p * 7 + w]:offsets[p * 7 + w + 1]`` of ``days``, sorted,
+    and of ``totals``, ``starts`` and ``ends``, which hold sums of
+    intervals, starts and ends of the group up to and including given
+    entry. Sums over any range of days come down to two binary searches
+    and a subtraction per weekday.
+
+    Sums are 32-bit: a day adds at most 86400 seconds to each of them,
+    so a group overflows only after 24855 entries, i.e. 477 years.
+    """
+
+    columns = ('offsets', 'days', 'totals', 'starts', 'ends')
+
+    def __init__(self):
+        self.offsets = array('l', [0])
+        self.days = array('i')
+        self.totals = array('i')
+        self.starts = array('i')
+        self.ends = array('i')
+
+    def add_user(self, sources, days, starts, ends):
+        """
+        Appends groups of the next user.
+
+        Groups of the user at ``position`` of every ``(index, position)``
+        in ``sources`` are concatenated first, followed by given entries.
+        Each part has to be later than the ones before it.
+        """
+        groups = [[] for _ in xrange(7)]
+        for entry in izip(days, starts, ends):
+            groups[weekday(entry[0])].append(entry)
+        for day_of_week, group in enumerate(groups):
+            total = start_sum = end_sum = 0
+            for source, position in sources:
+                begin = source.offsets[position * 7 + day_of_week]
+                end = source.offsets[position * 7 + day_of_week + 1]
+                if begin == end:
+                    continue
+                self.days.extend(source.days[begin:end])
+                self.totals.extend(shifted(source.totals[begin:end], total))
+                self.starts.extend(
+                    shifted(source.starts[begin:end], start_sum)
+                )
+                self.ends.extend(shifted(source.ends[begin:end], end_sum))
+                total = self.totals[-1]
+                start_sum = self.starts[-1]
+                end_sum = self.ends[-1]
+            for day, start, end in group:
+                total += end - start
+                start_sum += start
+                end_sum += end
+                self.days.append(day)
+                self.totals.append(total)
+                self.starts.append(start_sum)
+                self.ends.append(end_sum)
+            self.offsets.append(len(self.days))
+
+    def stats(self, position, first_day, last_day):
+        """
+        Returns (count, total, start, end) sums for every weekday of the
+        user at given position, limited to days between ``first_day``
+        and ``last_day`` inclusive, none when ``first_day`` is later.
+        """
+        result = []
+        for day_of_week in xrange(7):
+            begin = self.offsets[position * 7 + day_of_week]
+            end = self.offsets[position * 7 + day_of_week + 1]
+            low = bisect_left(self.days, first_day, begin, end)
+            high = bisect_right(self.days, last_day, begin, end)
+            if low >= high:
+                result.append((0, 0, 0, 0))
+                continue
+            sums = [
+                column[high - 1] - (column[low - 1] if low > begin else 0)
+                for column in (self.totals, self.starts, self.ends)
+            ]
+            result.append((high - low, sums[0], sums[1], sums[2]))
+        return result
+
+
+class QuantileIndex(object):
+    """
+    Quantile sketches of presence length, start and end of every user
+    and weekday, see ``sketch`` module.
+
+    Sketch of ``metrics[m]`` of weekday ``w`` of the user at position
+    ``p`` spans ``offsets[(p * 7 + w) * 3 + m]:offsets[... + 1]`` of
+    ``keys`` and ``counts``.
+    """
+
+    columns = ('offsets', 'keys', 'counts')
+    metrics = ('presence', 'start', 'end')
+
+    def __init__(self):
+        self.offsets = array('l', [0])
+        self.keys = array('h')
+        self.counts = array('i')
+
+    def add_user(self, sources, days, starts, ends):
+        """
+        Appends sketches of the next user.
+
+        Sketches of the user at ``position`` of every ``(index,
+        position)`` in ``sources`` are merged with given entries.
+        """
+        values = [([], [], []) for _ in xrange(7)]
+        for day, start, end in izip(days, starts, ends):
+            lengths, day_starts, day_ends = values[weekday(day)]
+            lengths.append(end - start)
+            day_starts.append(start)
+            day_ends.append(end)
+        for day_of_week in xrange(7):
+            for metric in xrange(len(self.metrics)):
+                pairs = sketch.sketch(values[day_of_week][metric])
+                if sources:
+                    pairs = sketch.merge([
+                        source.sketch(position, day_of_week, metric)
+                        for source, position in sources
+                    ] + [pairs])
+                self.keys.extend(key for key, _ in pairs)
+                self.counts.extend(count for _, count in pairs)
+                self.offsets.append(len(self.keys))
+
+    def sketch(self, position, day_of_week, metric):
+        """
+        Returns sketch of given metric of the user at given position.
+        """
+        slot = (position * 7 + day_of_week) * len(self.metrics) + metric
+        begin = self.offsets[slot]
+        end = self.offsets[slot + 1]
+        return zip(self.keys[begin:end], self.counts[begin:end])
+
+    def stats(self, position, quantiles):
+        """
+        Returns estimates of given quantiles for every weekday of the
+        user at given position, see ``weekday_quantiles``.
+        """
+        return weekday_quantiles(
+            lambda day_of_week, metric: self.sketch(
+                position, day_of_week, metric
+            ),
+            quantiles,
+        )
+
+
+class PresenceStore(Mapping):
+    """
+    Presence entries of all users kept in parallel typed arrays.
+
+    Rows are sorted by user_id and day. ``users`` holds sorted, unique
+    user ids and rows of ``users[i]`` live in
+    ``offsets[i]:offsets[i + 1]`` of ``user_ids``, ``days`` (date
+    ordinals), ``starts`` and ``ends`` (seconds since midnight).
+
+    Every store gets a new ``generation`` number, so anything derived
+    from it can tell when data was reloaded.
+
+    ``aggregates`` holds, for every user and weekday, number of entries
+    and sums of intervals, starts and ends, computed while loading. See
+    ``weekday_stats``. ``by_weekday`` is a ``WeekdayIndex`` answering
+    the same for any range of days, see ``range_stats``. ``quantiles``
+    is a ``QuantileIndex`` estimating percentiles, see
+    ``quantile_stats``.
+
+    Indexing with a user id returns a ``UserPresence`` view.
+    """
+    stride = 7 * 4
+    has_ranges = True
+    columns = (
+        'users', 'offsets', 'user_ids', 'days', 'starts', 'ends',
+        'aggregates',
+    )
+
+    def __init__(self, users, offsets, user_ids, days, starts, ends,
+                 aggregates, by_weekday, quantiles):
+        self.users = users
+        self.offsets = offsets
+        self.user_ids = user_ids
+        self.days = days
+        self.starts = starts
+        self.ends = ends
+        self.aggregates = aggregates
+        self.by_weekday = by_weekday
+        self.quantiles = quantiles
+        self.generation = next(GENERATIONS)
+        self.index = {user_id: i for i, user_id in enumerate(users)}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds store from (user_id, day ordinal, start, end) tuples.
+
+        Later rows win over earlier ones for the same user and day.
+        """
+        entries = {}
+        for user_id, day, start, end in rows:
+            entries.setdefault(user_id, {})[day] = (start, end)
+        return cls.from_entries(entries)
+
+    @classmethod
+    def from_entries(cls, entries):
+        """
+        Builds store from ``{user_id: {day ordinal: (start, end)}}``.
+        """
+        users = array('i', sorted(entries))
+        offsets = array('l', [0])
+        user_ids = array('i')
+        days = array('i')
+        starts = array('i')
+        ends = array('i')
+        aggregates = array('l')
+        by_weekday = WeekdayIndex()
+        quantiles = QuantileIndex()
+        for user_id in users:
+            user_entries = entries[user_id]
+            user_days = sorted(user_entries)
+            user_starts = [user_entries[day][0] for day in user_days]
+            user_ends = [user_entries[day][1] for day in user_days]
+            user_ids.extend(repeat(user_id, len(user_days)))
+            days.extend(user_days)
+            starts.extend(user_starts)
+            ends.extend(user_ends)
+            offsets.append(len(days))
+            aggregates.extend(accumulate(
+                [0] * cls.stride, user_days, user_starts, user_ends
+            ))
+            by_weekday.add_user([], user_days, user_starts, user_ends)
+            quantiles.add_user([], user_days, user_starts, user_ends)
+        return cls(
+            users, offsets, user_ids, days, starts, ends, aggregates,
+            by_weekday, quantiles
+        )
+
+    @classmethod
+    def from_columns(cls, columns):
+        """
+        Builds store from arrays returned by ``to_columns``.
+        """
+        by_weekday = WeekdayIndex()
+        for name in WeekdayIndex.columns:
+            setattr(by_weekday, name, columns['by_weekday.' + name])
+        quantiles = QuantileIndex()
+        for name in QuantileIndex.columns:
+            setattr(quantiles, name, columns['quantiles.' + name])
+        return cls(*[columns[name] for name in cls.columns] + [
+            by_weekday, quantiles
+        ])
+
+    def to_columns(self):
+        """
+        Returns list of (name, array) pairs holding all data of store.
+        """
+        return [(name, getattr(self, name)) for name in self.columns] + [
+            ('by_weekday.' + name, getattr(self.by_weekday, name))
+            for name in WeekdayIndex.columns
+        ] + [
+            ('quantiles.' + name, getattr(self.quantiles, name))
+            for name in QuantileIndex.columns
+        ]
+
+    @classmethod
+    def combine(cls, stores):
+        """
+        Builds store out of stores holding consecutive parts of the data.
+
+        Later stores win over earlier ones for the same user and day.
+        When parts of a user don't overlap, which is the case for an
+        appended file or a file split into ranges, they are concatenated
+        slice by slice; otherwise entries of the user are rebuilt.
+        """
+        users = array('i', sorted(set().union(*[
+            store.users for store in stores
+        ])))
+        offsets = array('l', [0])
+        user_ids = array('i')
+        days = array('i')
+        starts = array('i')
+        ends = array('i')
+        aggregates = array('l')
+        by_weekday = WeekdayIndex()
+        quantiles = QuantileIndex()
+        for user_id in users:
+            parts = []
+            for store in stores:
+                if user_id in store.index:
+                    position = store.index[user_id]
+                    parts.append((
+                        store,
+                        position,
+                        store.offsets[position],
+                        store.offsets[position + 1],
+                    ))
+            ordered = all(
+                previous.days[previous_end - 1] < following.days[begin]
+                for (previous, _, _, previous_end), (following, _, begin, _)
+                in izip(parts, parts[1:])
+            )
+            if ordered:
+                totals = [0] * cls.stride
+                for store, position, begin, end in parts:
+                    days.extend(store.days[begin:end])
+                    starts.extend(store.starts[begin:end])
+                    ends.extend(store.ends[begin:end])
+                    totals = [total + value for total, value in izip(
+                        totals,
+                        store.aggregates[
+                            position * cls.stride:(position + 1) * cls.stride
+                        ],
+                    )]
+                by_weekday.add_user(
+                    [(store.by_weekday, position)
+                     for store, position, _, _ in parts],
+                    [], [], []
+                )
+                quantiles.add_user(
+                    [(store.quantiles, position)
+                     for store, position, _, _ in parts],
+                    [], [], []
+                )
+            else:
+                user_entries = {}
+                for store, position, begin, end in parts:
+                    user_entries.update(izip(
+                        store.days[begin:end],
+                        izip(store.starts[begin:end], store.ends[begin:end]),
+                    ))
+                user_days = sorted(user_entries)
+                user_starts = [user_entries[day][0] for day in user_days]
+                user_ends = [user_entries[day][1] for day in user_days]
+                days.extend(user_days)
+                starts.extend(user_starts)
+                ends.extend(user_ends)
+                totals = accumulate(
+                    [0] * cls.stride, user_days, user_starts, user_ends
+                )
+                by_weekday.add_user([], user_days, user_starts, user_ends)
+                quantiles.add_user([], user_days, user_starts, user_ends)
+            user_ids.extend(repeat(user_id, len(days) - offsets[-1]))
+            offsets.append(len(days))
+            aggregates.extend(totals)
+        return cls(
+            users, offsets, user_ids, days, starts, ends, aggregates,
+            by_weekday, quantiles
+        )
+
+    @classmethod
+    def concatenate(cls, stores):
+        """
+        Builds store out of stores holding ascending, disjoint ranges of
+        users, e.g. built in parallel.
+
+        Arrays are simply concatenated, only offsets of every user are
+        shifted by the length of the columns before them.
+        """
+        indexed = {
+            'offsets': 'days',
+            'by_weekday.offsets': 'by_weekday.days',
+            'quantiles.offsets': 'quantiles.keys',
+        }
+        columns = dict(cls.from_entries({}).to_columns())
+        for store in stores:
+            bases = {
+                name: len(columns[target])
+                for name, target in indexed.iteritems()
+            }
+            for name, column in store.to_columns():
+                if name in indexed:
+                    column = shifted(column[1:], bases[name])
+                columns[name].extend(column)
+        return cls.from_columns(columns)
+
+    def merge(self, rows):
+        """
+        Returns new store with (user_id, day ordinal, start, end) tuples
+        added on top of this one.
+
+        Rows of users without new entries are copied slice by slice, and
+        entries appended after the last known day of a user are simply
+        concatenated, so the Python level work is proportional to the
+        number of users and new rows.
+        """
+        added = self.from_rows(rows)
+        if not added:
+            return self
+        return self.combine([self, added])
+
+    def __len__(self):
+        return len(self.users)
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    def __getitem__(self, user_id):
+        position = self.index[user_id]
+        return UserPresence(
+            self,
+            self.offsets[position],
+            self.offsets[position + 1],
+        )
+
+    def weekday_stats(self, user_id):
+        """
+        Returns (count, total, start, end) sums for every weekday of user.
+
+        ``total`` is the sum of presence intervals, ``start`` and ``end``
+        are sums of seconds since midnight.
+        """
+        position = self.index[user_id] * self.stride
+        totals = self.aggregates[position:position + self.stride]
+        return [tuple(totals[i:i + 4]) for i in xrange(0, self.stride, 4)]
+
+    def range_stats(self, user_id, first_day, last_day):
+        """
+        Same as ``weekday_stats``, limited to days between ``first_day``
+        and ``last_day`` ordinals inclusive. Zeros for unknown users.
+        """
+        position = self.index.get(user_id)
+        if position is None:
+            return [(0, 0, 0, 0)] * 7
+        return self.by_weekday.stats(position, first_day, last_day)
+
+    def quantile_stats(self, user_id, quantiles):
+        """
+        Returns ``{'presence': [...], 'start': [...], 'end': [...]}``
+        estimates of given quantiles for every weekday of user.
+        """
+        return self.quantiles.stats(self.index[user_id], quantiles)
+
+    @property
+    def rows_count(self):
+        """
+        Total number of presence entries.
+        """
+        return len(self.days)
+
+    def occupancy(self, first_day=None, last_day=None):
+        """
+        Returns mean number of people present at every minute of every
+        weekday, see ``occupancy``.
+        """
+        return occupancy(
+            self.days, self.starts, self.ends, first_day, last_day
+        )
+
+
+class RepeatedEntry(Exception):
+    """
+    Raised by AggregateStore for an entry of a day which the user has
+    entries after, as the values it replaces aren't known anymore.
+    """
+
+
+class DaySet(object):
+    """
+    Set of day ordinals kept as bitmaps of ``block`` days each, about
+    a hundred bytes per user and year.
+    """
+    block = 1024
+
+    def __init__(self, bitmaps=None):
+        self.bitmaps = dict(bitmaps or {})
+
+    def add(self, day):
+        """
+        Adds day, returns False when it was there already.
+        """
+        key, bit = divmod(day, self.block)
+        bitmap = self.bitmaps.get(key, 0)
+        if bitmap >> bit & 1:
+            return False
+        self.bitmaps[key] = bitmap | 1 << bit
+        return True
+
+    def copy(self):
+        """
+        Returns independent copy of the set.
+        """
+        return self.__class__(self.bitmaps)
+
+
+class AggregateStore(object):
+    """
+    Weekday aggregates of every user, without the entries themselves.
+
+    Built by streaming rows straight into per-user accumulators, so its
+    size depends on the number of users only. Answers ``weekday_stats``
+    like PresenceStore, but not ranges of days. Quantile sketches of
+    every user and weekday are kept as ``{bucket key: count}`` dicts in
+    ``sketches``, in QuantileIndex order.
+
+    Like in PresenceStore, later entries win over earlier ones for the
+    same user and day. The last entry of every user is kept, so an
+    entry repeating it replaces it. Days of every user are kept in a
+    DaySet, an entry repeating any other day raises RepeatedEntry; the
+    loader then rebuilds the store, see ``PresenceLoader``.
+    """
+    stride = PresenceStore.stride
+    has_ranges = False
+
+    def __init__(self, totals, last_entries, rows_count, sketches, days):
+        self.totals = totals
+        self.last_entries = last_entries
+        self.rows_count = rows_count
+        self.sketches = sketches
+        self.days = days
+        self.users = array('i', sorted(totals))
+        self.generation = next(GENERATIONS)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds store from (user_id, day ordinal, start, end) tuples.
+        """
+        return cls({}, {}, 0, {}, {}).merge(rows)
+
+    def merge(self, rows):
+        """
+        Returns new store with given rows added to the aggregates.
+        """
+        totals = {
+            user_id: user_totals[:]
+            for user_id, user_totals in self.totals.iteritems()
+        }
+        last_entries = dict(self.last_entries)
+        rows_count = self.rows_count
+        sketches = dict(self.sketches)
+        days = dict(self.days)
+        copied = set()
+        for user_id, day, start, end in rows:
+            user_totals = totals.get(user_id)
+            if user_totals is None:
+                user_totals = totals[user_id] = array('l', [0] * self.stride)
+            if user_id not in copied:
+                # sketches and days of other users are shared with this
+                # store
+                sketches[user_id] = [
+                    dict(buckets) for buckets in sketches.get(
+                        user_id, [{} for _ in xrange(7 * 3)]
+                    )
+                ]
+                days[user_id] = days.get(user_id, DaySet()).copy()
+                copied.add(user_id)
+            user_sketches = sketches[user_id]
+            base = weekday(day) * 4
+            last = last_entries.get(user_id)
+            if not days[user_id].add(day) and (
+                    last is None or last[0] != day):
+                raise RepeatedEntry(user_id, day)
+            if last is not None and last[0] == day:
+                user_totals[base] -= 1
+                user_totals[base + 1] -= last[2] - last[1]
+                user_totals[base + 2] -= last[1]
+                user_totals[base + 3] -= last[2]
+                for buckets, value in izip(
+                        user_sketches[weekday(day) * 3:],
+                        (last[2] - last[1], last[1], last[2])):
+                    buckets[sketch.bucket(value)] -= 1
+                rows_count -= 1
+            user_totals[base] += 1
+            user_totals[base + 1] += end - start
+            user_totals[base + 2] += start
+            user_totals[base + 3] += end
+            for buckets, value in izip(
+                    user_sketches[weekday(day) * 3:],
+                    (end - start, start, end)):
+                key = sketch.bucket(value)
+                buckets[key] = buckets.get(key, 0) + 1
+            last_entries[user_id] = (day, start, end)
+            rows_count += 1
+        return self.__class__(
+            totals, last_entries, rows_count, sketches, days
+        )
+
+    def __len__(self):
+        return len(self.totals)
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __contains__(self, user_id):
+        return user_id in self.totals
+
+    def weekday_stats(self, user_id):
+        """
+        Returns (count, total, start, end) sums for every weekday of user.
+        """
+        totals = self.totals[user_id]
+        return [tuple(totals[i:i + 4]) for i in xrange(0, self.stride, 4)]
+
+    def quantile_stats(self, user_id, quantiles):
+        """
+        Returns ``{'presence': [...], 'start': [...], 'end': [...]}``
+        estimates of given quantiles for every weekday of user.
+        """
+        user_sketches = self.sketches[user_id]
+        return weekday_quantiles(
+            lambda day_of_week, metric: sorted(
+                user_sketches[day_of_week * 3 + metric].items()
+            ),
+            quantiles,
+        )
+
+    def range_stats(self, user_id, first_day, last_day):
+        """
+        Ranges of days can't be answered without the entries.
+        """
+        raise NotImplementedError(
+            'Aggregates-only data has no ranges of days'
+        )
+
+    def occupancy(self, first_day=None, last_day=None):
+        """
+        Occupancy can't be answered without the entries.
+        """
+        raise NotImplementedError(
+            'Aggregates-only data has no presence intervals'
+        )
+
+
+def save_snapshot(store, path, meta):
+    """
+    Atomically writes store into binary snapshot file.
+
+    The file holds a magic line, a line of JSON with format version,
+    ``meta`` and column layout, then raw contents of the columns.
+    """
+    columns = store.to_columns()
+    header = {
+        'version': SNAPSHOT_VERSION,
+        'meta': meta,
+        'columns': [
+            (name, column.typecode, column.itemsize, len(column))
+            for name, column in columns
+        ],
+    }
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as snapshot:
+        snapshot.write('{}\n{}\n'.format(SNAPSHOT_MAGIC, json.dumps(header)))
+        for _, column in columns:
+            column.tofile(snapshot)
+    os.rename(temporary, path)
+
+
+def load_snapshot(path):
+    """
+    Reads store written by ``save_snapshot``, the file is memory-mapped
+    and its columns are copied straight into arrays.
+
+    Returns (store, meta) or None when the file is missing, empty or
+    written by another version or platform.
+    """
+    try:
+        with open(path, 'rb') as snapshot:
+            mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError):
+        return None
+    try:
+        magic_end = mapped.find('\n')
+        header_end = mapped.find('\n', magic_end + 1)
+        if mapped[:magic_end] != SNAPSHOT_MAGIC or header_end < 0:
+            return None
+        header = json.loads(mapped[magic_end + 1:header_end])
+        if header['version'] != SNAPSHOT_VERSION:
+            return None
+        columns = {}
+        position = header_end + 1
+        for name, typecode, itemsize, length in header['columns']:
+            column = array(str(typecode))
+            size = itemsize * length
+            if column.itemsize != itemsize or position + size > len(mapped):
+                return None
+            column.fromstring(buffer(mapped, position, size))
+            columns[name] = column
+            position += size
+        return PresenceStore.from_columns(columns), header['meta']
+    except (KeyError, TypeError, ValueError):
+        return None
+    finally:
+        mapped.close()
@@ -2,11 +2,27 @@
 """
 Presence analyzer unit tests.
 """
+import os
 import os.path
+import BaseHTTPServer
 import json
+import pstats
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import datetime
 import unittest
-from presence_analyzer import main, utils
+import urllib2
+import zlib
+from presence_analyzer import avatars, database, helpers, main, metrics
+from presence_analyzer import partitions, prefork, profiling, sketch, store
+from presence_analyzer import utils, views
+from presence_analyzer.benchmarks import generator
+from presence_analyzer.benchmarks import prefork as prefork_benchmark
 
 
 TEST_DATA_CSV = os.path.join(
@@ -17,6 +33,10 @@ TEST_CACHE_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_cache.csv'
 )
 
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'sample_data.csv'
+)
+
 TEST_DATA_XML = os.path.join(
     os.path.dirname(__file__), '..', '..', 'src',
     'presence_analyzer', 'users.xml'
@@ -63,6 +83,30 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.data, resp1.data)
 
+    def test_page_cache(self):
+        """
+        Test pages are rendered once and tagged with their content hash.
+        """
+        views.PAGES.clear()
+        resp = self.client.get('/presence_weekday')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/html')
+        etag = resp.headers['ETag']
+        self.assertEqual(etag, '"{}"'.format(utils.etag_of(resp.data)))
+        self.assertEqual(views.PAGES.keys(), [('presence_weekday.html', '')])
+
+        resp = self.client.get('/presence_weekday',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.client.get('/missing')
+        self.client.get('/other_missing')
+        self.assertEqual(len(views.PAGES), 2)
+
+        with main.app.test_request_context():
+            views.render_pages()
+        self.assertEqual(len(views.PAGES), len(views.pages_list) + 1)
+
     def test_api_users(self):
         """
         Test users listing.
@@ -72,7 +116,7 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.content_type, 'application/json')
         data = json.loads(resp.data)
         self.assertDictEqual(data[0], {
-            u'avatar': u'https://intranet.stxnext.pl:443/api/images/users/141',
+            u'avatar': u'/api/images/users/141',
             u'name': u'Adam P.',
             u'user_id': 141
         })
@@ -109,6 +153,183 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
             [u'Sun', 0.0],
         ])
 
+    def test_etag(self):
+        """
+        Test responses carry ETag and conditional requests get 304.
+        """
+        for url in ['/api/v1/users', '/api/v1/mean_time_weekday/10']:
+            resp = self.client.get(url)
+            etag = resp.headers['ETag']
+            self.assertTrue(etag)
+            resp = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, '')
+            resp = self.client.get(url, headers={'If-None-Match': '"x"'})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_serialized_cache(self):
+        """
+        Test serialized responses are dropped once data is reloaded.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        generation = utils.JSON_CACHE['generation']
+        key = ('presence_weekday_view', (), (('user_id', 10),), '')
+        self.assertEqual(utils.JSON_CACHE[key][0], resp.data)
+        main.app.config.update({'DATA_CSV': TEST_CACHE_CSV})
+        utils.CACHE = {}
+        try:
+            changed = self.client.get('/api/v1/presence_weekday/10')
+        finally:
+            utils.CACHE = {}
+        self.assertNotEqual(utils.JSON_CACHE['generation'], generation)
+        self.assertNotEqual(changed.data, resp.data)
+        self.assertNotEqual(changed.headers['ETag'], resp.headers['ETag'])
+
+    def test_metrics(self):
+        """
+        Test metrics of requests, loads and cache are exposed.
+        """
+        utils.CACHE = {}
+        self.client.get('/api/v1/mean_time_weekday/10')
+        self.client.get('/api/v1/users')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        lines = resp.data.splitlines()
+        self.assertIn(
+            '# TYPE presence_analyzer_request_seconds histogram', lines
+        )
+        samples = dict(
+            line.rsplit(' ', 1) for line in lines if not line.startswith('#')
+        )
+        self.assertGreaterEqual(float(samples[
+            'presence_analyzer_request_seconds_count'
+            '{endpoint="mean_time_weekday_view"}'
+        ]), 1)
+        self.assertGreaterEqual(float(samples[
+            'presence_analyzer_requests_total'
+            '{endpoint="users_view",status="200"}'
+        ]), 1)
+        self.assertEqual(float(samples[
+            'presence_analyzer_load_rows{loader="csv"}'
+        ]), 9)
+        self.assertIn('presence_analyzer_load_seconds_sum{loader="xml"}',
+                      samples)
+        self.assertGreaterEqual(float(samples[
+            'presence_analyzer_cache_misses_total{cache="cache"}'
+        ]), 1)
+        utils.CACHE = {}
+
+    def test_occupancy(self):
+        """
+        Test mean number of people present at every minute.
+        """
+        resp = self.client.get('/api/v1/occupancy')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1 + 24 * 60)
+        self.assertEqual(
+            data[0],
+            ['Time', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+        )
+        self.assertEqual(data[1 + 11 * 60], ['11:00', 1, 2, 2, 1.5, 0, 0, 0])
+        self.assertEqual(data[1 + 9 * 60 + 28][4], 0.5)
+        self.assertEqual(data[1 + 9 * 60 + 29][4], 0.5)
+        resp = self.client.get('/api/v1/occupancy?from=2013-09-12')
+        data = json.loads(resp.data)
+        self.assertEqual(data[1 + 11 * 60], ['11:00', 0, 0, 0, 2, 0, 0, 0])
+        resp = self.client.get('/occupancy')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('/api/v1/occupancy', resp.data)
+
+    def test_presence_percentiles(self):
+        """
+        Test percentiles of presence grouped by weekday.
+        """
+        resp = self.client.get('/api/v1/presence_percentiles/11')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 7)
+        self.assertEqual(data[6], ['Sun', {
+            'presence': [0, 0, 0], 'start': [0, 0, 0], 'end': [0, 0, 0],
+        }])
+        # Thursday: 09:28:08-15:51:27 and 10:18:36-16:41:25, with two
+        # entries rank of any percentile below 100 is the lower one
+        weekday, stats = data[3]
+        self.assertEqual(weekday, 'Thu')
+        for metric, lower in [('presence', 22969), ('start', 34088),
+                              ('end', 57087)]:
+            for value in stats[metric]:
+                self.assertAlmostEqual(value, lower, delta=lower * 0.01)
+
+        resp = self.client.get('/api/v1/presence_percentiles/1')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.client.get('/api/v1/presence_percentiles?user_ids=11')
+        self.assertEqual(json.loads(resp.data), {'11': data})
+        for url in ['/api/v1/presence_percentiles/11?from=2013-09-10',
+                    '/api/v1/presence_percentiles?to=2013-09-10']:
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_bulk_views(self):
+        """
+        Test statistics of many users in a single response.
+        """
+        for name in ['mean_time_weekday', 'presence_weekday',
+                     'presence_start_end']:
+            resp = self.client.get('/api/v1/{}'.format(name))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_type, 'application/json')
+            data = json.loads(resp.data)
+            self.assertItemsEqual(data.keys(), [u'10', u'11'])
+            for user_id in [10, 11]:
+                single = self.client.get(
+                    '/api/v1/{}/{}'.format(name, user_id)
+                )
+                self.assertEqual(data[str(user_id)], json.loads(single.data))
+
+        resp = self.client.get('/api/v1/presence_weekday?user_ids=11,12')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), [u'11', u'12'])
+        self.assertEqual(data[u'12'], [])
+        resp = self.client.get('/api/v1/presence_weekday?user_ids=a')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_date_range(self):
+        """
+        Test limiting statistics to a range of days.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?from=2013-09-06&to=2013-09-12'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [
+            [u'Weekday', u'Presence (s)'],
+            [u'Mon', 24123],
+            [u'Tue', 16564],
+            [u'Wed', 25321],
+            [u'Thu', 22969],
+            [u'Fri', 0],
+            [u'Sat', 0],
+            [u'Sun', 0],
+        ])
+        resp = self.client.get('/api/v1/mean_time_weekday/11?to=2013-09-09')
+        self.assertEqual(json.loads(resp.data)[0], [u'Mon', 24123.0])
+        self.assertEqual(json.loads(resp.data)[3], [u'Thu', 22999.0])
+        resp = self.client.get(
+            '/api/v1/presence_start_end?from=2013-09-13&user_ids=10,11'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(data[u'10'][3], [u'Thu', 0, 0])
+        self.assertEqual(data[u'11'][4], [u'Fri', 47816.0, 54242.0])
+        resp = self.client.get('/api/v1/presence_weekday/11?from=today')
+        self.assertEqual(resp.status_code, 400)
+        for url in [
+                '/api/v1/presence_weekday/10?from=2014-01-01&to=2013-01-01',
+                '/api/v1/mean_time_weekday/10?from=2013-09-12&to=2013-09-11',
+                '/api/v1/presence_start_end?from=2013-09-12&to=2013-09-11']:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 400)
+
     def test_presence_weekday_view(self):
         """
         Test presence weekday
@@ -201,11 +422,15 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         main.app.config.update({'DATA_CSV': TEST_CACHE_CSV})
         data2 = utils.get_data()
         self.assertEqual(data1, data2)
+        refreshing = utils.CACHE['cache'].refreshing
+        if refreshing is not None:
+            refreshing.join()
+        self.assertNotEqual(data1, utils.get_data())
         utils.CACHE = {}
         data2 = utils.get_data()
         self.assertNotEqual(data1, data2)
-        self.assertIsInstance(data1, dict)
-        self.assertIsInstance(data2, dict)
+        self.assertIsInstance(data1, utils.PresenceStore)
+        self.assertIsInstance(data2, utils.PresenceStore)
         utils.CACHE = {}
 
     def test_get_data(self):
@@ -213,7 +438,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, utils.PresenceStore)
         self.assertItemsEqual(data.keys(), [10, 11])
         sample_data = datetime.date(2013, 9, 10)
         self.assertIn(sample_data, data[10])
@@ -232,6 +457,31 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             'https://intranet.stxnext.pl:443/api/images/users/141'
         )
 
+    def test_collation_key(self):
+        """
+        Test sorting names in Polish alphabetical order.
+        """
+        names = [u'Łukasz', u'lucyna', u'Marek', u'Ćwik', u'Cezary',
+                 u'Źdźbło', u'Żaneta', u'Zenon', u'Émile', u'Ewa', u'Ela']
+        self.assertEqual(sorted(names, key=utils.collation_key), [
+            u'Cezary', u'Ćwik', u'Ela', u'Émile', u'Ewa', u'lucyna',
+            u'Łukasz', u'Marek', u'Zenon', u'Źdźbło', u'Żaneta',
+        ])
+
+    def test_get_users_directory(self):
+        """
+        Test users are parsed once and the listing is serialized.
+        """
+        utils.CACHE.pop('users', None)
+        directory = utils.get_users_directory()
+        self.assertIs(utils.get_users_directory(), directory)
+        self.assertEqual(directory.users.keys()[0], 141)
+        self.assertEqual(json.loads(directory.json)[0], {
+            u'avatar': u'/api/images/users/141',
+            u'name': u'Adam P.',
+            u'user_id': 141
+        })
+
     def test_group_by_weekday(self):
         """
         Test groups precence entries by weekday
@@ -256,7 +506,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             0: [24123],
             1: [16564],
             2: [25321],
-            3: [22969, 22999],
+            3: [22999, 22969],
             4: [6426],
             5: [],
             6: [],
@@ -315,7 +565,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         Test correct values of id, start, end variables
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, utils.PresenceStore)
         sample_data = utils.return_id_start_end(data[10])
         self.assertDictEqual(sample_data, {
             0: {'start': [], 'end': []},
@@ -338,6 +588,1810 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             6: {'start': [], 'end': []},
         })
 
+    def test_parse_rows(self):
+        """
+        Test fast parser gives the same results as the strict one.
+        """
+        rows = [
+            ['user_id', 'date', 'start', 'end'],
+            ['10', '2013-09-10', '09:39:05', '17:59:52'],
+            ['10', '2013-9-11', '9:19:52', '16:07:37'],
+            ['10', '2013-09-31', '09:19:52', '16:07:37'],
+            ['10', '2013-09-12', '24:00:00', '16:07:37'],
+            ['x', '2013-09-12', '10:00:00', '16:07:37'],
+            ['11', '2013-09-10', '09:39:05'],
+        ]
+        strict = [utils.parse_row_strict(row, i) for i, row in
+                  enumerate(rows) if len(row) == 4]
+        self.assertEqual(
+            list(utils.parse_rows(rows)),
+            [row for row in strict if row is not None]
+        )
+        self.assertEqual(list(utils.parse_rows(rows)), [
+            (10, 735121, 34745, 64792),
+            (10, 735122, 33592, 58057),
+        ])
+
+    def test_parse_day(self):
+        """
+        Test fixed-width date conversion.
+        """
+        self.assertEqual(utils.parse_day('2013-09-10'), 735121)
+        self.assertIsNone(utils.parse_day('2013-9-10'))
+        self.assertIsNone(utils.parse_day('2013-02-30'))
+        self.assertIsNone(utils.parse_day('2013/09/10'))
+
+    def test_parse_seconds(self):
+        """
+        Test fixed-width time conversion.
+        """
+        self.assertEqual(utils.parse_seconds('09:39:05'), 34745)
+        self.assertIsNone(utils.parse_seconds('9:39:05'))
+        self.assertIsNone(utils.parse_seconds('09:60:05'))
+        self.assertIsNone(utils.parse_seconds('09:39: 5'))
+
+
+class AggregatesModeTestCase(unittest.TestCase):
+    """
+    Aggregates-only data tests.
+    """
+    peak_memory = (
+        'import resource, sys\n'
+        'from presence_analyzer.utils import PresenceLoader\n'
+        'PresenceLoader().load(sys.argv[1], mode=sys.argv[2])\n'
+        'print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+    )
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+            'DATA_MODE': 'aggregates',
+        })
+        utils.CACHE = {}
+        self.client = main.app.test_client()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        del main.app.config['DATA_MODE']
+        utils.CACHE = {}
+        shutil.rmtree(self.tmpdir)
+
+    def test_weekday_stats(self):
+        """
+        Test aggregates match the ones of full data.
+        """
+        rows = [
+            (10, 735000, 10, 20),
+            (10, 735000, 30, 50),
+            (11, 735007, 1, 2),
+            (10, 735001, 5, 6),
+        ]
+        aggregates = store.AggregateStore.from_rows(rows)
+        full = store.PresenceStore.from_rows(rows)
+        self.assertEqual(list(aggregates.users), [10, 11])
+        self.assertEqual(aggregates.rows_count, full.rows_count)
+        for user_id in full:
+            self.assertEqual(aggregates.weekday_stats(user_id),
+                             full.weekday_stats(user_id))
+        merged = aggregates.merge([(11, 735007, 3, 9), (12, 735000, 1, 2)])
+        self.assertEqual(merged.weekday_stats(11)[store.weekday(735007)],
+                         (1, 6, 3, 9))
+        self.assertIn(12, merged)
+        self.assertNotIn(12, aggregates)
+
+    def test_repeated_entries(self):
+        """
+        Test entries repeating earlier days replace them like in full data.
+        """
+        self.assertRaises(
+            store.RepeatedEntry,
+            store.AggregateStore.from_rows,
+            [(10, 735000, 10, 20), (10, 735001, 5, 6), (10, 735000, 1, 2)],
+        )
+        path = os.path.join(self.tmpdir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                '10,2013-09-10,09:00:00,17:00:00\n'
+                '11,2013-09-10,10:00:00,17:00:00\n'
+                '10,2013-09-11,09:00:00,17:00:00\n'
+                '10,2013-09-10,08:00:00,12:00:00\n'
+                '11,2013-09-10,07:00:00,15:00:00\n'
+            )
+        loader = utils.PresenceLoader()
+        for line in ['', '10,2013-09-11,06:00:00,15:00:00\n']:
+            with open(path, 'a') as csvfile:
+                csvfile.write(line)
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+            aggregates = loader.load(path, mode='aggregates')
+            full = utils.PresenceLoader().load(path)
+            self.assertEqual(aggregates.rows_count, full.rows_count)
+            for user_id in full:
+                self.assertEqual(aggregates.weekday_stats(user_id),
+                                 full.weekday_stats(user_id))
+                self.assertEqual(
+                    aggregates.quantile_stats(user_id, [0, 0.5, 1]),
+                    full.quantile_stats(user_id, [0, 0.5, 1]),
+                )
+        self.assertEqual(loader.offset, os.path.getsize(path))
+
+    def test_views(self):
+        """
+        Test views work on top of aggregates only.
+        """
+        resp = self.client.get('/api/v1/presence_start_end/11')
+        self.assertEqual(json.loads(resp.data)[0], [u'Mon', 33134.0, 57257.0])
+        self.assertIsInstance(utils.get_data(), store.AggregateStore)
+        resp = self.client.get('/api/v1/mean_time_weekday?user_ids=10')
+        self.assertEqual(json.loads(resp.data)[u'10'][1], [u'Tue', 30047.0])
+        resp = self.client.get('/api/v1/presence_weekday/11?from=2013-09-06')
+        self.assertEqual(resp.status_code, 400)
+
+    def measure(self, days, mode):
+        """
+        Returns peak memory (kB) of a process loading ``days`` of data.
+        """
+        path = os.path.join(self.tmpdir, '{}.csv'.format(days))
+        first_day = datetime.date(2000, 1, 1).toordinal()
+        with open(path, 'w') as csvfile:
+            for day in xrange(first_day, first_day + days):
+                for user_id in xrange(20):
+                    seconds = 28800 + (day * 20 + user_id) % 3600
+                    csvfile.write('{},{},{},{}\n'.format(
+                        user_id,
+                        datetime.date.fromordinal(day),
+                        store.seconds_to_time(seconds),
+                        store.seconds_to_time(seconds + 28800),
+                    ))
+        root = os.path.join(os.path.dirname(__file__), '..')
+        return int(subprocess.check_output(
+            [sys.executable, '-c', self.peak_memory, path, mode],
+            cwd=root,
+            stderr=open(os.devnull, 'w'),
+        ))
+
+    def test_peak_memory(self):
+        """
+        Test peak memory doesn't grow with the history in aggregates mode.
+        """
+        small = self.measure(1000, 'aggregates')
+        large = self.measure(10000, 'aggregates')
+        self.assertLess(large - small, 1024)
+        # while keeping all entries does
+        self.assertGreater(self.measure(10000, 'full') - large, 10240)
+
+
+class SqliteBackendTestCase(unittest.TestCase):
+    """
+    SQLite storage backend tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        self.database = os.path.join(self.tmpdir, 'presence.sqlite')
+        shutil.copy(SAMPLE_DATA_CSV, self.path)
+        self.loader = utils.SqliteLoader()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('DATA_BACKEND', None)
+        utils.CACHE = {}
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, content, mode='a'):
+        """
+        Writes to the data file and makes sure its mtime moves.
+        """
+        with open(self.path, mode) as csvfile:
+            csvfile.write(content)
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 1))
+
+    def assert_same_stats(self, data, expected):
+        """
+        Asserts two stores answer every statistic the same way.
+        """
+        self.assertEqual(list(data.users), list(expected.users))
+        self.assertEqual(data.rows_count, expected.rows_count)
+        first, last = [datetime.date(2013, 1, 1).toordinal(),
+                       datetime.date(2013, 6, 30).toordinal()]
+        for user_id in expected:
+            self.assertEqual(data.weekday_stats(user_id),
+                             expected.weekday_stats(user_id))
+            self.assertEqual(data.range_stats(user_id, first, last),
+                             expected.range_stats(user_id, first, last))
+            self.assertEqual(data.range_stats(user_id, last, first),
+                             [(0, 0, 0, 0)] * 7)
+            self.assertEqual(data.quantile_stats(user_id, [0.1, 0.5]),
+                             expected.quantile_stats(user_id, [0.1, 0.5]))
+            self.assertEqual(dict(data[user_id]), dict(expected[user_id]))
+        self.assertEqual(data.occupancy(first, last),
+                         expected.occupancy(first, last))
+
+    def test_stats(self):
+        """
+        Test SQL aggregates match the in-memory store.
+        """
+        self.write('10,2013-09-10,08:00:00,09:00:00\n')
+        data = self.loader.load(self.path, self.database)
+        self.assertIsInstance(data, database.SqliteStore)
+        self.assert_same_stats(data, utils.PresenceLoader().load(self.path))
+        self.assertNotIn(0, data)
+        self.assertRaises(KeyError, lambda: data[0])
+
+    def test_incremental(self):
+        """
+        Test only appended rows are imported, also by a new process.
+        """
+        data = self.loader.load(self.path, self.database)
+        self.assertIs(self.loader.load(self.path, self.database), data)
+        offset = self.loader.offset
+        self.write('12345,2013-09-16,08:00:00,16:00:00\n')
+        appended = self.loader.load(self.path, self.database)
+        self.assertIn(12345, appended)
+        self.assertNotIn(12345, data)
+        self.assertNotEqual(appended.generation, data.generation)
+        self.assertEqual(appended.rows_count, data.rows_count + 1)
+
+        # a new loader continues from the state saved in the database,
+        # the row only the database has would be gone after a full import
+        database.insert_rows(
+            database.connect(self.database), [(99999, 735000, 1, 2)]
+        )
+        loader = utils.SqliteLoader()
+        self.write('12346,2013-09-16,08:00:00,16:00:00\n')
+        data = loader.load(self.path, self.database)
+        self.assertIn(99999, data)
+        self.assertIn(12346, data)
+        self.assertGreater(loader.offset, offset)
+        self.assertEqual(loader.offset, os.path.getsize(self.path))
+
+    def test_rewrite(self):
+        """
+        Test rewritten file is imported from scratch.
+        """
+        self.loader.load(self.path, self.database)
+        self.write('12,2013-09-16,08:00:00,16:00:00\n', 'w')
+        data = self.loader.load(self.path, self.database)
+        self.assertEqual(list(data.users), [12])
+        self.assertEqual(data.rows_count, 1)
+
+    def test_edit(self):
+        """
+        Test rows edited in place are noticed along with appended ones.
+        """
+        self.loader.load(self.path, self.database)
+        with open(self.path, 'r+') as csvfile:
+            csvfile.write('99')
+        self.write('12346,2013-09-16,08:00:00,16:00:00\n')
+        self.assert_same_stats(
+            utils.SqliteLoader().load(self.path, self.database),
+            utils.PresenceLoader().load(self.path)
+        )
+
+    def test_connection_per_thread(self):
+        """
+        Test every thread queries through its own connection.
+        """
+        connection = database.connect(self.database)
+        self.assertIs(database.connect(self.database), connection)
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(
+                database.connect(self.database)
+            )
+        )
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], connection)
+
+    def test_views(self):
+        """
+        Test views answer the same with the SQLite backend.
+        """
+        main.app.config.update({
+            'DATA_CSV': self.path,
+            'DATA_XML': TEST_DATA_XML,
+        })
+        client = main.app.test_client()
+        urls = [
+            '/api/v1/presence_weekday/10',
+            '/api/v1/mean_time_weekday/11?from=2013-01-01',
+            '/api/v1/presence_start_end?user_ids=10,11',
+            '/api/v1/presence_percentiles/10',
+            '/api/v1/occupancy?to=2013-01-01',
+        ]
+        utils.CACHE = {}
+        expected = [client.get(url).data for url in urls]
+        main.app.config.update({
+            'DATA_BACKEND': 'sqlite',
+            'DATA_SQLITE': self.database,
+        })
+        utils.CACHE = {}
+        self.assertEqual([client.get(url).data for url in urls], expected)
+        self.assertIsInstance(utils.get_data(), database.SqliteStore)
+
+
+class PartitionsTestCase(unittest.TestCase):
+    """
+    Month-partitioned data tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmpdir, 'data')
+        self.written = partitions.split_csv(SAMPLE_DATA_CSV, self.directory)
+        self.loaded = []
+        utils.PARTITION_LOADERS.clear()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        utils.PARTITION_LOADERS.clear()
+        utils.CACHE = {}
+        utils.CACHE_FROZEN.discard('cache')
+        shutil.rmtree(self.tmpdir)
+
+    def load(self, path):
+        """
+        Loads partition, remembering which ones were loaded.
+        """
+        self.loaded.append(os.path.basename(path))
+        return utils.load_partition(path)
+
+    def test_split(self):
+        """
+        Test file is split into months, keeping every line.
+        """
+        names = [os.path.basename(path) for path in self.written]
+        self.assertEqual(names[0], '2011-06.csv')
+        self.assertEqual(names[-1], '2013-09.csv')
+        self.assertEqual(sorted(os.listdir(self.directory)), names)
+        with open(os.path.join(self.directory, '2013-09.csv')) as csvfile:
+            self.assertTrue(all(
+                line.split(',')[1].startswith('2013-09-')
+                for line in csvfile
+            ))
+        with open(SAMPLE_DATA_CSV) as csvfile:
+            lines = sorted(line.rstrip('\n') for line in csvfile)
+        self.assertEqual(sorted(
+            line.rstrip('\n')
+            for path in self.written for line in open(path)
+        ), lines)
+        self.assertEqual(
+            partitions.month_range('2013-02.csv'),
+            (datetime.date(2013, 2, 1).toordinal(),
+             datetime.date(2013, 2, 28).toordinal()),
+        )
+        self.assertIsNone(partitions.month_range('old.csv'))
+
+    def test_stats(self):
+        """
+        Test partitioned data answers like the whole file.
+        """
+        data = partitions.PartitionedStore(
+            partitions.partition_paths(self.directory), self.load
+        )
+        expected = utils.PresenceLoader().load(SAMPLE_DATA_CSV)
+        first, last = [datetime.date(2012, 11, 15).toordinal(),
+                       datetime.date(2013, 2, 10).toordinal()]
+        self.assertEqual(list(data.users), list(expected.users))
+        self.assertEqual(data.rows_count, expected.rows_count)
+        for user_id in expected:
+            self.assertEqual(data.weekday_stats(user_id),
+                             expected.weekday_stats(user_id))
+            self.assertEqual(data.range_stats(user_id, first, last),
+                             expected.range_stats(user_id, first, last))
+            self.assertEqual(data.range_stats(user_id, last, first),
+                             [(0, 0, 0, 0)] * 7)
+            self.assertEqual(data.quantile_stats(user_id, [0.1, 0.9]),
+                             expected.quantile_stats(user_id, [0.1, 0.9]))
+        self.assertEqual(dict(data[10]), dict(expected[10]))
+        self.assertEqual(data.occupancy(first, last),
+                         expected.occupancy(first, last))
+        self.assertNotIn(0, data)
+
+    def test_pruning(self):
+        """
+        Test ranges of days read only partitions they overlap.
+        """
+        data = partitions.PartitionedStore(
+            partitions.partition_paths(
+                os.path.join(self.directory, '2013-*.csv')
+            ),
+            self.load,
+        )
+        self.assertIn(11, data)
+        self.assertEqual(self.loaded, ['2013-09.csv'])
+        data.range_stats(11, datetime.date(2013, 7, 30).toordinal(),
+                         datetime.date(2013, 8, 2).toordinal())
+        self.assertEqual(
+            self.loaded, ['2013-09.csv', '2013-07.csv', '2013-08.csv']
+        )
+        data.occupancy(datetime.date(2013, 9, 1).toordinal())
+        self.assertEqual(len(self.loaded), 3)
+
+    def test_ranged_views(self):
+        """
+        Test ranged requests load only partitions overlapping the range.
+        """
+        client = main.app.test_client()
+        requests = [
+            ('/api/v1/presence_weekday/10?from=2011-06-01&to=2011-07-31',
+             ['2011-06.csv', '2011-07.csv']),
+            ('/api/v1/presence_start_end?user_ids=10,0&to=2011-06-30',
+             ['2011-06.csv']),
+            ('/api/v1/mean_time_weekday/0?from=2013-09-01',
+             ['2013-09.csv']),
+        ]
+        for url, loaded in requests:
+            main.app.config.update({
+                'DATA_CSV': SAMPLE_DATA_CSV,
+                'DATA_XML': TEST_DATA_XML,
+            })
+            utils.CACHE = {}
+            expected = client.get(url).data
+            main.app.config['DATA_CSV'] = self.directory
+            utils.CACHE = {}
+            utils.PARTITION_LOADERS.clear()
+            self.assertEqual(client.get(url).data, expected)
+            data = utils.get_data()
+            self.assertEqual(
+                [os.path.basename(data.paths[i])
+                 for i, store in enumerate(data.stores) if store],
+                loaded,
+            )
+        self.assertEqual(json.loads(expected)[0], [u'Mon', 0])
+
+    def test_prefork(self):
+        """
+        Test prefork master loads all partitions before forking workers.
+        """
+        main.app.config['DATA_CSV'] = self.directory
+        utils.CACHE = {}
+        prefork.load_data()
+        data = utils.get_data()
+        self.assertTrue(all(data.stores))
+        self.assertEqual(len(data.stores), len(self.written))
+        self.assertFalse(prefork.data_changed())
+        # workers forked off this process never refresh the data
+        self.assertIn('cache', utils.CACHE_FROZEN)
+        self.assertIsNone(utils.CACHE['cache'].refreshing)
+
+    def test_reload(self):
+        """
+        Test only changed partitions are parsed again.
+        """
+        url = '/api/v1/presence_weekday/11?from=2013-09-01'
+        client = main.app.test_client()
+        main.app.config.update({
+            'DATA_CSV': SAMPLE_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+        })
+        utils.CACHE = {}
+        expected = client.get(url).data
+        main.app.config['DATA_CSV'] = self.directory
+        utils.CACHE = {}
+        self.assertEqual(client.get(url).data, expected)
+        data = utils.get_data()
+        self.assertEqual(
+            [i for i, loaded in enumerate(data.stores) if loaded],
+            [len(self.written) - 1]
+        )
+
+        changed = os.path.join(self.directory, '2013-09.csv')
+        with open(changed, 'a') as csvfile:
+            csvfile.write('11,2013-09-17,09:00:00,10:00:00\n')
+        stat = os.stat(changed)
+        os.utime(changed, (stat.st_atime, stat.st_mtime + 1))
+        self.assertNotEqual(
+            utils.CACHE['cache'].source, utils.file_signature(self.directory)
+        )
+        reloaded = utils.load_partitions(data.paths)
+        self.assertIsNot(reloaded.stores[-1], data.stores[-1])
+        self.assertEqual(reloaded.stores[:-1], data.stores[:-1])
+        self.assertEqual(
+            reloaded.range_stats(
+                11, *[datetime.date(2013, 9, 17).toordinal()] * 2
+            )[1],
+            (1, 3600, 32400, 36000),
+        )
+
+
+class PreforkTestCase(unittest.TestCase):
+    """
+    Prefork server tests.
+    """
+    serve = (
+        'import sys\n'
+        'from presence_analyzer import app\n'
+        'from presence_analyzer.prefork import PreforkServer\n'
+        'app.config.update({\n'
+        '    "DATA_CSV": sys.argv[1], "DATA_XML": sys.argv[2],\n'
+        '    "DATA_SNAPSHOT": None,\n'
+        '})\n'
+        'server = PreforkServer(app, "127.0.0.1", 0, 2, 0.1)\n'
+        'print server.port\n'
+        'sys.stdout.flush()\n'
+        'server.serve_forever()\n'
+    )
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        root = os.path.join(os.path.dirname(__file__), '..')
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', self.serve, self.path, TEST_DATA_XML],
+            cwd=root,
+            stdout=subprocess.PIPE,
+            stderr=open(os.devnull, 'w'),
+        )
+        self.port = int(self.process.stdout.readline())
+        self.workers = self.wait_for(
+            lambda: prefork_benchmark.child_pids(self.process.pid),
+            lambda pids: len(pids) == 2,
+        )
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def wait_for(self, function, condition, timeout=10):
+        """
+        Returns result of function once it satisfies condition.
+        """
+        deadline = time.time() + timeout
+        while True:
+            result = function()
+            if condition(result) or time.time() > deadline:
+                self.assertTrue(condition(result), result)
+                return result
+            time.sleep(0.05)
+
+    def get(self, url):
+        """
+        Returns response body of the server.
+        """
+        return prefork_benchmark.request(self.port, url)
+
+    def test_serve(self):
+        """
+        Test workers answer like the application itself.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+        })
+        utils.CACHE = {}
+        client = main.app.test_client()
+        for url in ['/api/v1/users', '/api/v1/presence_weekday/10',
+                    '/api/v1/mean_time_weekday?from=2013-09-10']:
+            self.assertEqual(self.get(url), client.get(url).data)
+
+    def test_reload(self):
+        """
+        Test workers are replaced by ones forked off reloaded data.
+        """
+        self.assertEqual(self.get('/api/v1/presence_weekday/12'), '[]')
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-16,08:00:00,16:00:00\n')
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 1))
+        self.wait_for(
+            lambda: prefork_benchmark.child_pids(self.process.pid),
+            lambda pids: len(pids) == 2 and not set(pids) & set(self.workers),
+        )
+        self.assertEqual(
+            json.loads(self.get('/api/v1/presence_weekday/12'))[1],
+            [u'Mon', 28800],
+        )
+
+    def test_replace_and_stop(self):
+        """
+        Test dead workers are replaced and SIGTERM stops all processes.
+        """
+        os.kill(self.workers[0], signal.SIGKILL)
+        workers = self.wait_for(
+            lambda: prefork_benchmark.child_pids(self.process.pid),
+            lambda pids: len(pids) == 2 and self.workers[0] not in pids,
+        )
+        self.assertIn(self.workers[1], workers)
+        self.process.terminate()
+        self.assertEqual(self.process.wait(), 0)
+        self.assertEqual(prefork_benchmark.child_pids(self.process.pid), [])
+
+
+class FakeClock(object):
+    """
+    Clock which moves only when told to.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CacheTestCase(unittest.TestCase):
+    """
+    Cache decorator tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.clock = FakeClock()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'source.csv')
+        with open(self.path, 'w') as source:
+            source.write('1')
+        self.calls = []
+        self.cached = utils.cache(
+            'test', 10, source=lambda: self.path, clock=self.clock
+        )(self.load)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        utils.CACHE.pop('test', None)
+        utils.CACHE_STATS.pop('test', None)
+        utils.CACHE_FROZEN.discard('test')
+        shutil.rmtree(self.tmpdir)
+
+    def load(self):
+        """
+        Loads "data" and counts calls.
+        """
+        self.calls.append(self.clock())
+        if os.path.getsize(self.path) > 2:
+            raise IOError('broken')
+        with open(self.path) as source:
+            return source.read()
+
+    def wait(self):
+        """
+        Waits for background refresh to finish.
+        """
+        refreshing = utils.CACHE['test'].refreshing
+        if refreshing is not None:
+            refreshing.join()
+
+    def test_expiration(self):
+        """
+        Test data is served stale and refreshed after expiration time.
+        """
+        self.assertEqual(self.cached(), '1')
+        self.clock.now += 10
+        self.assertEqual(self.cached(), '1')
+        self.assertEqual(len(self.calls), 1)
+
+        self.clock.now += 1
+        with open(self.path, 'w') as source:
+            source.write('2')
+        os.utime(self.path, (0, os.stat(self.path).st_mtime))
+        self.assertEqual(self.cached(), '1')
+        self.wait()
+        self.assertEqual(self.cached(), '2')
+        self.assertEqual(self.calls, [1000.0, 1011.0])
+        self.assertEqual(utils.CACHE_STATS['test'], {
+            'hits': 3, 'misses': 1, 'refreshes': 1
+        })
+
+    def test_source_change(self):
+        """
+        Test data is refreshed as soon as the source file changes.
+        """
+        self.assertEqual(self.cached(), '1')
+        with open(self.path, 'w') as source:
+            source.write('22')
+        self.assertEqual(self.cached(), '1')
+        self.wait()
+        self.assertEqual(self.cached(), '22')
+        self.wait()
+        self.assertEqual(len(self.calls), 2)
+
+    def test_failed_refresh(self):
+        """
+        Test stale data is kept when reloading fails.
+        """
+        self.assertEqual(self.cached(), '1')
+        with open(self.path, 'w') as source:
+            source.write('333')
+        self.assertEqual(self.cached(), '1')
+        self.wait()
+        self.assertEqual(self.cached(), '1')
+        self.assertEqual(utils.CACHE_STATS['test']['refreshes'], 0)
+
+    def test_frozen(self):
+        """
+        Test frozen entries are served without refreshing them.
+        """
+        utils.CACHE_FROZEN.add('test')
+        self.assertEqual(self.cached(), '1')
+        self.clock.now += 11
+        with open(self.path, 'w') as source:
+            source.write('2')
+        self.assertEqual(self.cached(), '1')
+        self.assertIsNone(utils.CACHE['test'].refreshing)
+        self.assertEqual(len(self.calls), 1)
+        utils.CACHE.pop('test')
+        self.assertEqual(self.cached(), '2')
+
+
+class PresenceStoreTestCase(unittest.TestCase):
+    """
+    Columnar presence store tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.store = store.PresenceStore.from_rows([
+            (11, 735000, 100, 200),
+            (10, 735001, 300, 400),
+            (10, 735000, 500, 600),
+            (11, 735000, 700, 800),
+        ])
+
+    def test_layout(self):
+        """
+        Test rows are sorted by user and day with an offset table.
+        """
+        self.assertEqual(list(self.store.users), [10, 11])
+        self.assertEqual(list(self.store.offsets), [0, 2, 3])
+        self.assertEqual(list(self.store.user_ids), [10, 10, 11])
+        self.assertEqual(list(self.store.days), [735000, 735001, 735000])
+        self.assertEqual(list(self.store.starts), [500, 300, 700])
+        self.assertEqual(list(self.store.ends), [600, 400, 800])
+        self.assertEqual(self.store.rows_count, 3)
+
+    def test_user_presence(self):
+        """
+        Test mapping interface of a single user.
+        """
+        self.assertIn(10, self.store)
+        self.assertNotIn(12, self.store)
+        user = self.store[10]
+        self.assertEqual(len(user), 2)
+        day = datetime.date.fromordinal(735001)
+        self.assertEqual(user[day], {
+            'start': datetime.time(0, 5, 0),
+            'end': datetime.time(0, 6, 40),
+        })
+        self.assertNotIn(datetime.date.fromordinal(735002), user)
+        self.assertEqual(
+            list(user.rows()),
+            [(735000, 500, 600), (735001, 300, 400)]
+        )
+
+    def test_merge(self):
+        """
+        Test merging new rows into existing store.
+        """
+        merged = self.store.merge([
+            (10, 735002, 1, 2),
+            (10, 735000, 3, 4),
+            (9, 735000, 5, 6),
+        ])
+        self.assertEqual(list(merged.users), [9, 10, 11])
+        self.assertEqual(list(merged.offsets), [0, 1, 4, 5])
+        self.assertEqual(list(merged.user_ids), [9, 10, 10, 10, 11])
+        self.assertEqual(list(merged.days),
+                         [735000, 735000, 735001, 735002, 735000])
+        self.assertEqual(list(merged.starts), [5, 3, 300, 1, 700])
+        self.assertEqual(list(merged.ends), [6, 4, 400, 2, 800])
+        self.assertIs(self.store.merge([]), self.store)
+
+    def test_weekday_stats(self):
+        """
+        Test per-weekday aggregates, also after merging new rows.
+        """
+        day = store.weekday(735000)
+        stats = self.store.weekday_stats(10)
+        self.assertEqual(stats[day], (1, 100, 500, 600))
+        self.assertEqual(stats[store.weekday(735001)], (1, 100, 300, 400))
+        self.assertEqual(sum(count for count, _, _, _ in stats), 2)
+
+        rows = [(10, 735007, 1000, 1500), (11, 735000, 0, 50)]
+        merged = self.store.merge(rows)
+        self.assertEqual(merged.weekday_stats(10)[day], (2, 600, 1500, 2100))
+        self.assertEqual(merged.weekday_stats(11)[day], (1, 50, 0, 50))
+        self.assertEqual(
+            list(merged.aggregates),
+            list(store.PresenceStore.from_entries({
+                10: {735000: (500, 600), 735001: (300, 400),
+                     735007: (1000, 1500)},
+                11: {735000: (0, 50)},
+            }).aggregates)
+        )
+
+    def test_range_stats(self):
+        """
+        Test weekday aggregates limited to a range of days.
+        """
+        merged = self.store.merge([
+            (10, 735007, 1000, 1500),
+            (10, 735014, 2000, 2100),
+        ])
+        day = store.weekday(735000)
+        self.assertEqual(
+            merged.range_stats(10, 0, 800000), merged.weekday_stats(10)
+        )
+        self.assertEqual(
+            merged.range_stats(10, 735001, 735014)[day], (2, 600, 3000, 3600)
+        )
+        self.assertEqual(
+            merged.range_stats(10, 735000, 735007)[day], (2, 600, 1500, 2100)
+        )
+        self.assertEqual(
+            merged.range_stats(10, 735008, 735013)[day], (0, 0, 0, 0)
+        )
+        self.assertEqual(
+            merged.range_stats(10, 735014, 735000), [(0, 0, 0, 0)] * 7
+        )
+        rebuilt = store.PresenceStore.from_entries({
+            10: {735000: (500, 600), 735001: (300, 400),
+                 735007: (1000, 1500), 735014: (2000, 2100)},
+            11: {735000: (700, 800)},
+        })
+        for name in ['offsets', 'days', 'totals', 'starts', 'ends']:
+            self.assertEqual(
+                getattr(merged.by_weekday, name),
+                getattr(rebuilt.by_weekday, name)
+            )
+
+    def test_combine(self):
+        """
+        Test combining stores of consecutive parts of data.
+        """
+        later = store.PresenceStore.from_rows([
+            (11, 735007, 1, 2),
+            (12, 735000, 3, 4),
+            (10, 735000, 5, 6),
+        ])
+        combined = store.PresenceStore.combine([self.store, later])
+        self.assertEqual(
+            combined.to_columns(),
+            store.PresenceStore.from_entries({
+                10: {735000: (5, 6), 735001: (300, 400)},
+                11: {735000: (700, 800), 735007: (1, 2)},
+                12: {735000: (3, 4)},
+            }).to_columns()
+        )
+
+    def test_concatenate(self):
+        """
+        Test concatenating stores of consecutive ranges of users.
+        """
+        rows = [
+            (10, 735000, 500, 600),
+            (11, 735001, 300, 400),
+            (12, 735007, 1000, 1500),
+            (12, 735014, 2000, 2100),
+            (14, 735000, 700, 800),
+        ]
+        concatenated = store.PresenceStore.concatenate([
+            store.PresenceStore.from_rows(rows[:1]),
+            store.PresenceStore.from_rows([]),
+            store.PresenceStore.from_rows(rows[1:4]),
+            store.PresenceStore.from_rows(rows[4:]),
+        ])
+        self.assertEqual(
+            concatenated.to_columns(),
+            store.PresenceStore.from_rows(rows).to_columns(),
+        )
+        self.assertEqual(concatenated.range_stats(12, 735014, 735014)[6],
+                         (1, 100, 2000, 2100))
+
+    def test_occupancy(self):
+        """
+        Test occupancy with and without NumPy matches counting directly.
+        """
+        rows = [
+            (10, 735000, 9 * 3600 + 30, 17 * 3600),
+            (10, 735001, 8 * 3600, 8 * 3600 + 119),
+            (10, 735002, 8 * 3600, 8 * 3600 + 59),
+            (11, 735000, 10 * 3600, 86399),
+            (11, 735007, 12 * 3600, 11 * 3600),
+            (12, 735007, 0, 60),
+        ]
+        data = store.PresenceStore.from_rows(rows)
+        expected = [[0] * store.MINUTES for __ in xrange(7)]
+        for __, day, start, end in rows:
+            for minute in xrange(start // 60, end // 60):
+                expected[store.weekday(day)][minute] += 1
+        expected[store.weekday(735000)] = [
+            value / 2.0 for value in expected[store.weekday(735000)]
+        ]
+        numpy = store.numpy
+        try:
+            for store.numpy in set([None, numpy]):
+                self.assertEqual(data.occupancy(), expected)
+                curves = data.occupancy(735001, 735001)
+                self.assertEqual(curves[store.weekday(735001)][480], 1)
+                self.assertEqual(sum(map(sum, curves)), 1)
+                self.assertEqual(
+                    store.PresenceStore.from_rows([]).occupancy(),
+                    [[0] * store.MINUTES] * 7
+                )
+        finally:
+            store.numpy = numpy
+        aggregates = store.AggregateStore.from_rows(rows)
+        self.assertRaises(NotImplementedError, aggregates.occupancy)
+
+    def test_quantile_stats(self):
+        """
+        Test percentiles estimated by sketches on the sample data are
+        within 1% of the exact ones.
+        """
+        data = utils.PresenceLoader().load(SAMPLE_DATA_CSV)
+        aggregates = store.AggregateStore.from_rows(
+            (user_id, day, start, end)
+            for user_id in data
+            for day, start, end in data[user_id].rows()
+        )
+        quantiles = [0, 0.1, 0.5, 0.9, 1]
+        for user_id in data:
+            exact = [([], [], []) for __ in xrange(7)]
+            for day, start, end in data[user_id].rows():
+                for values, value in zip(exact[store.weekday(day)],
+                                         (end - start, start, end)):
+                    values.append(value)
+            estimated = data.quantile_stats(user_id, quantiles)
+            self.assertEqual(
+                aggregates.quantile_stats(user_id, quantiles), estimated
+            )
+            for day_of_week in xrange(7):
+                for metric, values in zip(['presence', 'start', 'end'],
+                                          exact[day_of_week]):
+                    values.sort()
+                    for q, value in zip(quantiles,
+                                        estimated[day_of_week][metric]):
+                        expected = values[int(q * (len(values) - 1))] \
+                            if values else 0
+                        self.assertLessEqual(
+                            abs(value - expected),
+                            expected * sketch.RELATIVE_ACCURACY
+                        )
+
+    def test_sketch(self):
+        """
+        Test sketches merge exactly and handle edge values.
+        """
+        values = range(0, 86400, 7)
+        whole = sketch.sketch(values)
+        self.assertEqual(
+            sketch.merge([sketch.sketch(values[:100]),
+                          sketch.sketch(values[100:5000]),
+                          sketch.sketch(values[5000:])]),
+            whole
+        )
+        self.assertEqual(sketch.quantile(whole, 0), 0)
+        self.assertAlmostEqual(
+            sketch.quantile(whole, 0.5), 43197, delta=431.97
+        )
+        self.assertIsNone(sketch.quantile([], 0.5))
+        # zero and negative presence, like broken entries, aren't clamped
+        values = [-86400, -3600, -5, -1, 0, 0, 1, 5, 3600]
+        pairs = sketch.sketch(values)
+        self.assertEqual(pairs[4], (sketch.ZERO_KEY, 2))
+        for i, value in enumerate(values):
+            self.assertAlmostEqual(
+                sketch.quantile(pairs, i / 8.0), value,
+                delta=abs(value) * sketch.RELATIVE_ACCURACY
+            )
+        self.assertAlmostEqual(sketch.quantile(sketch.sketch([1]), 1), 1,
+                               delta=0.01)
+
+    def test_weekday(self):
+        """
+        Test weekday of a day ordinal.
+        """
+        day = datetime.date(2013, 9, 10)
+        self.assertEqual(store.weekday(day.toordinal()), day.weekday())
+
+
+class PresenceLoaderTestCase(unittest.TestCase):
+    """
+    Incremental CSV loading tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.loader = utils.PresenceLoader()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, content, mode='a'):
+        """
+        Writes to the data file and makes sure its mtime moves.
+        """
+        with open(self.path, mode) as csvfile:
+            csvfile.write(content)
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 1))
+
+    def test_unchanged(self):
+        """
+        Test unchanged file isn't parsed again.
+        """
+        data = self.loader.load(self.path)
+        self.assertIs(self.loader.load(self.path), data)
+
+    def test_append(self):
+        """
+        Test only appended rows are parsed and merged.
+        """
+        data = self.loader.load(self.path)
+        offset = self.loader.offset
+        self.write('\n12,2013-09-16,08:00:00,16:00:00\n')
+        self.loader.load(self.path)
+        self.assertEqual(self.loader.offset, os.path.getsize(self.path))
+        self.assertGreater(self.loader.offset, offset)
+        # last line of the original file had no line break
+        self.assertEqual(list(data.users), [10, 11])
+        self.assertEqual(list(self.loader.data.users), [10, 11, 12])
+        self.assertEqual(
+            self.loader.data,
+            utils.PresenceLoader().load(self.path)
+        )
+
+    def test_rewrite(self):
+        """
+        Test truncated and rewritten files are loaded from scratch.
+        """
+        self.loader.load(self.path)
+        self.write('12,2013-09-16,08:00:00,16:00:00\n', 'w')
+        self.assertEqual(list(self.loader.load(self.path).users), [12])
+        self.write('13,2013-09-16,08:00:00,16:00:00\n', 'w')
+        self.assertEqual(list(self.loader.load(self.path).users), [13])
+
+    def test_edit(self):
+        """
+        Test rows edited in place are noticed along with appended ones,
+        also when restoring from snapshot.
+        """
+        snapshot = os.path.join(self.tmpdir, 'data.snapshot')
+        self.loader.load(self.path, snapshot)
+        with open(self.path, 'r+') as csvfile:
+            csvfile.write('12')
+        self.write('\n13,2013-09-16,08:00:00,16:00:00\n')
+        expected = utils.PresenceLoader().load(self.path)
+        self.assertEqual(list(expected.users), [10, 11, 12, 13])
+        self.assertEqual(self.loader.load(self.path), expected)
+        self.assertEqual(
+            utils.PresenceLoader().load(self.path, snapshot), expected
+        )
+
+    def test_parallel(self):
+        """
+        Test parsing in worker processes gives the same data.
+        """
+        self.write('\n'.join([
+            '12,2013-09-16,08:00:00,16:00:00',
+            '10,2013-09-10,09:00:00,17:00:00',
+            'broken line',
+            '11,2013-09-05,09:28:08,15:51:27',
+        ]))
+        data = self.loader.load(self.path)
+        for workers in [2, 3, 50]:
+            loader = utils.PresenceLoader()
+            parallel = loader.load(self.path, workers=workers)
+            self.assertEqual(parallel.to_columns(), data.to_columns())
+            self.assertEqual(loader.offset, self.loader.offset)
+            self.assertEqual(loader.tail, self.loader.tail)
+            self.assertEqual(loader.checksum, self.loader.checksum)
+
+        # later entries of the same day win across ranges of the file
+        self.write(''.join(
+            '{},2013-09-{:02},0{}:00:00,16:00:00\n'.format(
+                user_id, day, repeat + 7
+            )
+            for repeat in xrange(3)
+            for user_id in xrange(20, 60)
+            for day in xrange(1, 29)
+        ), 'w')
+        self.loader = utils.PresenceLoader()
+        data = self.loader.load(self.path)
+        self.assertEqual(
+            data.weekday_stats(30)[0],
+            (4, 4 * 7 * 3600, 4 * 9 * 3600, 4 * 16 * 3600),
+        )
+        for workers in [2, 3, 7]:
+            loader = utils.PresenceLoader()
+            parallel = loader.load(self.path, workers=workers)
+            self.assertEqual(parallel.to_columns(), data.to_columns())
+            self.assertEqual(loader.offset, self.loader.offset)
+            self.assertEqual(loader.tail, self.loader.tail)
+            self.assertEqual(loader.checksum, self.loader.checksum)
+
+    def test_snapshot(self):
+        """
+        Test loading from binary snapshot, also of a shorter file.
+        """
+        snapshot = os.path.join(self.tmpdir, 'data.snapshot')
+        data = self.loader.load(self.path, snapshot)
+        self.assertTrue(os.path.exists(snapshot))
+        restored, meta = store.load_snapshot(snapshot)
+        self.assertEqual(restored, data)
+        self.assertEqual(meta['offset'], self.loader.offset)
+        for name, column in data.to_columns():
+            self.assertEqual(dict(restored.to_columns())[name], column)
+
+        loader = utils.PresenceLoader()
+        self.assertEqual(loader.load(self.path, snapshot), data)
+        self.assertEqual(loader.offset, self.loader.offset)
+
+        self.write('\n12,2013-09-16,08:00:00,16:00:00\n')
+        self.assertEqual(
+            utils.PresenceLoader().load(self.path, snapshot),
+            utils.PresenceLoader().load(self.path)
+        )
+        self.assertIn(12, utils.PresenceLoader().load(self.path, snapshot))
+
+    def test_invalid_snapshot(self):
+        """
+        Test broken snapshots are ignored and rewritten.
+        """
+        snapshot = os.path.join(self.tmpdir, 'data.snapshot')
+        for content in ['', 'garbage', store.SNAPSHOT_MAGIC + '\n{}\n']:
+            with open(snapshot, 'w') as snapshot_file:
+                snapshot_file.write(content)
+            self.assertIsNone(store.load_snapshot(snapshot))
+            data = utils.PresenceLoader().load(self.path, snapshot)
+            self.assertEqual(store.load_snapshot(snapshot)[0], data)
+        self.assertIsNone(store.load_snapshot(snapshot + '.missing'))
+
+
+class XmlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for the intranet serving users.xml and avatars.
+    """
+    # pylint: disable=C0103
+
+    def do_GET(self):
+        """
+        Serves server.body, honouring If-None-Match.
+        """
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.delay:
+            time.sleep(server.delay)
+        if server.status != 200:
+            self.send_error(server.status)
+            return
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header(
+            'Content-Type', getattr(server, 'content_type', 'text/xml')
+        )
+        self.send_header('Content-Length', str(len(server.body)))
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, *args):
+        """
+        Keeps test output clean.
+        """
+
+
+class UpdateXmlTestCase(unittest.TestCase):
+    """
+    Users XML refresh tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.xml')
+        shutil.copy(TEST_DATA_XML, self.path)
+        with open(TEST_DATA_XML) as xmlfile:
+            self.original = xmlfile.read()
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), XmlHandler)
+        self.server.requests = []
+        self.server.status = 200
+        self.server.delay = 0
+        self.server.etag = '"v1"'
+        # clients hanging up after timeout aren't worth a traceback
+        self.server.handle_error = lambda request, address: None
+        self.server.body = self.original.replace('Adam P.', 'Adam Q.')
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.config = dict(main.app.config)
+        main.app.config.update({
+            'DATA_XML': self.path,
+            'DATA_XML_URL': 'http://127.0.0.1:%d/users.xml' % (
+                self.server.server_port
+            ),
+            'DATA_XML_TIMEOUT': 1,
+        })
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        main.app.config.clear()
+        main.app.config.update(self.config)
+        shutil.rmtree(self.tmpdir)
+
+    def read(self):
+        """
+        Returns current content of the users XML.
+        """
+        with open(self.path) as xmlfile:
+            return xmlfile.read()
+
+    def test_update(self):
+        """
+        Test file is replaced and unchanged document isn't downloaded.
+        """
+        self.assertTrue(utils.update_data_from_xml())
+        self.assertEqual(self.read(), self.server.body)
+        self.assertNotIn('If-None-Match', self.server.requests[0])
+
+        self.assertFalse(utils.update_data_from_xml())
+        self.assertEqual(self.server.requests[1]['if-none-match'], '"v1"')
+        self.assertEqual(self.read(), self.server.body)
+
+        self.server.etag = '"v2"'
+        self.server.body = self.original
+        self.assertTrue(utils.update_data_from_xml())
+        self.assertEqual(self.read(), self.original)
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir)), ['users.xml', 'users.xml.meta']
+        )
+
+    def test_permissions(self):
+        """
+        Test replaced file keeps permissions, a new one follows the umask.
+        """
+        os.chmod(self.path, 0640)
+        self.assertTrue(utils.update_data_from_xml())
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0640)
+
+        os.remove(self.path)
+        umask = os.umask(0077)
+        try:
+            self.assertTrue(utils.update_data_from_xml())
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0600)
+
+    def test_failures(self):
+        """
+        Test failed downloads leave the file intact.
+        """
+        self.server.status = 500
+        self.assertRaises(urllib2.HTTPError, utils.update_data_from_xml)
+        self.assertEqual(self.read(), self.original)
+
+        self.server.status = 200
+        self.server.body = '<intranet><users><user'
+        self.assertRaises(Exception, utils.update_data_from_xml)
+        self.assertEqual(self.read(), self.original)
+
+        self.server.delay = 1.5
+        self.assertRaises(IOError, utils.update_data_from_xml)
+        self.assertEqual(self.read(), self.original)
+        self.assertEqual(os.listdir(self.tmpdir), ['users.xml'])
+
+    def test_schedule(self):
+        """
+        Test refresh runs periodically until stopped.
+        """
+        self.server.status = 500
+        stop = utils.schedule_xml_update(0.05)
+        try:
+            for __ in xrange(100):
+                if len(self.server.requests) >= 2:
+                    break
+                time.sleep(0.05)
+            self.assertGreaterEqual(len(self.server.requests), 2)
+            self.assertEqual(self.read(), self.original)
+        finally:
+            stop.set()
+
+
+class GeneratorTestCase(unittest.TestCase):
+    """
+    Synthetic benchmark data tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = dict(main.app.config)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.clear()
+        main.app.config.update(self.config)
+        utils.CACHE = {}
+        shutil.rmtree(self.tmpdir)
+
+    def test_generate(self):
+        """
+        Test generated files are loaded like the real ones.
+        """
+        data_csv, data_xml = generator.generate(self.tmpdir, 12, 28)
+        self.assertEqual(
+            generator.generate(self.tmpdir, 12, 28), (data_csv, data_xml)
+        )
+        main.app.config.update({
+            'DATA_CSV': data_csv,
+            'DATA_XML': data_xml,
+            'DATA_SNAPSHOT': None,
+        })
+        utils.CACHE = {}
+        data = utils.get_data()
+        self.assertEqual(list(data), range(1, 13))
+        self.assertEqual(
+            data.rows_count, len(list(generator.presence_rows(12, 28)))
+        )
+        self.assertLessEqual(data.rows_count, 12 * 20)
+        for user_id in data:
+            for day in data[user_id]:
+                self.assertLess(day.weekday(), 5)
+        self.assertEqual(sorted(utils.get_data_from_xml()), range(1, 13))
+
+
+class MetricsTestCase(unittest.TestCase):
+    """
+    Metrics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.registry = list(metrics.REGISTRY)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        metrics.REGISTRY[:] = self.registry
+
+    def test_histogram(self):
+        """
+        Test observations are rendered as cumulative buckets.
+        """
+        histogram = metrics.Histogram(
+            'test_seconds', 'Test.', ['name'], buckets=[0.1, 1]
+        )
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.observe(value, 'a"b')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{name="a\\"b",le="0.1"} 2',
+            'test_seconds_bucket{name="a\\"b",le="1"} 3',
+            'test_seconds_bucket{name="a\\"b",le="+Inf"} 4',
+            'test_seconds_count{name="a\\"b"} 4',
+            'test_seconds_sum{name="a\\"b"} 5.65',
+        ])
+
+    def test_counter_and_gauge(self):
+        """
+        Test counters add up and gauges keep the last value.
+        """
+        counter = metrics.Counter('test_total', 'Test.', ['name'])
+        counter.inc('a')
+        counter.inc('a', amount=2)
+        gauge = metrics.Gauge('test_rows', 'Test.')
+        gauge.set(5)
+        gauge.set(3)
+        self.assertEqual(counter.samples(), ['test_total{name="a"} 3.0'])
+        self.assertEqual(gauge.samples(), ['test_rows 3.0'])
+        self.assertIn('test_rows 3.0\n', metrics.render())
+
+    def test_measured(self):
+        """
+        Test loads are timed and counted.
+        """
+        loaded = metrics.measured('test')(lambda: [1, 2, 3])
+        self.assertEqual(loaded(), [1, 2, 3])
+        self.assertEqual(metrics.LOAD_ROWS.values[('test',)], 3)
+        self.assertEqual(metrics.LOADS.values[('test',)], 1)
+
+
+class ProfilingTestCase(unittest.TestCase):
+    """
+    Request profiling tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = dict(main.app.config)
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+            'PROFILE_REQUESTS': True,
+            'PROFILE_DIR': os.path.join(self.tmpdir, 'profiles'),
+        })
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.clear()
+        main.app.config.update(self.config)
+        shutil.rmtree(self.tmpdir)
+
+    def profiles(self):
+        """
+        Returns paths of written stats.
+        """
+        directory = main.app.config['PROFILE_DIR']
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+        )
+
+    def test_opt_in(self):
+        """
+        Test only requests asking for it are profiled, if enabled.
+        """
+        self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(self.profiles(), [])
+        resp = self.client.get('/api/v1/presence_weekday?profile')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('"10"', resp.data)
+        self.assertEqual(len(self.profiles()), 1)
+        self.assertIn('api_v1_presence_weekday', self.profiles()[0])
+        stats = pstats.Stats(self.profiles()[0])
+        self.assertIn(
+            'presence_weekday',
+            [function for __, __, function in stats.stats]
+        )
+        self.client.get('/api/v1/users', headers={'X-Profile': '1'})
+        self.assertEqual(len(self.profiles()), 2)
+
+        main.app.config['PROFILE_REQUESTS'] = False
+        self.client.get('/api/v1/users?profile')
+        self.assertEqual(len(self.profiles()), 2)
+
+    def test_profile_requests(self):
+        """
+        Test scripted requests are profiled together.
+        """
+        profile = profiling.profile_requests(
+            main.app, profiling.SCRIPTED_REQUESTS, 2
+        )
+        functions = [
+            function for __, __, function in pstats.Stats(profile).stats
+        ]
+        self.assertIn('mean_time_weekday_view', functions)
+        self.assertIn('users_view', functions)
+        self.assertEqual(self.profiles(), [])
+
+
+class CompressionTestCase(unittest.TestCase):
+    """
+    Response compression and static files caching tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        self.client = main.app.test_client()
+        self.tmpdir = tempfile.mkdtemp()
+        # gzipped copies are written next to static files
+        self.static_folder = main.app.static_folder
+        self.static_tmpdir = tempfile.mkdtemp()
+        main.app.static_folder = os.path.join(self.static_tmpdir, 'static')
+        shutil.copytree(self.static_folder, main.app.static_folder,
+                        ignore=shutil.ignore_patterns('*.gz'))
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.static_folder = self.static_folder
+        shutil.rmtree(self.tmpdir)
+        shutil.rmtree(self.static_tmpdir)
+
+    def gunzip(self, data):
+        """
+        Returns decompressed gzip data.
+        """
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    def test_json(self):
+        """
+        Test JSON responses are gzipped for clients accepting it.
+        """
+        gzipped = {'Accept-Encoding': 'gzip'}
+        for url in ['/api/v1/presence_weekday', '/api/v1/occupancy']:
+            plain = self.client.get(url)
+            self.assertIsNone(plain.content_encoding)
+            self.assertIn('Accept-Encoding', plain.vary)
+            resp = self.client.get(url, headers=gzipped)
+            self.assertEqual(resp.content_encoding, 'gzip')
+            self.assertEqual(self.gunzip(resp.data), plain.data)
+            self.assertLess(len(resp.data), len(plain.data))
+
+        # the same weak tag for both encodings and 304 responses
+        self.assertEqual(resp.headers['ETag'], plain.headers['ETag'])
+        self.assertTrue(resp.get_etag()[1])
+        for headers in [{}, gzipped]:
+            not_modified = self.client.get(url, headers=dict(
+                headers, **{'If-None-Match': resp.headers['ETag']}
+            ))
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.data, '')
+            self.assertEqual(not_modified.headers['ETag'],
+                             resp.headers['ETag'])
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10',
+                               headers=gzipped)
+        self.assertIsNone(resp.content_encoding)
+
+    def test_static(self):
+        """
+        Test versioned static files are cached for long, and gzipped.
+        """
+        page = self.client.get('/presence_weekday')
+        with main.app.test_request_context():
+            url = helpers.static_url('js/jquery.min.js')
+        self.assertIn(url, page.data)
+        self.assertIn('?v=', url)
+        with open(os.path.join(main.app.static_folder, 'js',
+                               'jquery.min.js')) as static_file:
+            content = static_file.read()
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.data, content)
+        self.assertEqual(resp.cache_control.max_age, helpers.STATIC_MAX_AGE)
+        self.assertIsNone(resp.content_encoding)
+        resp = self.client.get(url.split('?')[0] + '?v=old')
+        self.assertLess(resp.cache_control.max_age, helpers.STATIC_MAX_AGE)
+
+        helpers.compress_static()
+        self.assertFalse([
+            name for _, _, files in os.walk(self.static_folder)
+            for name in files if name.endswith('.gz')
+        ])
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.content_encoding, 'gzip')
+        self.assertEqual(resp.mimetype, self.client.get(url).mimetype)
+        self.assertEqual(self.gunzip(resp.data), content)
+        self.assertEqual(resp.cache_control.max_age, helpers.STATIC_MAX_AGE)
+        self.assertEqual(self.client.get('/static/../tests.py').status_code,
+                         404)
+
+    def test_compress_static(self):
+        """
+        Test gzipped copies are written for text files only, once.
+        """
+        for name in ['style.css', 'image.gif']:
+            with open(os.path.join(self.tmpdir, name), 'w') as static_file:
+                static_file.write('body {}' * 100)
+        path = os.path.join(self.tmpdir, 'style.css')
+        self.assertEqual(helpers.compress_static(self.tmpdir), [path + '.gz'])
+        with open(path + '.gz') as compressed:
+            self.assertEqual(self.gunzip(compressed.read()), 'body {}' * 100)
+        self.assertEqual(helpers.compress_static(self.tmpdir), [])
+
+
+class AvatarsTestCase(unittest.TestCase):
+    """
+    Avatar cache and proxy tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmpdir, 'avatars')
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), XmlHandler)
+        self.server.requests = []
+        self.server.status = 200
+        self.server.delay = 0
+        self.server.etag = '"v1"'
+        self.server.content_type = 'image/png'
+        self.server.body = 'png' * 100
+        self.server.handle_error = lambda request, address: None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/api/images/users/' % (
+            self.server.server_port
+        )
+
+        users_xml = os.path.join(self.tmpdir, 'users.xml')
+        with open(TEST_DATA_XML) as source:
+            with open(users_xml, 'w') as target:
+                target.write(source.read().replace(
+                    'intranet.stxnext.pl', '127.0.0.1'
+                ).replace(
+                    '<port>443</port>',
+                    '<port>%d</port>' % self.server.server_port
+                ).replace('https', 'http'))
+        self.config = dict(main.app.config)
+        main.app.config.update({
+            'DATA_XML': users_xml,
+            'AVATAR_CACHE_DIR': self.directory,
+            'AVATAR_TIMEOUT': 1,
+        })
+        utils.CACHE = {}
+        avatars.AVATAR_CACHES.clear()
+        self.client = main.app.test_client()
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        main.app.config.clear()
+        main.app.config.update(self.config)
+        utils.CACHE = {}
+        avatars.AVATAR_CACHES.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def cache(self, max_size=1000):
+        """
+        Returns avatar cache using the fake clock.
+        """
+        return avatars.AvatarCache(
+            self.directory, max_size, timeout=1, revalidate_after=100,
+            clock=self.clock,
+        )
+
+    def test_view(self):
+        """
+        Test avatar is fetched once and served with validators.
+        """
+        users = json.loads(self.client.get('/api/v1/users').data)
+        resp = self.client.get(users[0]['avatar'])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, self.server.body)
+        self.assertEqual(resp.content_type, 'image/png')
+        self.assertTrue(resp.cache_control.public)
+        self.assertEqual(resp.cache_control.max_age, 3600)
+        etag = resp.headers['ETag']
+        resp = self.client.get('/api/images/users/141')
+        self.assertEqual(resp.data, self.server.body)
+        self.assertEqual(len(self.server.requests), 1)
+        resp = self.client.get('/api/images/users/141',
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertTrue(
+            os.path.exists(os.path.join(self.directory, '141'))
+        )
+
+    def test_placeholder(self):
+        """
+        Test placeholder is served while the avatar can't be fetched.
+        """
+        self.server.status = 500
+        resp = self.client.get('/api/images/users/141')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/svg+xml')
+        self.assertEqual(resp.cache_control.max_age, 60)
+        self.client.get('/api/images/users/141')
+        # failures aren't retried right away
+        self.assertEqual(len(self.server.requests), 1)
+        resp = self.client.get('/api/images/users/1')
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.mimetype, 'image/svg+xml')
+
+        self.server.status = 200
+        self.server.content_type = 'text/html'
+        self.assertIsNone(self.cache().get(176, self.url + '176'))
+
+    def test_eviction(self):
+        """
+        Test least recently used avatars are evicted over the size limit.
+        """
+        cache = self.cache(max_size=900)
+        for user_id in [1, 2, 3]:
+            cache.get(user_id, self.url + str(user_id))
+            self.clock.now += 1
+        cache.get(1, self.url + '1')
+        cache.get(4, self.url + '4')
+        self.assertEqual(list(cache.entries), [3, 1, 4])
+        self.assertEqual(cache.size, 900)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ['1', '1.json', '3', '3.json', '4', '4.json'],
+        )
+        # avatars survive restarts, oldest checked first
+        self.assertEqual(list(self.cache(max_size=900).entries), [1, 3, 4])
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_revalidate(self):
+        """
+        Test stale avatars are served while revalidated in background.
+        """
+        cache = self.cache()
+        cache.get(141, self.url + '141')
+        self.clock.now += 101
+        self.server.body = 'gif' * 100
+        self.server.etag = '"v2"'
+        entry, content = cache.get(141, self.url + '141')
+        self.assertEqual(content, 'png' * 100)
+        deadline = time.time() + 5
+        while cache.revalidating and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.requests[-1]['if-none-match'], '"v1"')
+        entry, content = cache.get(141, self.url + '141')
+        self.assertEqual(content, 'gif' * 100)
+
+        self.clock.now += 101
+        cache.get(141, self.url + '141')
+        deadline = time.time() + 5
+        while cache.revalidating and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(cache.entries[141].checked, self.clock.now)
+        self.assertEqual(cache.get(141, self.url + '141')[1], 'gif' * 100)
+
 
 def suite():
     """
@@ -346,6 +2400,19 @@ def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    suite.addTest(unittest.makeSuite(AggregatesModeTestCase))
+    suite.addTest(unittest.makeSuite(SqliteBackendTestCase))
+    suite.addTest(unittest.makeSuite(PartitionsTestCase))
+    suite.addTest(unittest.makeSuite(PreforkTestCase))
+    suite.addTest(unittest.makeSuite(CacheTestCase))
+    suite.addTest(unittest.makeSuite(PresenceStoreTestCase))
+    suite.addTest(unittest.makeSuite(PresenceLoaderTestCase))
+    suite.addTest(unittest.makeSuite(UpdateXmlTestCase))
+    suite.addTest(unittest.makeSuite(GeneratorTestCase))
+    suite.addTest(unittest.makeSuite(MetricsTestCase))
+    suite.addTest(unittest.makeSuite(ProfilingTestCase))
+    suite.addTest(unittest.makeSuite(CompressionTestCase))
+    suite.addTest(unittest.makeSuite(AvatarsTestCase))
     return suite
 
 
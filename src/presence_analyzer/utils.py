@@ -4,34 +4,180 @@ Helper functions used in views.
 """
 
 import csv
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import zlib
+from array import array
+from bisect import bisect_right
+from cStringIO import StringIO
 from json import dumps
 from functools import wraps
-from datetime import datetime
-from flask import Response
+from itertools import islice, izip
+from datetime import date, datetime
+from flask import Response, request
+from presence_analyzer import metrics
+from presence_analyzer.database import SqliteStore, connect, insert_rows
+from presence_analyzer.database import read_import_state, transaction
+from presence_analyzer.database import write_import_state
 from presence_analyzer.main import app
+from presence_analyzer.partitions import PartitionedStore, partition_paths
+from presence_analyzer.store import AggregateStore, DaySet, PresenceStore
+from presence_analyzer.store import RepeatedEntry, weekday
+from presence_analyzer.store import load_snapshot, save_snapshot
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=C0103
 from lxml import etree
 import urllib2
 import threading
 import time
-from collections import OrderedDict
-import locale
+from collections import OrderedDict, namedtuple
+import unicodedata
 CACHE = {}
+CACHE_STATS = {}
+CACHE_FROZEN = set()
+JSON_CACHE = {}
+JSON_CACHE_SIZE = 10000
+GZIP_CACHE = {}
+GZIP_CACHE_SIZE = 1000
+GZIP_MIN_SIZE = 512
 
 
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped
     function result.
+
+    Serialized results are kept per endpoint, arguments and query string
+    until presence data is reloaded, which drops all of them at once.
     """
     @wraps(function)
     def inner(*args, **kwargs):  # pylint: disable=C0111
-        return Response(dumps(function(*args, **kwargs)),
-                        mimetype='application/json')
+        generation = get_data().generation
+        if JSON_CACHE.get('generation') != generation \
+                or len(JSON_CACHE) > JSON_CACHE_SIZE:
+            JSON_CACHE.clear()
+            JSON_CACHE['generation'] = generation
+        key = (
+            function.__name__,
+            args,
+            tuple(sorted(kwargs.items())),
+            request.query_string,
+        )
+        cached = JSON_CACHE.get(key)
+        if cached is None:
+            body = dumps(function(*args, **kwargs))
+            cached = (body, etag_of(body))
+            # data may have been reloaded meanwhile by another thread
+            if JSON_CACHE.get('generation') == generation:
+                JSON_CACHE[key] = cached
+        return json_response(*cached)
     return inner
 
 
+def etag_of(body):
+    """
+    Returns strong ETag of response body.
+    """
+    return hashlib.sha1(body).hexdigest()
+
+
+def stream_json_object(items):
+    """
+    Yields JSON object built from (key, value) pairs piece by piece.
+    """
+    yield '{'
+    for i, (key, value) in enumerate(items):
+        separator = ', ' if i else ''
+        yield '{}{}: {}'.format(separator, dumps(str(key)), dumps(value))
+    yield '}'
+
+
+def json_response(body, etag):
+    """
+    Creates JSON response tagged with given ETag.
+
+    Requests with matching If-None-Match get 304 Not Modified.
+    """
+    return conditional_response(body, etag, 'application/json')
+
+
+def conditional_response(body, etag, mimetype):
+    """
+    Creates response tagged with given ETag, 304 Not Modified for
+    requests with matching If-None-Match.
+    """
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def gzip_body(body):
+    """
+    Returns gzipped body, the same for the same input.
+    """
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6, mtime=0) \
+            as compressed:
+        compressed.write(body)
+    return buf.getvalue()
+
+
+def gzip_stream(chunks):
+    """
+    Gzips streamed body chunk by chunk.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+@app.after_request
+def compress_json(response):
+    """
+    Gzips JSON responses for clients accepting it.
+
+    Compressed bodies are kept by ETag, so cached responses are
+    compressed once. The ETag is made weak, as the representation
+    differs while the content is the same; plain and 304 responses get
+    the same weak tag, so caches revalidate either of them.
+    """
+    if response.mimetype != 'application/json':
+        return response
+    response.vary.add('Accept-Encoding')
+    etag = response.get_etag()[0]
+    if etag:
+        response.set_etag(etag, weak=True)
+    if response.status_code != 200 or response.content_encoding \
+            or not request.accept_encodings['gzip']:
+        return response
+    if response.is_streamed:
+        response.response = gzip_stream(response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < GZIP_MIN_SIZE:
+            return response
+        compressed = GZIP_CACHE.get(etag)
+        if compressed is None:
+            compressed = gzip_body(body)
+            if etag:
+                if len(GZIP_CACHE) >= GZIP_CACHE_SIZE:
+                    GZIP_CACHE.clear()
+                GZIP_CACHE[etag] = compressed
+        response.set_data(compressed)
+    response.content_encoding = 'gzip'
+    return response
+
+
+@metrics.measured('xml')
 def get_data_from_xml():
     """
     Extracts data from XML file and groups it by user_id.
@@ -65,9 +211,8 @@ def get_data_from_xml():
                 'avatar': '{}://{}:{}{}'.format(protocol, host, port, avatar),
                 'name': name
             })
-    locale.setlocale(locale.LC_COLLATE, "pl_PL.UTF-8")
     sorted_data = OrderedDict(
-        sorted(data.items(), key=lambda(k, v): (v['name']), cmp=locale.strcoll)
+        sorted(data.items(), key=lambda(k, v): collation_key(v['name']))
     )
     return sorted_data
 
@@ -75,53 +220,625 @@ def get_data_from_xml():
 def update_data_from_xml():
     """
     Update xml file
+
+    The document is streamed into a temporary file next to DATA_XML and
+    renamed over it once complete and well-formed, so readers never see
+    a partial file. ETag and Last-Modified of the last download are kept
+    in DATA_XML + '.meta' and sent back, so an unchanged document costs
+    a single 304 response. Returns True when the file was replaced.
     """
-    with open(app.config['DATA_XML'], 'w') as xmlfile:
-        data = urllib2.urlopen(app.config['DATA_XML_URL'])
-        temp = data.read()
-        xmlfile.write(temp)
+    path = app.config['DATA_XML']
+    meta_path = path + '.meta'
+    meta = {}
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            try:
+                meta = json.load(meta_file)
+            except ValueError:
+                log.warning('Ignoring broken %s', meta_path)
+    download = urllib2.Request(app.config['DATA_XML_URL'])
+    if meta.get('etag'):
+        download.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        download.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        response = urllib2.urlopen(
+            download, timeout=app.config.get('DATA_XML_TIMEOUT', 30)
+        )
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            log.debug('%s not modified', app.config['DATA_XML_URL'])
+            return False
+        raise
+
+    temporary = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path) or '.',
+        prefix=os.path.basename(path) + '.',
+        delete=False,
+    )
+    try:
+        with temporary:
+            shutil.copyfileobj(response, temporary)
+        etree.parse(temporary.name)
+        os.chmod(temporary.name, replacement_mode(path))
+        os.rename(temporary.name, path)
+    except:
+        os.remove(temporary.name)
+        raise
+    finally:
+        response.close()
+
+    with open(meta_path, 'w') as meta_file:
+        json.dump({
+            'etag': response.info().getheader('ETag'),
+            'last_modified': response.info().getheader('Last-Modified'),
+        }, meta_file)
+    log.info('%s updated', path)
+    return True
 
 
-def locker(func):
+def replacement_mode(path):
     """
-    Lock thread when missing
+    Returns permission bits for a file replacing the one at ``path``:
+    the ones of that file, or the defaults left by the umask when there
+    is none yet.
     """
-    func.lock = threading.Lock()
+    try:
+        return os.stat(path).st_mode & 07777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0666 & ~umask
 
-    def wrap(*args, **kwargs):
-        """
-        Call acquire() method when block is entered,
-        release() when exited
-        """
-        with func.lock:
-            return func(*args, **kwargs)
-    return wrap
 
+def schedule_xml_update(interval):
+    """
+    Calls update_data_from_xml every ``interval`` seconds in a daemon
+    thread. Failures are logged and retried in the next round.
 
-def cache(key, expiration_time):
+    Returns event which stops the thread once set.
+    """
+    stopped = threading.Event()
+
+    def run():  # pylint: disable=C0111
+        while not stopped.wait(interval):
+            try:
+                update_data_from_xml()
+            except Exception:  # pylint: disable=W0703
+                log.exception('Updating users XML failed')
+
+    thread = threading.Thread(target=run, name='xml-update')
+    thread.daemon = True
+    thread.start()
+    return stopped
+
+
+def file_signature(path):
+    """
+    Returns (path, size, mtime) of given file, None if it's missing.
+
+    For a directory or glob of partition files, see ``partition_paths``,
+    returns a tuple of signatures of all of them.
+    """
+    paths = partition_paths(path)
+    if paths is not None:
+        return tuple(file_signature(partition) for partition in paths)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return path, stat.st_size, stat.st_mtime
+
+
+def prefix_checksum(csvfile, size):
+    """
+    Returns CRC-32 of the first ``size`` bytes of given file, the same
+    as of all its lines consumed by PresenceLoader.
+    """
+    csvfile.seek(0)
+    checksum = 0
+    while size > 0:
+        block = csvfile.read(min(size, 1 << 20))
+        if not block:
+            break
+        checksum = zlib.crc32(block, checksum)
+        size -= len(block)
+    return checksum
+
+
+CacheEntry = namedtuple(
+    'CacheEntry', ['data', 'time', 'source', 'refreshing']
+)
+
+
+def cache(key, expiration_time, source=None, clock=time.time):
     """
     Cache for data from CSV file.
+
+    Result is reloaded after ``expiration_time`` seconds or as soon as
+    mtime or size of the file returned by ``source`` callable changes.
+    Only the first call waits for the data, later on the stale result is
+    served while a single background thread reloads it. Hits, misses and
+    refreshes are counted in CACHE_STATS. Entries of keys added to
+    CACHE_FROZEN are never refreshed, whoever froze them reloads them.
+
+    Entries are immutable and replaced as a whole, so readers take no
+    lock: they use whichever complete entry is in CACHE at the moment.
     """
+    stats = CACHE_STATS.setdefault(
+        key, {'hits': 0, 'misses': 0, 'refreshes': 0}
+    )
+    load_lock = threading.Lock()
+    refresh_lock = threading.Lock()
+
+    def signature():  # pylint: disable=C0111
+        return file_signature(source()) if source is not None else None
+
     def wrap(func):
+        def refresh(entry, args, kwargs):
+            """
+            Builds the next entry off to the side and swaps it in.
+            """
+            source_signature = signature()
+            try:
+                data = func(*args, **kwargs)
+            except Exception:  # pylint: disable=W0703
+                log.exception('Reloading cache %r failed', key)
+                # serve stale data until it expires or changes again
+                data = entry.data
+            else:
+                stats['refreshes'] += 1
+            CACHE[key] = CacheEntry(data, clock(), source_signature, None)
+
+        def load(args, kwargs):
+            """
+            Loads missing entry, once for all threads asking for it.
+            """
+            with load_lock:
+                entry = CACHE.get(key)
+                if entry is None:
+                    stats['misses'] += 1
+                    source_signature = signature()
+                    entry = CACHE[key] = CacheEntry(
+                        func(*args, **kwargs), clock(), source_signature, None
+                    )
+                return entry.data
+
+        @wraps(func)
         def wrap_cache(*args, **kwargs):
-            if key in CACHE and time.time() - CACHE[key]['time']:
-                    return CACHE[key]['data']
-            CACHE[key] = {
-                'data': func(*args, **kwargs),
-                'time': time.time()
-            }
-            return CACHE[key]['data']
+            entry = CACHE.get(key)
+            if entry is None:
+                return load(args, kwargs)
+
+            stats['hits'] += 1
+            if key in CACHE_FROZEN:
+                return entry.data
+            expired = (
+                clock() - entry.time > expiration_time or
+                entry.source != signature()
+            )
+            if expired and entry.refreshing is None:
+                with refresh_lock:
+                    if CACHE.get(key) is entry:
+                        thread = threading.Thread(
+                            target=refresh,
+                            args=(entry, args, kwargs),
+                            name='cache-refresh-{}'.format(key),
+                        )
+                        thread.daemon = True
+                        CACHE[key] = entry._replace(refreshing=thread)
+                        thread.start()
+            return entry.data
         return wrap_cache
     return wrap
 
 
-@locker
-@cache('cache', 200)
+class PresenceLoader(object):
+    """
+    Loads presence data from CSV file, re-parsing only appended bytes.
+
+    The file is expected to only grow. The loader remembers how many
+    bytes it consumed along with inode, size and mtime of the file, the
+    last consumed bytes and CRC-32 of all of them; the data is rebuilt
+    from scratch whenever the file was replaced, truncated or rewritten.
+    Telling an append from an in-place edit of earlier rows reads the
+    consumed bytes again, which is much cheaper than parsing them. The
+    last bytes are compared first, so most rewrites are caught without
+    reading the file.
+    """
+    tail_size = 64
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = None
+        self.path = None
+        self.stat = None
+        self.offset = 0
+        self.tail = ''
+        self.checksum = 0
+
+    def load(self, path, snapshot=None, workers=1, mode='full'):
+        """
+        Returns PresenceStore with current contents of given CSV file.
+
+        When ``snapshot`` path is given, loading from scratch starts with
+        the binary snapshot of parsed data, if it's still valid, and the
+        snapshot is rewritten after a full parse. Full parse is split
+        between given number of worker processes.
+
+        In ``'aggregates'`` mode the file is streamed into an
+        AggregateStore instead, snapshot and workers don't apply then.
+        """
+        with self.lock:
+            return self._load(path, snapshot, workers, mode)
+
+    def _load(self, path, snapshot, workers, mode):
+        """
+        Loads given file, the caller has to hold the lock.
+        """
+        store_class = AggregateStore if mode == 'aggregates' else \
+            PresenceStore
+        if not isinstance(self.data, store_class):
+            self.data = None
+            self.stat = None
+        if store_class is AggregateStore:
+            snapshot = None
+            workers = 1
+        stat = os.stat(path)
+        if self.data is not None and path == self.path \
+                and self._same_stat(stat):
+            return self.data
+        with open(path, 'rb') as csvfile:
+            try:
+                self._read(path, stat, csvfile, snapshot, workers,
+                           store_class)
+            except RepeatedEntry as error:
+                log.debug('Entry of user %s of day %s repeated, '
+                          'aggregating the file again', *error.args)
+                self.data = self._aggregate_latest(csvfile)
+        self.path = path
+        self.stat = stat
+        return self.data
+
+    def _read(self, path, stat, csvfile, snapshot, workers, store_class):
+        """
+        Reads appended bytes or the whole file into ``self.data``.
+        """
+        if self._appended(path, stat, csvfile):
+            csvfile.seek(self.offset)
+            self.data = self.data.merge(self._consume(csvfile))
+        elif snapshot and self._restore(snapshot, stat, csvfile):
+            log.debug('Presence data restored from %s', snapshot)
+            csvfile.seek(self.offset)
+            self.data = self.data.merge(self._consume(csvfile))
+        else:
+            csvfile.seek(0)
+            self.offset = 0
+            self.tail = ''
+            self.checksum = 0
+            if workers > 1:
+                self.data = self._consume_parallel(
+                    path, stat.st_size, csvfile, workers
+                )
+            else:
+                self.data = store_class.from_rows(self._consume(csvfile))
+            if snapshot:
+                self._save(snapshot, stat)
+
+    def _aggregate_latest(self, csvfile):
+        """
+        Streams the whole file into AggregateStore in two passes, the
+        first one finds the last entry of every repeated user and day,
+        the second one skips all entries of it but the last.
+        """
+        csvfile.seek(0)
+        days = {}
+        latest = {}
+        rows_count = 0
+        for user_id, day, _, _ in parse_rows(csv.reader(csvfile)):
+            if not days.setdefault(user_id, DaySet()).add(day):
+                latest[user_id, day] = rows_count
+            rows_count += 1
+        del days
+
+        def last_entries(rows):  # pylint: disable=C0111
+            for i, row in enumerate(rows):
+                if latest.get(row[:2], i) == i:
+                    yield row
+
+        csvfile.seek(0)
+        self.offset = 0
+        self.tail = ''
+        self.checksum = 0
+        # rows appended meanwhile are merged with the next load
+        return AggregateStore.from_rows(
+            last_entries(islice(self._consume(csvfile), rows_count))
+        )
+
+    def _restore(self, snapshot, stat, csvfile):
+        """
+        Loads data from snapshot of given file, or of its beginning.
+        """
+        loaded = load_snapshot(snapshot)
+        if loaded is None or 'checksum' not in loaded[1]:
+            return False
+        data, meta = loaded
+        offset = meta.get('offset', 0)
+        tail = meta.get('tail', '').decode('hex')
+        unchanged = (meta.get('size'), meta.get('mtime')) == (
+            stat.st_size, stat.st_mtime
+        )
+        if not unchanged:
+            # the file might have been appended to since
+            if stat.st_size < offset:
+                return False
+            csvfile.seek(offset - len(tail))
+            if csvfile.read(len(tail)) != tail:
+                return False
+            if prefix_checksum(csvfile, offset) != meta['checksum']:
+                return False
+        self.data, self.offset, self.tail = data, offset, tail
+        self.checksum = meta['checksum']
+        return True
+
+    def _save(self, snapshot, stat):
+        """
+        Writes current data to snapshot, failures are only logged.
+        """
+        try:
+            save_snapshot(self.data, snapshot, {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'offset': self.offset,
+                'tail': self.tail.encode('hex'),
+                'checksum': self.checksum,
+            })
+        except (IOError, OSError):
+            log.warning('Writing snapshot %s failed', snapshot, exc_info=True)
+
+    def _same_stat(self, stat):
+        """
+        Checks whether file wasn't touched since the last load.
+        """
+        return (stat.st_ino, stat.st_size, stat.st_mtime) == (
+            self.stat.st_ino, self.stat.st_size, self.stat.st_mtime
+        )
+
+    def _appended(self, path, stat, csvfile):
+        """
+        Checks whether file was only appended to since the last load.
+        """
+        if self.stat is None or path != self.path:
+            return False
+        if stat.st_ino != self.stat.st_ino or stat.st_size < self.offset:
+            return False
+        csvfile.seek(self.offset - len(self.tail))
+        if csvfile.read(len(self.tail)) != self.tail:
+            return False
+        return prefix_checksum(csvfile, self.offset) == self.checksum
+
+    def _consume(self, csvfile):
+        """
+        Lazily parses the file from current position to the end.
+        """
+        log.debug('Parsing presence data from byte %d', csvfile.tell())
+        return parse_rows(csv.reader(self._lines(csvfile), delimiter=','))
+
+    def _lines(self, csvfile):
+        """
+        Yields lines of the file, keeping track of consumed bytes.
+
+        Only complete lines count as consumed, an unterminated last line
+        is parsed again on the next load.
+        """
+        for line in iter(csvfile.readline, ''):
+            if line.endswith('\n'):
+                self.offset += len(line)
+                self.tail = (self.tail + line)[-self.tail_size:]
+                self.checksum = zlib.crc32(line, self.checksum)
+            yield line
+
+    def _consume_parallel(self, path, size, csvfile, workers):
+        """
+        Parses the whole file in a pool of worker processes.
+
+        The file is split into byte ranges starting at line boundaries
+        and users into ranges of about the same number of rows, see
+        ``user_bounds``. Every worker first parses a range of bytes,
+        sorting rows by range of users, then builds PresenceStore of a
+        range of users out of its rows from all byte ranges, in file
+        order. Stores of consecutive users only need to be concatenated,
+        giving the same result as _consume.
+        """
+        bounds = [0]
+        for i in xrange(1, workers):
+            csvfile.seek(max(size * i // workers, bounds[-1]))
+            csvfile.readline()
+            bounds.append(csvfile.tell())
+        bounds.append(size)
+        users = user_bounds(csvfile, size, workers)
+        ranges = [(path, begin, end, users)
+                  for begin, end in zip(bounds, bounds[1:]) if begin < end]
+        log.debug('Parsing %d bytes of presence data in %d processes',
+                  size, len(ranges))
+        pool = multiprocessing.Pool(max(len(ranges), 1))
+        try:
+            parsed = pool.map(parse_range, ranges)
+            parts = pool.map(build_users, [
+                [rows[i] for rows in parsed] for i in xrange(len(users) + 1)
+            ])
+        finally:
+            pool.close()
+            pool.join()
+
+        # remember the last complete line, like _consume does
+        csvfile.seek(max(size - 65536, 0))
+        block = csvfile.read()
+        newline = block.rfind('\n')
+        if newline >= 0:
+            consumed = size - len(block) + newline + 1
+            self.offset = consumed
+            csvfile.seek(max(consumed - self.tail_size, 0))
+            self.tail = csvfile.read(consumed - csvfile.tell())
+            self.checksum = prefix_checksum(csvfile, consumed)
+        return PresenceStore.concatenate([
+            PresenceStore.from_columns({
+                name: array(typecode, content)
+                for name, typecode, content in part
+            }) for part in parts
+        ])
+
+
+def user_bounds(csvfile, size, parts, samples=1000):
+    """
+    Returns sorted user ids splitting users of CSV file into at most
+    ``parts`` ranges of about the same number of rows, estimated from
+    lines sampled at even intervals. Range ``i`` holds users from
+    ``bounds[i - 1]`` up to, without, ``bounds[i]``.
+    """
+    user_ids = []
+    for i in xrange(samples):
+        csvfile.seek(size * i // samples)
+        if i:
+            csvfile.readline()
+        user_id = csvfile.readline().split(',', 1)[0]
+        if user_id.isdigit():
+            user_ids.append(int(user_id))
+    user_ids.sort()
+    return sorted(set(
+        user_ids[len(user_ids) * i // parts] for i in xrange(1, parts)
+    )) if user_ids else []
+
+
+def parse_range(task):
+    """
+    Parses CSV lines within (path, begin, end, bounds) range into flat
+    arrays of (user_id, day, start, end) rows, one for every range of
+    users split by ``bounds``, see ``user_bounds``.
+
+    Runs in worker processes, so arrays are returned as strings.
+    """
+    path, begin, end, bounds = task
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(begin)
+        chunk = csvfile.read(end - begin)
+    parts = [array('i') for _ in xrange(len(bounds) + 1)]
+    for row in parse_rows(csv.reader(chunk.splitlines(), delimiter=',')):
+        parts[bisect_right(bounds, row[0])].extend(row)
+    return [part.tostring() for part in parts]
+
+
+def build_users(parts):
+    """
+    Builds PresenceStore of a range of users out of flat arrays of rows,
+    see ``parse_range``, of consecutive ranges of the file.
+
+    Runs in worker processes, so arrays are returned as strings.
+    """
+    rows = array('i')
+    for part in parts:
+        rows.fromstring(part)
+    data = PresenceStore.from_rows(izip(*[iter(rows)] * 4))
+    return [(name, column.typecode, column.tostring())
+            for name, column in data.to_columns()]
+
+
+PRESENCE_LOADER = PresenceLoader()
+
+FileStat = namedtuple('FileStat', 'st_ino st_size st_mtime')
+
+
+class SqliteLoader(PresenceLoader):
+    """
+    Imports presence data from CSV file into SQLite database.
+
+    How much of which file was imported is kept in the database next to
+    the rows, so any process picks up where the last import stopped and
+    only appended bytes are parsed, like in PresenceLoader. Imports hold
+    the database write lock, so processes sharing it don't import the
+    same bytes twice.
+    """
+
+    def __init__(self):
+        super(SqliteLoader, self).__init__()
+        self.database = None
+
+    def load(self, path, database):
+        """
+        Returns SqliteStore of given database, importing whatever was
+        added to given CSV file first.
+        """
+        with self.lock:
+            stat = os.stat(path)
+            if self.data is None or database != self.database \
+                    or path != self.path or not self._same_stat(stat):
+                self._import(path, database, stat)
+            return self.data
+
+    def _import(self, path, database, stat):
+        """
+        Brings the database up to date with the file.
+        """
+        connection = connect(database)
+        with transaction(connection):
+            self._restore_state(connection)
+            if path != self.path or not self._same_stat(stat):
+                with open(path, 'rb') as csvfile:
+                    if not self._appended(path, stat, csvfile):
+                        log.debug('Importing %s into %s', path, database)
+                        connection.execute('DELETE FROM presence')
+                        self.offset = 0
+                        self.tail = ''
+                        self.checksum = 0
+                    csvfile.seek(self.offset)
+                    insert_rows(connection, self._consume(csvfile))
+                write_import_state(
+                    connection, path, stat, self.offset, self.tail,
+                    self.checksum
+                )
+        self.path = path
+        self.stat = FileStat(stat.st_ino, stat.st_size, stat.st_mtime)
+        self.database = database
+        self.data = SqliteStore(database)
+
+    def _restore_state(self, connection):
+        """
+        Reads import state, it might have been changed by other process.
+        """
+        state = read_import_state(connection)
+        if state is None:
+            self.path = self.stat = None
+            self.offset = 0
+            self.tail = ''
+            self.checksum = 0
+        else:
+            self.path = state['path']
+            self.stat = FileStat(
+                state['inode'], state['size'], state['mtime']
+            )
+            self.offset = state['offset']
+            self.tail = str(state['tail'])
+            self.checksum = state['checksum']
+
+    def _same_stat(self, stat):
+        """
+        Checks whether file wasn't touched since the last import.
+        """
+        return self.stat is not None and \
+            super(SqliteLoader, self)._same_stat(stat)
+
+
+SQLITE_LOADER = SqliteLoader()
+PARTITION_LOADERS = {}
+
+
+@cache('cache', 200, source=lambda: app.config['DATA_CSV'])
+@metrics.measured('csv', rows=lambda data: data.rows_count)
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
 
-    It creates structure like this:
+    It creates a PresenceStore which can be used like this:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
@@ -134,38 +851,244 @@ def get_data():
             },
         }
     }
+
+    With ``DATA_BACKEND`` set to ``'sqlite'`` the file is imported into
+    DATA_SQLITE database instead and SqliteStore answers the same way.
+    When DATA_CSV is a directory or glob of partition files, a
+    PartitionedStore of them is returned, see ``load_partitions``.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
-
-            data.setdefault(user_id, {})[date] = {
-                'start': start,
-                'end': end
-            }
+    if app.config.get('DATA_BACKEND', 'memory') == 'sqlite':
+        return SQLITE_LOADER.load(
+            app.config['DATA_CSV'], app.config['DATA_SQLITE']
+        )
+    paths = partition_paths(app.config['DATA_CSV'])
+    if paths is not None:
+        return load_partitions(paths)
+    return PRESENCE_LOADER.load(
+        app.config['DATA_CSV'],
+        app.config.get('DATA_SNAPSHOT'),
+        app.config.get('DATA_CSV_WORKERS', 1),
+        app.config.get('DATA_MODE', 'full'),
+    )
+
+
+def load_partition(path):
+    """
+    Returns PresenceStore of partition file, reloaded only when changed.
+    """
+    loader = PARTITION_LOADERS.get(path)
+    if loader is None:
+        loader = PARTITION_LOADERS.setdefault(path, PresenceLoader())
+    return loader.load(path)
+
+
+def load_partitions(paths):
+    """
+    Returns PartitionedStore of given partition files.
+
+    Every partition has its own PresenceLoader, so only changed files
+    are parsed again, and only their appended lines if possible.
+    Partitions loaded before are brought up to date right away, others
+    are left for the first request needing them. Snapshots, workers and
+    aggregates-only mode don't apply to partitions.
+    """
+    for path in set(PARTITION_LOADERS).difference(paths):
+        PARTITION_LOADERS.pop(path, None)
+    data = PartitionedStore(paths, load_partition)
+    for i, path in enumerate(paths):
+        loader = PARTITION_LOADERS.get(path)
+        if loader is not None and loader.data is not None:
+            data.partition(i)
     return data
 
 
+def build_snapshot():
+    """
+    Parses DATA_CSV from scratch and writes its DATA_SNAPSHOT.
+
+    Snapshot is written next to DATA_CSV when DATA_SNAPSHOT isn't set.
+    Returns snapshot path.
+    """
+    path = app.config['DATA_CSV']
+    snapshot = app.config.get('DATA_SNAPSHOT') or path + '.snapshot'
+    if os.path.exists(snapshot):
+        os.remove(snapshot)
+    PresenceLoader().load(path, snapshot)
+    return snapshot
+
+
+@metrics.collector
+def cache_metrics():
+    """
+    Exposes hits, misses and refreshes of cached data.
+    """
+    lines = []
+    for event in ['hits', 'misses', 'refreshes']:
+        name = 'presence_analyzer_cache_{}_total'.format(event)
+        lines.extend([
+            '# HELP {} Cache {} by cache key.'.format(name, event),
+            '# TYPE {} counter'.format(name),
+        ])
+        for key, stats in sorted(CACHE_STATS.items()):
+            lines.append('{}{} {}'.format(
+                name, metrics.format_labels(['cache'], [key]), stats[event]
+            ))
+    return lines
+
+
+AVATAR_URL = '/api/images/users/{}'
+UsersDirectory = namedtuple('UsersDirectory', ['users', 'json', 'etag'])
+
+
+@cache('users', 600, source=lambda: app.config['DATA_XML'])
+def get_users_directory():
+    """
+    Parses users once and keeps them with serialized dropdown listing.
+
+    Users are the sorted mapping returned by get_data_from_xml. Avatars
+    in the listing point at the local avatar cache, see ``avatar_view``.
+    """
+    users = get_data_from_xml()
+    listing = dumps([{
+        'user_id': user_id,
+        'avatar': AVATAR_URL.format(user_id),
+        'name': details['name']
+    } for user_id, details in users.iteritems()])
+    return UsersDirectory(users, listing, etag_of(listing))
+
+
+POLISH_ALPHABET = u'aąbcćdeęfghijklłmnńoópqrsśtuvwxyzźż'
+COLLATION_ORDER = dict(
+    [(letter, i) for i, letter in enumerate(POLISH_ALPHABET, 10)] +
+    [(unicode(digit), digit) for digit in range(10)]
+)
+
+
+def collation_key(name):
+    """
+    Returns key sorting names in Polish alphabetical order.
+
+    Letters are compared first, regardless of case and punctuation, then
+    the lowercase and finally the original names. Unlike locale.strcoll
+    it doesn't depend on process-global locale settings.
+    """
+    name = unicode(name)
+    lowered = name.lower()
+    letters = []
+    for char in lowered:
+        if char not in COLLATION_ORDER:
+            # letters outside of Polish alphabet sort as their base letter
+            char = unicodedata.normalize('NFD', char)[0]
+        if char in COLLATION_ORDER:
+            letters.append(COLLATION_ORDER[char])
+        elif char.isalnum():
+            letters.append(len(COLLATION_ORDER) + ord(char))
+    return letters, lowered, name
+
+
+def parse_rows(presence_reader):
+    """
+    Yields (user_id, day ordinal, start, end) tuples from CSV rows.
+
+    Dates and times are fixed-width, so they are sliced instead of going
+    through datetime.strptime and every distinct string is converted
+    only once. Rows the fast path can't handle go through
+    parse_row_strict.
+    """
+    days = {}
+    seconds = {}
+    for i, row in enumerate(presence_reader):
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+        try:
+            day = days[row[1]]
+        except KeyError:
+            if len(days) > 4096:
+                # keep memory flat for long histories
+                days.clear()
+            day = days[row[1]] = parse_day(row[1])
+        try:
+            start = seconds[row[2]]
+        except KeyError:
+            start = seconds[row[2]] = parse_seconds(row[2])
+        try:
+            end = seconds[row[3]]
+        except KeyError:
+            end = seconds[row[3]] = parse_seconds(row[3])
+        try:
+            user_id = int(row[0])
+        except ValueError:
+            user_id = None
+
+        if None in (user_id, day, start, end):
+            parsed = parse_row_strict(row, i)
+            if parsed is not None:
+                yield parsed
+        else:
+            yield user_id, day, start, end
+
+
+def parse_row_strict(row, line):
+    """
+    Parses CSV row with datetime.strptime.
+
+    Returns None and logs the problem for invalid rows.
+    """
+    try:
+        user_id = int(row[0])
+        day = datetime.strptime(row[1], '%Y-%m-%d').date()
+        start = datetime.strptime(row[2], '%H:%M:%S').time()
+        end = datetime.strptime(row[3], '%H:%M:%S').time()
+    except (ValueError, TypeError):
+        log.debug('Problem with line %d: ', line, exc_info=True)
+        return None
+
+    return (
+        user_id,
+        day.toordinal(),
+        seconds_since_midnight(start),
+        seconds_since_midnight(end),
+    )
+
+
+def parse_day(text):
+    """
+    Converts YYYY-MM-DD string to day ordinal, None if it doesn't fit.
+    """
+    if len(text) != 10 or text[4] != '-' or text[7] != '-':
+        return None
+    if not (text[:4] + text[5:7] + text[8:]).isdigit():
+        return None
+    try:
+        return date(int(text[:4]), int(text[5:7]), int(text[8:])).toordinal()
+    except ValueError:
+        return None
+
+
+def parse_seconds(text):
+    """
+    Converts HH:MM:SS string to seconds since midnight.
+
+    Returns None if it doesn't fit.
+    """
+    if len(text) != 8 or text[2] != ':' or text[5] != ':':
+        return None
+    if not (text[:2] + text[3:5] + text[6:]).isdigit():
+        return None
+    hour, minute, second = int(text[:2]), int(text[3:5]), int(text[6:])
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    return hour * 3600 + minute * 60 + second
+
+
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
     """
     result = {i: [] for i in range(7)}
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for day, start, end in items.rows():
+        result[weekday(day)].append(end - start)
     return result
 
 
@@ -174,11 +1097,9 @@ def return_id_start_end(items):
     Groups presence entries by weekday.
     """
     result = {i: {'start': [], 'end': []} for i in range(7)}
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()]['start'].append(seconds_since_midnight(start))
-        result[date.weekday()]['end'].append(seconds_since_midnight(end))
+    for day, start, end in items.rows():
+        result[weekday(day)]['start'].append(start)
+        result[weekday(day)]['end'].append(end)
     return result
 
 
@@ -200,4 +1121,12 @@ def mean(items):
     """
     Calculates arithmetic mean. Returns zero for empty lists.
     """
-    return float(sum(items)) / len(items) if len(items) > 0 else 0
+    return mean_of(sum(items), len(items))
+
+
+def mean_of(total, count):
+    """
+    Calculates arithmetic mean of ``count`` items summing up to
+    ``total``. Returns zero when there are no items.
+    """
+    return float(total) / count if count > 0 else 0
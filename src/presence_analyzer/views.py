@@ -4,22 +4,33 @@ Defines views.
 """
 
 import calendar
-from flask import redirect, url_for
+import os
+from flask import Response, abort, redirect, request, url_for
 from flask import Flask
-from flask.ext.mako import MakoTemplates, render_template, exceptions
+from flask.ext.mako import MakoTemplates, render_template
 app = Flask(__name__)  # pylint: disable-msg=C0103
 mako = MakoTemplates(app)  # pylint: disable-msg=C0103
+from presence_analyzer import metrics
+from presence_analyzer.avatars import get_avatar_cache
 from presence_analyzer.main import app
-from presence_analyzer.utils import jsonify, get_data, mean, group_by_weekday
-from presence_analyzer.utils import return_id_start_end, get_data_from_xml
+from presence_analyzer.utils import jsonify, get_data, mean_of
+from presence_analyzer.utils import get_users_directory, json_response
+from presence_analyzer.utils import conditional_response, etag_of
+from presence_analyzer.utils import stream_json_object, parse_day
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable-msg=C0103
 
+PERCENTILES = (10, 50, 90)
+PAGES = {}
+PLACEHOLDER = {}
+PLACEHOLDER_MAX_AGE = 60
+
 pages_list = [
     'presence_weekday',
     'mean_time_weekday',
-    'presence_start_end'
+    'presence_start_end',
+    'occupancy',
 ]
 
 
@@ -36,28 +47,54 @@ def page_to_render(page_name):
     """
     Returns name of page to render
     """
-    try:
-        if page_name not in pages_list:
-            raise exceptions.TopLevelLookupException(page_name)
-        else:
-            return render_template('{}.html'.format(page_name))
-    except exceptions.TopLevelLookupException:
-        return render_template('{}.html'.format('page_not_found'))
-    return render_template('{}.html'.format(page_name))
+    if page_name not in pages_list:
+        page_name = 'page_not_found'
+    body, etag = render_page('{}.html'.format(page_name))
+    return conditional_response(body, etag, 'text/html')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Metrics in Prometheus text format.
+    """
+    return Response(
+        metrics.render(), mimetype='text/plain; version=0.0.4'
+    )
 
 
 @app.route('/api/v1/users', methods=['GET'])
-@jsonify
 def users_view():
     """
     Users listing for dropdown.
     """
-    data_xml = get_data_from_xml()
-    return [{
-        'user_id': user_id,
-        'avatar': details['avatar'],
-        'name': details['name']
-    } for user_id, details in data_xml.iteritems()]
+    directory = get_users_directory()
+    return json_response(directory.json, directory.etag)
+
+
+@app.route('/api/images/users/<int:user_id>', methods=['GET'])
+def avatar_view(user_id):
+    """
+    Avatar of given user, fetched from the intranet once and cached.
+
+    A placeholder is served for a short time while the avatar can't be
+    fetched, and with 404 status for unknown users.
+    """
+    users = get_users_directory().users
+    avatar = None
+    if user_id in users:
+        avatar = get_avatar_cache().get(user_id, users[user_id]['avatar'])
+    if avatar is None:
+        response = conditional_response(*placeholder())
+        response.cache_control.max_age = PLACEHOLDER_MAX_AGE
+        if user_id not in users and response.status_code == 200:
+            response.status_code = 404
+        return response
+    entry, content = avatar
+    response = conditional_response(content, entry.etag, entry.content_type)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('AVATAR_MAX_AGE', 3600)
+    return response
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
@@ -67,15 +104,20 @@ def mean_time_weekday_view(user_id):
     Returns mean presence time of given user grouped by weekday.
     """
     data = get_data()
-    if user_id not in data:
+    days_range = requested_range(data)
+    if not has_stats(data, user_id, days_range):
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], mean(intervals))
-              for weekday, intervals in weekdays.items()]
+    return mean_time_weekday(weekday_stats(data, user_id, days_range))
 
-    return result
+
+@app.route('/api/v1/mean_time_weekday', methods=['GET'])
+def mean_time_weekday_bulk_view():
+    """
+    Returns mean presence time of all or selected users.
+    """
+    return bulk_response(mean_time_weekday)
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
@@ -85,16 +127,20 @@ def presence_weekday_view(user_id):
     Returns total presence time of given user grouped by weekday.
     """
     data = get_data()
-    if user_id not in data:
+    days_range = requested_range(data)
+    if not has_stats(data, user_id, days_range):
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [(calendar.day_abbr[weekday], sum(intervals))
-              for weekday, intervals in weekdays.items()]
+    return presence_weekday(weekday_stats(data, user_id, days_range))
 
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+
+@app.route('/api/v1/presence_weekday', methods=['GET'])
+def presence_weekday_bulk_view():
+    """
+    Returns total presence time of all or selected users.
+    """
+    return bulk_response(presence_weekday)
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
@@ -104,14 +150,234 @@ def presence_start_end_view(user_id):
     Returns interval presence time
     """
     data = get_data()
-    if user_id not in data:
+    days_range = requested_range(data)
+    if not has_stats(data, user_id, days_range):
+        log.debug('User %s not found!', user_id)
+        return []
+
+    return presence_start_end(weekday_stats(data, user_id, days_range))
+
+
+@app.route('/api/v1/presence_start_end', methods=['GET'])
+def presence_start_end_bulk_view():
+    """
+    Returns interval presence time of all or selected users.
+    """
+    return bulk_response(presence_start_end)
+
+
+@app.route('/api/v1/presence_percentiles/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_percentiles_view(user_id):
+    """
+    Returns 10th, 50th and 90th percentile of presence length, start and
+    end of given user grouped by weekday.
+    """
+    data = get_data()
+    days_range = requested_range(data)
+    if not has_stats(data, user_id, days_range):
         log.debug('User %s not found!', user_id)
         return []
 
-    weekdays = return_id_start_end(data[user_id])
-    result = [(calendar.day_abbr[key],
-               mean(value['start']),
-               mean(value['end']))
-              for key, value in weekdays.items()]
+    return presence_percentiles(percentile_stats(data, user_id, days_range))
+
+
+@app.route('/api/v1/presence_percentiles', methods=['GET'])
+def presence_percentiles_bulk_view():
+    """
+    Returns percentiles of presence of all or selected users.
+    """
+    if requested_range(get_data()) is not None:
+        log.debug('Percentiles of ranges of days are not available')
+        abort(400)
+    return bulk_response(presence_percentiles, percentile_stats)
+
 
+@app.route('/api/v1/occupancy', methods=['GET'])
+@jsonify
+def occupancy_view():
+    """
+    Mean number of people in the office at every minute of every
+    weekday, with a header row.
+    """
+    data = get_data()
+    days_range = requested_range(data) or (None, None)
+    try:
+        curves = data.occupancy(*days_range)
+    except NotImplementedError:
+        log.debug('Occupancy is not available')
+        abort(400)
+    result = [['Time'] + list(calendar.day_abbr)]
+    for minute, present in enumerate(zip(*curves)):
+        result.append(
+            ['{:02d}:{:02d}'.format(*divmod(minute, 60))] +
+            [round(value, 2) for value in present]
+        )
     return result
+
+
+def mean_time_weekday(weekdays):
+    """
+    Mean presence time grouped by weekday.
+    """
+    return [(calendar.day_abbr[weekday], mean_of(total, count))
+            for weekday, (count, total, _, _) in enumerate(weekdays)]
+
+
+def presence_weekday(weekdays):
+    """
+    Total presence time grouped by weekday, with a header row.
+    """
+    result = [(calendar.day_abbr[weekday], total)
+              for weekday, (_, total, _, _) in enumerate(weekdays)]
+
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(weekdays):
+    """
+    Mean start and end of presence grouped by weekday.
+    """
+    return [(calendar.day_abbr[weekday],
+             mean_of(start, count),
+             mean_of(end, count))
+            for weekday, (count, _, start, end) in enumerate(weekdays)]
+
+
+def presence_percentiles(weekdays):
+    """
+    Percentiles of presence length, start and end grouped by weekday.
+
+    Values are estimated within 1% of the exact ones, see ``sketch``.
+    """
+    return [
+        (calendar.day_abbr[weekday], {
+            metric: [int(round(value)) for value in values]
+            for metric, values in stats.iteritems()
+        })
+        for weekday, stats in enumerate(weekdays)
+    ]
+
+
+def placeholder():
+    """
+    Returns (body, ETag, mimetype) of the placeholder avatar.
+    """
+    if not PLACEHOLDER:
+        path = os.path.join(app.static_folder, 'img', 'avatar.svg')
+        with open(path, 'rb') as image:
+            body = image.read()
+        PLACEHOLDER['image'] = (body, etag_of(body), 'image/svg+xml')
+    return PLACEHOLDER['image']
+
+
+def render_page(template_name):
+    """
+    Returns (body, ETag) of page rendered from given template.
+
+    Pages don't depend on the request, so each one is rendered once per
+    application root, except in debug mode.
+    """
+    key = (template_name, request.script_root)
+    page = PAGES.get(key)
+    if page is None or app.debug:
+        body = render_template(template_name)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        page = PAGES[key] = (body, etag_of(body))
+    return page
+
+
+def render_pages():
+    """
+    Renders all pages ahead of the first request for them.
+    """
+    for page_name in pages_list + ['page_not_found']:
+        render_page('{}.html'.format(page_name))
+
+
+def requested_range(data):
+    """
+    Returns (first, last) day ordinals from ``from`` and ``to`` query
+    parameters, both optional and in YYYY-MM-DD format.
+
+    Returns None when neither is given, aborts when ``from`` is later
+    than ``to``.
+    """
+    if 'from' not in request.args and 'to' not in request.args:
+        return None
+    if not data.has_ranges:
+        log.debug('Ranges of days are not available')
+        abort(400)
+    first_day = parse_day(request.args.get('from', '0001-01-01'))
+    last_day = parse_day(request.args.get('to', '9999-12-31'))
+    if first_day is None or last_day is None or first_day > last_day:
+        abort(400)
+    return first_day, last_day
+
+
+def has_stats(data, user_id, days_range):
+    """
+    Checks whether there are statistics of user.
+
+    Within a range of days every user has them, zeros when there's no
+    entry of the user in it, so partitioned data doesn't load partitions
+    outside the range just to look for the user.
+    """
+    return days_range is not None or user_id in data
+
+
+def weekday_stats(data, user_id, days_range):
+    """
+    Returns weekday aggregates of user, limited to given range of days.
+    """
+    if days_range is None:
+        return data.weekday_stats(user_id)
+    return data.range_stats(user_id, *days_range)
+
+
+def percentile_stats(data, user_id, days_range):
+    """
+    Returns PERCENTILES of user for every weekday, aborts when a range
+    of days is requested, sketches cover all days only.
+    """
+    if days_range is not None:
+        log.debug('Percentiles of ranges of days are not available')
+        abort(400)
+    return data.quantile_stats(
+        user_id, [percentile / 100.0 for percentile in PERCENTILES]
+    )
+
+
+def bulk_response(statistic, stats=weekday_stats):
+    """
+    Streams JSON object mapping user ids to their statistic.
+
+    All users are included unless ``user_ids`` query parameter lists
+    them, comma separated. Unknown users get an empty list. ``from`` and
+    ``to`` limit the range of days, like in per-user views, every listed
+    user gets statistics then. ``statistic`` is computed from
+    ``stats(data, user_id, days_range)``.
+    """
+    data = get_data()
+    days_range = requested_range(data)
+    if 'user_ids' in request.args:
+        try:
+            user_ids = [int(user_id) for user_id in
+                        request.args['user_ids'].split(',') if user_id]
+        except ValueError:
+            abort(400)
+    else:
+        user_ids = data.users
+
+    def results():  # pylint: disable=C0111
+        for user_id in user_ids:
+            if not has_stats(data, user_id, days_range):
+                log.debug('User %s not found!', user_id)
+                yield user_id, []
+            else:
+                yield user_id, statistic(stats(data, user_id, days_range))
+
+    return Response(stream_json_object(results()),
+                    mimetype='application/json')